@@ -1,4 +1,7 @@
+import os
+import re
 import sys
+import hashlib
 import collections
 from functools import reduce
 from fractions import gcd
@@ -7,6 +10,12 @@ from ase.io import read
 # from ase.io.trajectory import convert
 import numpy as np
 import ase
+from ase.data import atomic_numbers
+from ase.db.core import Database, now
+from ase.io.formats import UnknownFileTypeError
+from ase.io.trajectory import TrajectoryReader
+from ase.symbols import Symbols
+from ase.db.row import AtomsRow
 from ase.utils import formula_metal
 import copy
 from cathub.tools import get_atoms, get_state, clear_prefactor
@@ -25,6 +34,12 @@ try:
 except (ImportError, AttributeError):
     from pathlib2 import Path
 
+# ASE >= 3.18 raises ParseError for files that can not be parsed
+try:
+    from ase.io import ParseError
+except ImportError:
+    ParseError = ValueError
+
 PUBLICATION_TEMPLATE = collections.OrderedDict({
     'title': 'Fancy title',
     'authors': ['Doe, John', 'Einstein, Albert'],
@@ -82,7 +97,26 @@ def symbols(atoms):
     return ''.join(symbols)
 
 
-def collect_structures(foldername, verbose=False, level='*'):
+def collect_structures(foldername, verbose=False, level='*',
+                       parsed_structures=None, cache=None, headers=False):
+    """
+    Read the atomic structures with an energy in foldername.
+
+    Parameters
+    ----------
+    foldername: str
+    level: str
+        glob pattern for structure files
+    parsed_structures: dict
+        structures already read with read_structure, or None, with the
+        normalized filename as key. Structures found here are removed from
+        the dict instead of being read again.
+    cache: ParseCache object
+        cache of structures read by earlier runs
+    headers: bool
+        return StructureHeader objects read with read_structure_header,
+        instead of Atoms objects
+    """
     structures = []
     if verbose:
         print(foldername)
@@ -98,64 +132,88 @@ def collect_structures(foldername, verbose=False, level='*'):
         if posix_filename.endswith('traj.old'):
             continue
         elif Path(posix_filename).is_file():
-            try:
-                filetype = ase.io.formats.filetype(posix_filename)
-            except Exception as e:
-                continue
-            if filetype:
-                try:
-                    structure = ase.io.read(posix_filename)
-                    structure.info['filename'] = posix_filename
-                    structure.info['filetype'] = ase.io.formats.filetype(
-                        posix_filename)
-                    try:
-                        structure.get_potential_energy()
-                        # ensure that the structure has an energy
-                        structures.append(structure)
-                    except RuntimeError:
-                        print("Did not add {posix_filename} since it has no energy"
-                              .format(
-                                  posix_filename=posix_filename,
-                              ))
-                except TypeError:
-                    print("Warning: Could not read {posix_filename}"
-                            .format(
-                                posix_filename=posix_filename,
-                                ))
-
-                except StopIteration:
-                    print("Warning: StopIteration {posix_filename} hit."
-                          .format(
-                              posix_filename=posix_filename,
-                          ))
-                except IndexError:
-                    print("Warning: File {posix_filename} looks incomplete"
-                          .format(
-                              posix_filename=posix_filename,
-                          ))
-                except OSError as e:
-                    print("Error with {posix_filename}: {e}".format(
-                        posix_filename=posix_filename,
-                        e=e,
-                    ))
-                except AssertionError as e:
-                    print("Hit an assertion error with {posix_filename}: {e}".format(
-                        posix_filename=posix_filename,
-                        e=e,
-                    ))
-                except ValueError as e:
-                    print("Trouble reading {posix_filename}: {e}".format(
-                        posix_filename=posix_filename,
-                        e=e,
-                    ))
-                except DeprecationWarning as e:
-                    print("Trouble reading {posix_filename}: {e}".format(
-                        posix_filename=posix_filename,
-                        e=e,
-                    ))
+            key = os.path.normpath(posix_filename)
+            if parsed_structures is not None and key in parsed_structures:
+                structure = parsed_structures.pop(key)
+            elif cache is not None:
+                structure = cache.read_structure(posix_filename)
+            elif headers:
+                structure = read_structure_header(posix_filename)
+            else:
+                structure = read_structure(posix_filename)
+            if structure is not None:
+                structures.append(structure)
     return structures
 
 
+def read_structure(posix_filename):
+    """
+    Read atomic structure file with ASE. Returns Atoms object, or None if
+    the file is not a structure file, can not be read or has no energy.
+    """
+    try:
+        filetype = ase.io.formats.filetype(posix_filename)
+    except Exception as e:
+        return None
+    if not filetype:
+        return None
+    try:
+        structure = ase.io.read(posix_filename)
+        structure.info['filename'] = posix_filename
+        structure.info['filetype'] = filetype
+        try:
+            structure.get_potential_energy()
+            # ensure that the structure has an energy
+            return structure
+        except RuntimeError:
+            print("Did not add {posix_filename} since it has no energy"
+                  .format(
+                      posix_filename=posix_filename,
+                  ))
+    except TypeError:
+        print("Warning: Could not read {posix_filename}"
+              .format(
+                  posix_filename=posix_filename,
+              ))
+
+    except StopIteration:
+        print("Warning: StopIteration {posix_filename} hit."
+              .format(
+                  posix_filename=posix_filename,
+              ))
+    except IndexError:
+        print("Warning: File {posix_filename} looks incomplete"
+              .format(
+                  posix_filename=posix_filename,
+              ))
+    except OSError as e:
+        print("Error with {posix_filename}: {e}".format(
+            posix_filename=posix_filename,
+            e=e,
+        ))
+    except AssertionError as e:
+        print("Hit an assertion error with {posix_filename}: {e}".format(
+            posix_filename=posix_filename,
+            e=e,
+        ))
+    except ValueError as e:
+        print("Trouble reading {posix_filename}: {e}".format(
+            posix_filename=posix_filename,
+            e=e,
+        ))
+    except DeprecationWarning as e:
+        print("Trouble reading {posix_filename}: {e}".format(
+            posix_filename=posix_filename,
+            e=e,
+        ))
+    except (ParseError, UnknownFileTypeError) as e:
+        print("Trouble reading {posix_filename}: {e}".format(
+            posix_filename=posix_filename,
+            e=e,
+        ))
+    return None
+
+
 def get_energies(atoms_list):
     """ Potential energy for a list of atoms objects"""
     if len(atoms_list) == 1:
@@ -304,26 +362,218 @@ def get_bulk_composition(atoms):
     return bulk_composition
 
 
-def check_in_ase(atoms, ase_db, energy=None):
-    """Check if entry is allready in ASE db"""
+class StructureHeader:
+    """
+    Atomic numbers, cell, pbc and energy of the structure in a file, with
+    the methods of Atoms used to match structures with reactions. The full
+    Atoms object is only read with get_atoms(), f.ex. when the structure is
+    written to ASE db.
+    """
+
+    def __init__(self, numbers, cell, pbc, energy, info=None, atoms=None):
+        self.numbers = np.array(numbers, dtype=int)
+        self.cell = np.array(cell, dtype=float)
+        self.pbc = np.array(pbc, dtype=bool)
+        self.energy = energy
+        self.info = info or {}
+        self._atoms = atoms
+
+    @classmethod
+    def from_atoms(cls, atoms):
+        return cls(atoms.numbers, atoms.cell, atoms.pbc,
+                   atoms.get_potential_energy(), dict(atoms.info), atoms)
+
+    def __len__(self):
+        return len(self.numbers)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_atoms'] = None  # read again from file if needed
+        return state
 
-    db_ase = ase.db.connect(ase_db)
+    def get_atomic_numbers(self):
+        return self.numbers.copy()
+
+    def get_chemical_formula(self, mode='hill', empirical=False):
+        return Symbols(self.numbers).get_chemical_formula(mode, empirical)
+
+    def get_potential_energy(self):
+        return self.energy
+
+    def get_atoms(self):
+        """Atoms object with calculator, read from file"""
+        if self._atoms is not None:
+            return self._atoms
+        atoms = ase.io.read(self.info['filename'])
+        atoms.info.update(self.info)
+        return atoms
+
+
+def read_structure_header(posix_filename):
+    """
+    Read the atomic numbers, cell, pbc and energy of the structure in a
+    file, without building Atoms and calculator objects for traj, json and
+    OUTCAR files. Other files are read with read_structure.
+
+    Returns StructureHeader object, or None like read_structure.
+    """
+    try:
+        filetype = ase.io.formats.filetype(posix_filename)
+    except Exception as e:
+        return None
+    if not filetype:
+        return None
+    header = None
+    if filetype in header_readers:
+        try:
+            header = header_readers[filetype](posix_filename)
+        except Exception:
+            header = None  # read_structure reports the error
+    if header is None:
+        atoms = read_structure(posix_filename)
+        if atoms is None:
+            return None
+        return StructureHeader.from_atoms(atoms)
+    if header.energy is None:
+        print("Did not add {posix_filename} since it has no energy"
+              .format(
+                  posix_filename=posix_filename,
+              ))
+        return None
+    header.info['filename'] = posix_filename
+    header.info['filetype'] = filetype
+    return header
+
+
+def read_traj_header(filename):
+    """Header of the last image of an ASE trajectory, without reading
+    positions and other arrays"""
+    trajectory = TrajectoryReader(filename)
+    try:
+        if len(trajectory) == 0:
+            return None
+        b = trajectory.backend[-1]
+        if 'numbers' in b:
+            numbers, pbc = b.numbers, b.pbc
+        else:
+            numbers, pbc = trajectory.numbers, trajectory.pbc
+        energy = None
+        if 'calculator' in b and 'energy' in b.calculator:
+            energy = b.calculator.get('energy')
+        return StructureHeader(numbers, b.cell, pbc, energy)
+    finally:
+        trajectory.close()
+
+
+def read_json_header(filename):
+    """Header of the last row of an ASE json db file"""
+    row = None
+    for row in ase.db.connect(filename, serial=True).select(
+            include_data=False):
+        pass
+    if row is None:
+        return None
+    return StructureHeader(row.numbers, row.cell, row.pbc, row.get('energy'))
+
+
+def read_outcar_header(filename):
+    """
+    Header of the last image of a VASP OUTCAR file, following
+    ase.io.vasp.read_vasp_out without building an Atoms object and
+    calculator for each ionic step.
+    """
+    with open(filename) as f:
+        data = f.readlines()
+    species = []
+    numbers = []
+    cell = np.zeros((3, 3))
+    image_cell = None
+    energy = 0
+    image_energy = None
+    ecount = 0
+    poscount = 0
+    for n, line in enumerate(data):
+        if 'POTCAR:' in line:
+            name = line.split()[2]
+            for c in ['.', '_', '1']:
+                if c in name:
+                    name = name[0:name.find(c)]
+            species += [name]
+        if 'ions per type' in line:
+            species = species[:len(species) // 2]
+            for name, count in zip(species, line.split()[4:]):
+                numbers += [atomic_numbers[name]] * int(count)
+        if 'direct lattice vectors' in line:
+            cell = [[float(x) for x in split_outcar_line(data[n + 1 + i])[:3]]
+                    for i in range(3)]
+        if 'FREE ENERGIE OF THE ION-ELECTRON SYSTEM' in line:
+            energy = float(split_outcar_line(data[n + 4])[6])
+            if ecount < poscount:
+                image_energy = energy
+            ecount += 1
+        if 'POSITION          ' in line:
+            data[n + 1 + len(numbers)]  # IndexError for incomplete file
+            image_cell = cell
+            image_energy = energy
+            cell = np.zeros((3, 3))
+            poscount += 1
+    if image_cell is None:
+        return None
+    return StructureHeader(numbers, image_cell, [True] * 3, image_energy)
+
+
+def split_outcar_line(line):
+    return re.sub('([0-9])-([0-9])', r'\1 -\2', line).split()
+
+
+header_readers = {'traj': read_traj_header,
+                  'json': read_json_header,
+                  'vasp-out': read_outcar_header}
+
+
+def get_structure_hash(atoms, energy=None, decimals=4, energy_decimals=6):
+    """
+    Content hash of an atomic structure, from the atomic numbers, positions
+    and cell rounded to decimals, the pbc and the energy rounded to
+    energy_decimals. Stored as the structure_hash key in ASE db.
+    """
     if energy is None:
         energy = atoms.get_potential_energy()
-    formula = get_chemical_formula(atoms)
-    rows = db_ase.select(energy=energy)
-    n = 0
-    ids = []
-    for row in rows:
-        if formula == row.formula:
-            n += 1
-            ids.append(row.id)
-    if n > 0:
-        id = ids[0]
-        unique_id = db_ase.get(id)['unique_id']
-        return id, unique_id
-    else:
-        return None, None
+
+    def rounded(array, n):
+        # adding 0.0 turns -0.0 into 0.0
+        return (np.round(np.asarray(array, dtype=float), n) + 0.0).tobytes()
+
+    structure_hash = hashlib.sha1()
+    structure_hash.update(np.asarray(atoms.numbers, dtype=np.int64).tobytes())
+    structure_hash.update(rounded(atoms.positions, decimals))
+    structure_hash.update(rounded(atoms.cell, decimals))
+    structure_hash.update(np.asarray(atoms.pbc, dtype=bool).tobytes())
+    structure_hash.update(rounded([energy], energy_decimals))
+    return structure_hash.hexdigest()
+
+
+def get_ase_row(db_ase, structure_hash):
+    """Get (id, unique_id) of the row in ASE db with structure_hash, or
+    (None, None)"""
+    for row in db_ase.select(structure_hash=structure_hash,
+                             include_data=False, limit=1):
+        return row.id, row.unique_id
+    return None, None
+
+
+def get_ase_db(db_file):
+    """ASE db of filename, or db_file if it is an ASE db already"""
+    if isinstance(db_file, Database):
+        return db_file
+    return ase.db.connect(db_file)
+
+
+def check_in_ase(atoms, ase_db, energy=None):
+    """Check if entry is allready in ASE db"""
+
+    db_ase = get_ase_db(ase_db)
+    return get_ase_row(db_ase, get_structure_hash(atoms, energy))
 
 
 def _normalize_key_value_pairs_inplace(data):
@@ -332,19 +582,35 @@ def _normalize_key_value_pairs_inplace(data):
             data[key] = int(data[key])
 
 
-def write_ase(atoms, db_file, stdout=sys.stdout, user=None, data=None, **key_value_pairs):
-    """Connect to ASE db"""
-    db_ase = ase.db.connect(db_file)
+def write_ase(atoms, db_file, stdout=sys.stdout, user=None, data=None,
+              return_id=False, **key_value_pairs):
+    """Connect to ASE db, unless db_file is an ASE db already. Returns
+    unique_id, or (id, unique_id) if return_id is True. An identical
+    structure that is already in the ASE db is not written again, and its
+    unique_id is returned."""
+    db_ase = get_ase_db(db_file)
     _normalize_key_value_pairs_inplace(key_value_pairs)
-    id = db_ase.write(atoms, data=data, **key_value_pairs)
-    stdout.write('  writing atoms to ASE db row id = {}\n'.format(id))
-    unique_id = db_ase.get(id)['unique_id']
+    structure_hash = get_structure_hash(atoms)
+    id, unique_id = get_ase_row(db_ase, structure_hash)
+    if id is not None:
+        stdout.write('  atoms already in ASE db row id = {}\n'.format(id))
+    else:
+        # unique_id is assigned here, so no need to read back the row
+        row = AtomsRow(atoms)
+        row.ctime = now()
+        row.user = os.getenv('USER')
+        key_value_pairs['structure_hash'] = structure_hash
+        id = db_ase.write(row, data=data, **key_value_pairs)
+        unique_id = row.unique_id
+        stdout.write('  writing atoms to ASE db row id = {}\n'.format(id))
+    if return_id:
+        return id, unique_id
     return unique_id
 
 
 def update_ase(db_file, identity, stdout, **key_value_pairs):
-    """Connect to ASE db"""
-    db_ase = ase.db.connect(db_file)
+    """Connect to ASE db, unless db_file is an ASE db already"""
+    db_ase = get_ase_db(db_file)
 
     _normalize_key_value_pairs_inplace(key_value_pairs)
     count = db_ase.update(identity, **key_value_pairs)
@@ -1,10 +1,16 @@
+import os
 import sys
+from itertools import islice
+from contextlib import contextmanager
+import ase.db
 from ase.db.sqlite import SQLite3Database
 import sqlite3
 import json
-from past.utils import PY2
 from tabulate import tabulate
 
+from .tools import clear_state, get_state
+from .ase_tools import get_structure_hash
+
 
 init_commands = [
     """ CREATE TABLE publication (
@@ -55,6 +61,61 @@ init_commands = [
     FOREIGN KEY (id) REFERENCES reaction(id)
     );"""]
 
+species_commands = [
+    """CREATE TABLE IF NOT EXISTS reaction_species (
+    reaction_id integer,
+    species text,
+    state text,
+    prefactor real,
+    side text,
+    FOREIGN KEY (reaction_id) REFERENCES reaction(id)
+    );""",
+    'CREATE INDEX IF NOT EXISTS idxspecies ON reaction_species '
+    '(species, state, side);',
+    'CREATE INDEX IF NOT EXISTS idxspeciesreac ON reaction_species '
+    '(reaction_id);'
+]
+
+index_commands = [
+    'CREATE INDEX IF NOT EXISTS idxpubid ON publication (pub_id);',
+    'CREATE INDEX IF NOT EXISTS idxreacten ON reaction (reaction_energy);',
+    'CREATE INDEX IF NOT EXISTS idxchemcomp ON reaction '
+    '(chemical_composition);',
+    'CREATE INDEX IF NOT EXISTS idxreact ON reaction (reactants);',
+    'CREATE INDEX IF NOT EXISTS idxprod ON reaction (products);',
+    'CREATE INDEX IF NOT EXISTS idxuser ON reaction (username);',
+    'CREATE INDEX IF NOT EXISTS idxreacsys ON reaction_system (id);',
+    'CREATE INDEX IF NOT EXISTS idxpubsys ON publication_system (ase_id);',
+    'CREATE INDEX IF NOT EXISTS idxtextkeyvalue ON text_key_values '
+    '(key, value);'
+]
+
+
+# Journal of blocks transferred to a postgreSQL server, for resuming
+checkpoint_commands = [
+    """CREATE TABLE IF NOT EXISTS transfer_checkpoint (
+    server text,
+    phase text,
+    source_start integer,
+    source_end integer,
+    target_start integer,
+    target_end integer,
+    completed integer,
+    PRIMARY KEY (server, phase, source_start)
+    );"""]
+
+# Fingerprints of folders read by FolderReader, for incremental reading
+fingerprint_commands = [
+    """CREATE TABLE IF NOT EXISTS folder_fingerprint (
+    folder text PRIMARY KEY,
+    fingerprint text,
+    reaction_id integer
+    );"""]
+
+
+# Files with reaction tables, shared between CathubSQLite sessions
+_initialized_files = set()
+
 
 class CathubSQLite:
     """Class for managing SQLite3 database for reaction energies,
@@ -72,6 +133,11 @@ class CathubSQLite:
        reaction_system: mamy-to-many mapping between reaction table and
            systems table in ASE database
 
+    and the reaction_species table, with one row per reactant and product
+    of a reaction (species, state, prefactor and side), for indexed
+    lookups of reactions by species. Files written with older versions are
+    upgraded with migrate().
+
     Connect to a database object:
 
         db = CathubSQLite('yourdbfile.db')
@@ -81,33 +147,89 @@ class CathubSQLite:
         with db as CathubSQLite('yourdbfile.db'):
             Do your work...
 
+    Keep one tuned connection open for many manipulations (session mode).
+    Changes are committed when the outermost with block exits, and
+    on close():
+
+        db = CathubSQLite('yourdbfile.db', session=True)
+        with db:
+            Do your work...
+        with db:
+            Do more work...
+        db.close()
+
     Parameters
     ----------
     filename : str
         name of database file
+    session : bool
+        keep one connection open until close() is called. The connection
+        uses WAL journaling and the pragmas below. The file is switched
+        back to the default rollback journal by close().
+    synchronous : str
+        synchronous pragma in session mode: 'OFF', 'NORMAL', 'FULL' or
+        'EXTRA'
+    cache_size : int
+        cache_size pragma in session mode. Negative values are in KiB.
+    mmap_size : int
+        mmap_size pragma in session mode, in bytes
     """
 
-    def __init__(self, filename, stdin=sys.stdin, stdout=sys.stdout):
+    def __init__(self, filename, stdin=sys.stdin, stdout=sys.stdout,
+                 session=False, synchronous='NORMAL', cache_size=-64000,
+                 mmap_size=268435456):
 
         assert filename.endswith('.db'), 'filename should have .db extension'
+        assert synchronous.upper() in ['OFF', 'NORMAL', 'FULL', 'EXTRA'], \
+            'synchronous should be OFF, NORMAL, FULL or EXTRA'
         self.filename = filename
         self.initialized = False
+        self.species = False
         self.default = 'NULL'
         self.connection = None
         self.stdin = stdin
         self.stdout = stdout
+        self.session = session
+        self.synchronous = synchronous.upper()
+        self.cache_size = int(cache_size)
+        self.mmap_size = int(mmap_size)
+        self.depth = 0
 
     def _connect(self):
-        return sqlite3.connect(self.filename, timeout=600)
+        con = sqlite3.connect(self.filename, timeout=600)
+        if self.session:
+            con.execute('PRAGMA journal_mode=WAL')
+            con.execute('PRAGMA synchronous={}'.format(self.synchronous))
+            con.execute('PRAGMA cache_size={}'.format(self.cache_size))
+            con.execute('PRAGMA mmap_size={}'.format(self.mmap_size))
+
+            cur = con.execute(
+                'SELECT COUNT(*) FROM sqlite_master WHERE name="reaction"')
+            if cur.fetchone()[0] == 0:  # new or replaced file
+                _initialized_files.discard(os.path.abspath(self.filename))
+                self.initialized = False
+        return con
 
     def __enter__(self):
         """Set connection upon entry using with statement"""
+        if self.session:
+            if self.connection is None:
+                self.connection = self._connect()
+            self.depth += 1
+            return self
         assert self.connection is None
         self.connection = self._connect()
         return self
 
     def __exit__(self, exc_type, exc_value, tb):
         """Commit changes upon exit"""
+        if self.session:
+            self.depth -= 1
+            if exc_type is not None:
+                self.connection.rollback()
+            elif self.depth == 0:
+                self.connection.commit()
+            return
         if exc_type is None:
             self.connection.commit()
         else:
@@ -115,11 +237,48 @@ class CathubSQLite:
         self.connection.close()
         self.connection = None
 
+    def get_ase_db(self):
+        """
+        ASE db of the file. With an open session connection, the ASE db
+        runs over that connection, such that atomic structures are written
+        in the same transactions as reactions, and are visible to both
+        before they are committed.
+        """
+        if self.session and self.connection is not None:
+            return SessionSQLite3Database(self.filename, self.connection)
+        return ase.db.connect(self.filename)
+
+    def commit(self):
+        """Commit changes on the open connection"""
+        if self.connection is not None:
+            self.connection.commit()
+
+    def close(self):
+        """Commit changes and close the session connection"""
+        if self.connection is not None:
+            self.connection.commit()
+            if self.session:
+                # WAL mode is persistent, and would leave -wal and -shm
+                # files next to the db file for later readers
+                try:
+                    self.connection.execute('PRAGMA journal_mode=DELETE')
+                except sqlite3.OperationalError:
+                    pass  # still open elsewhere, left in WAL mode
+            self.connection.close()
+            self.connection = None
+        self.depth = 0
+
     def _initialize(self, con):
         """Set up tables in SQL"""
         if self.initialized:
             return
 
+        filename = os.path.abspath(self.filename)
+        if self.session and filename in _initialized_files:
+            self.species = self._has_species(con)
+            self.initialized = True
+            return
+
         SQLite3Database()._initialize(con)  # ASE db initialization
 
         cur = con.execute(
@@ -128,9 +287,79 @@ class CathubSQLite:
         if cur.fetchone()[0] == 0:  # no reaction table
             for init_command in init_commands:
                 con.execute(init_command)  # Create tables
+            for index_command in index_commands:
+                con.execute(index_command)
+            for species_command in species_commands:
+                con.execute(species_command)
             con.commit()
 
+        self.species = self._has_species(con)
         self.initialized = True
+        if self.session:
+            _initialized_files.add(filename)
+
+    def _has_species(self, con):
+        cur = con.execute(
+            'SELECT COUNT(*) FROM sqlite_master WHERE name="reaction_species"')
+        return cur.fetchone()[0] > 0
+
+    def migrate(self):
+        """
+        Update the schema of an existing db file by creating missing
+        indexes, and the reaction_species table filled from the reactants
+        and products of the reaction table. The structure_hash key, used to
+        find duplicate structures, is added to atomic structures written
+        before it was introduced. Can safely be run several times.
+
+        Returns: list of names of created tables and indexes, and
+        'structure_hash' if it was added to any structures
+        """
+        con = self.connection or self._connect()
+        self._initialize(con)
+        cur = con.cursor()
+
+        statement = "SELECT name FROM sqlite_master WHERE type='index'"
+        cur.execute(statement)
+        indexes0 = set(row[0] for row in cur.fetchall())
+        for index_command in index_commands:
+            cur.execute(index_command)
+
+        created = []
+        if not self.species:
+            for species_command in species_commands:
+                cur.execute(species_command)
+            species_values = []
+            for row, reaction_systems in self.iter_reactions():
+                for species_row in get_species_values(json.loads(row[6]),
+                                                      json.loads(row[7])):
+                    species_values.append([row[0]] + species_row)
+            cur.executemany(
+                'INSERT INTO reaction_species VALUES (?, ?, ?, ?, ?)',
+                species_values)
+            self.species = True
+            created.append('reaction_species')
+
+        cur.execute(statement)
+        created += sorted(set(row[0] for row in cur.fetchall()) - indexes0)
+
+        cur.execute(
+            'SELECT COUNT(*) FROM sqlite_master WHERE name="systems"')
+        if cur.fetchone()[0] > 0:
+            db_ase = SessionSQLite3Database(self.filename, con)
+            hashes = [(row.id, get_structure_hash(row.toatoms(), row.energy))
+                      for row in db_ase.select(include_data=False)
+                      if 'structure_hash' not in row.key_value_pairs and
+                      row.get('energy') is not None]
+            for id, structure_hash in hashes:
+                db_ase.update(id, structure_hash=structure_hash)
+            if hashes:
+                created.append('structure_hash')
+
+        if self.connection is None:
+            con.commit()
+            con.close()
+
+        return created
 
     def read(self, id, table='reaction'):
         """ Return an entire row of a table
@@ -154,6 +383,94 @@ class CathubSQLite:
 
         return row
 
+    def iter_reactions(self, where=None, params=[], batch_size=1000):
+        """
+        Iterate over rows of the reaction table together with their
+        reaction_system rows, ordered by reaction id. Rows are fetched
+        batch_size at the time with keyset pagination on reaction.id, such
+        that memory use is independent of the size of the db file.
+
+        Parameters
+        ----------
+        where: str
+            SQL condition on the reaction table, f.ex.
+            'reaction.surface_composition=?'
+        params: list
+            values for the ? placeholders in where
+        batch_size: int
+            number of reactions to fetch per query
+
+        Yields: (reaction row, list of reaction_system rows)
+        """
+        con = self.connection or self._connect()
+        self._initialize(con)
+        cur = con.cursor()
+
+        condition = 'reaction.id > ?'
+        if where:
+            condition += ' AND ({})'.format(where)
+        statement = """SELECT * FROM reaction WHERE {}
+        ORDER BY reaction.id LIMIT ?""".format(condition)
+        system_statement = """SELECT * FROM reaction_system
+        WHERE reaction_system.id IN ({})"""
+
+        last_id = 0
+        try:
+            while True:
+                cur.execute(statement, [last_id] + list(params) + [batch_size])
+                rows = cur.fetchmany(batch_size)
+                if len(rows) == 0:
+                    break
+                last_id = rows[-1][0]
+
+                # only the systems of the fetched reactions, which may be
+                # spread over a wide id range with a selective where
+                reaction_systems = {}
+                for ids in get_batches([row[0] for row in rows], 500):
+                    cur.execute(system_statement.format(
+                        ', '.join('?' * len(ids))), ids)
+                    system_rows = cur.fetchmany(batch_size)
+                    while system_rows:
+                        for system_row in system_rows:
+                            reaction_systems.setdefault(system_row[3], []) \
+                                .append(system_row)
+                        system_rows = cur.fetchmany(batch_size)
+
+                for row in rows:
+                    yield row, reaction_systems.get(row[0], [])
+        finally:
+            if self.connection is None:
+                con.close()
+
+    def get_species_names(self):
+        """
+        Get the names of all reactants and products in the reaction table
+
+        Returns: {'reactants': sorted list, 'products': sorted list}
+        """
+        con = self.connection or self._connect()
+        self._initialize(con)
+        cur = con.cursor()
+
+        names = {}
+        try:
+            for side in ['reactants', 'products']:
+                cur.execute(
+                    """SELECT DISTINCT json_each.key FROM reaction,
+                    json_each(reaction.{})""".format(side))
+                names[side] = sorted(row[0] for row in cur.fetchall())
+        except sqlite3.OperationalError:  # no JSON1 extension
+            names = {'reactants': set(), 'products': set()}
+            for row, reaction_systems in self.iter_reactions():
+                names['reactants'].update(json.loads(row[6]) or {})
+                names['products'].update(json.loads(row[7]) or {})
+            names = {side: sorted(names[side]) for side in names}
+
+        if self.connection is None:
+            con.close()
+
+        return names
+
     def write_publication(self, values):
         """
         Write publication info to db
@@ -239,57 +556,107 @@ class CathubSQLite:
         cur = con.cursor()
 
         pub_id = values['pub_id']
-        ase_ids = values['ase_ids']
-        energy_corrections = values['energy_corrections']
-
-        if ase_ids is not None:
-            check_ase_ids(values, ase_ids)
-        else:
-            ase_ids = {}
-        values = (values['chemical_composition'],
-                  values['surface_composition'],
-                  values['facet'],
-                  json.dumps(values['sites']),
-                  json.dumps(values['coverages']),
-                  json.dumps(values['reactants']),
-                  json.dumps(values['products']),
-                  values['reaction_energy'],
-                  values['activation_energy'],
-                  values['dft_code'],
-                  values['dft_functional'],
-                  values['username'],
-                  values['pub_id']
-                  )
+        reaction_values, reaction_structure_values = \
+            get_reaction_values(values)
 
         """ Write to reaction table"""
-        q = self.default + ',' + ', '.join('?' * len(values))
+        q = self.default + ',' + ', '.join('?' * len(reaction_values))
         cur.execute('INSERT INTO reaction VALUES ({})'.format(q),
-                    values)
+                    reaction_values)
         id = self.get_last_id(cur)
 
-        reaction_structure_values = []
-
         """ Write to publication_system and reaction_system tables"""
-        for name, ase_id in ase_ids.items():
-            if name in energy_corrections:
-                energy_correction = energy_corrections[name]
-            else:
-                energy_correction = 0
-            reaction_structure_values.append([name, energy_correction,
-                                              ase_id, id])
+        for reaction_structure in reaction_structure_values:
+            reaction_structure.append(id)
             insert_statement = """INSERT OR IGNORE INTO
             publication_system(ase_id, pub_id) VALUES (?, ?)"""
-            cur.execute(insert_statement, [ase_id, pub_id])
+            cur.execute(insert_statement, [reaction_structure[2], pub_id])
 
         cur.executemany('INSERT INTO reaction_system VALUES (?, ?, ?, ?)',
                         reaction_structure_values)
 
+        if self.species:
+            self._write_species(cur, id, values)
+
         if self.connection is None:
             con.commit()
             con.close()
 
         return id
 
+    def _write_species(self, cur, id, values):
+        """Write reactants and products of reaction to reaction_species"""
+        species_values = [[id] + species_row for species_row in
+                          get_species_values(values['reactants'],
+                                             values['products'])]
+        cur.executemany('INSERT INTO reaction_species VALUES (?, ?, ?, ?, ?)',
+                        species_values)
+
+    def write_many(self, values_iter, batch_size=1000):
+        """
+        Write several reactions to db file in a single transaction.
+        Reaction ids are assigned up front, such that the reaction,
+        reaction_system and publication_system rows can be inserted
+        with executemany, batch_size reactions at the time.
+
+        Parameters
+        ----------
+        values_iter: iterable of dicts
+            See write() method for details
+        batch_size: int
+            Number of reactions to insert per executemany call
+
+        Returns: list of ids
+        """
+        con = self.connection or self._connect()
+        self._initialize(con)
+        cur = con.cursor()
+
+        if not getattr(con, 'in_transaction', True):
+            cur.execute('BEGIN IMMEDIATE')  # reserve ids until commit
+
+        id = self.get_last_id(cur)
+        ids = []
+        for values_batch in get_batches(values_iter, batch_size):
+            reaction_values = []
+            reaction_system_values = []
+            publication_system_values = set()
+            species_values = []
+            for values in values_batch:
+                id += 1
+                values_reaction, reaction_structure_values = \
+                    get_reaction_values(values)
+                reaction_values.append((id, ) + values_reaction)
+                if self.species:
+                    species_values += [
+                        [id] + species_row for species_row in
+                        get_species_values(values['reactants'],
+                                           values['products'])]
+                for reaction_structure in reaction_structure_values:
+                    reaction_structure.append(id)
+                    publication_system_values.add(
+                        (reaction_structure[2], values['pub_id']))
+                reaction_system_values += reaction_structure_values
+                ids.append(id)
+
+            q = ', '.join('?' * len(reaction_values[0]))
+            cur.executemany('INSERT INTO reaction VALUES ({})'.format(q),
+                            reaction_values)
+            cur.executemany("""INSERT OR IGNORE INTO
+            publication_system(ase_id, pub_id) VALUES (?, ?)""",
+                            sorted(publication_system_values))
+            cur.executemany('INSERT INTO reaction_system VALUES (?, ?, ?, ?)',
+                            reaction_system_values)
+            cur.executemany(
+                'INSERT INTO reaction_species VALUES (?, ?, ?, ?, ?)',
+                species_values)
+
+        if self.connection is None:
+            con.commit()
+            con.close()
+
+        return ids
+
     def update(self, id, values, key_names='all'):
         """
         Update reaction info for a selected row
@@ -305,50 +672,247 @@ class CathubSQLite:
             pairs in values.
             default is 'all'
         """
+        self.update_many([id], [values], key_names=key_names)
+        return id
+
+    def update_many(self, ids, values_list, key_names='all',
+                    batch_size=1000):
+        """
+        Update reaction info for several rows in a single transaction,
+        with bound parameters and executemany, batch_size rows at the time.
+
+        Parameters
+        ----------
+        ids: list of int
+            row integers
+        values_list: list of dicts
+            values for each row. See write() method for details
+        key_names: list or 'all'
+            list with name of columns to update. Should match the keys-value
+            pairs in values.
+            default is 'all'
+        batch_size: int
+            Number of rows to update per executemany call
+
+        Returns: list of ids
+        """
+        assert len(ids) == len(values_list), \
+            'ids and values_list should have the same length'
         con = self.connection or self._connect()
         self._initialize(con)
         cur = con.cursor()
 
-        pub_id = values['pub_id']
-        ase_ids = values['ase_ids']
-        energy_corrections = values['energy_corrections']
-
-        if ase_ids is not None:
-            check_ase_ids(values, ase_ids)
-        else:
-            ase_ids = {}
-
-        key_list, value_list = get_key_value_list(key_names, values)
-        N_keys = len(key_list)
+        if not getattr(con, 'in_transaction', True):
+            cur.execute('BEGIN IMMEDIATE')
+
+        key_list = get_key_value_list(key_names, values_list[0])[0] \
+            if values_list else []
+        update_command = 'UPDATE reaction SET {} WHERE id = ?'.format(
+            ', '.join('{}=?'.format(key) for key in key_list))
+        update_species = self.species and ('reactants' in key_list or
+                                           'products' in key_list)
+
+        # Later updates of the same row replace earlier ones
+        last_values = dict(zip(ids, values_list))
+        rows = [(id, last_values.pop(id)) for id in ids if id in last_values]
+
+        for batch in get_batches(rows, batch_size):
+            reaction_values = []
+            reaction_system_values = []
+            publication_system_values = set()
+            species_values = []
+            for id, values in batch:
+                value_list = get_key_value_list(key_list, values)[1]
+                reaction_values.append(get_value_params(value_list) + [id])
+
+                ase_ids = values['ase_ids']
+                if ase_ids is not None:
+                    check_ase_ids(values, ase_ids)
+                else:
+                    ase_ids = {}
+                energy_corrections = values['energy_corrections']
+                for name, ase_id in ase_ids.items():
+                    reaction_system_values.append(
+                        [name, energy_corrections.get(name), ase_id, id])
+                    publication_system_values.add((ase_id, values['pub_id']))
+
+                if update_species:
+                    species_values += [
+                        [id] + species_row for species_row in
+                        get_species_values(values['reactants'],
+                                           values['products'])]
+
+            batch_ids = [[id] for id, values in batch]
+            cur.executemany(update_command, reaction_values)
+            cur.executemany('DELETE FROM reaction_system WHERE id = ?',
+                            batch_ids)
+            cur.executemany("""INSERT OR IGNORE INTO
+            publication_system(ase_id, pub_id) VALUES (?, ?)""",
+                            sorted(publication_system_values))
+            cur.executemany('INSERT INTO reaction_system VALUES (?, ?, ?, ?)',
+                            reaction_system_values)
+            if update_species:
+                cur.executemany(
+                    'DELETE FROM reaction_species WHERE reaction_id = ?',
+                    batch_ids)
+                cur.executemany(
+                    'INSERT INTO reaction_species VALUES (?, ?, ?, ?, ?)',
+                    species_values)
 
-        value_strlist = get_value_strlist(value_list)
-        execute_str = ', '.join('{}={}'.format(key_list[i], value_strlist[i])
-                                for i in range(N_keys))
+        if self.connection is None:
+            con.commit()
+            con.close()
+        return list(ids)
 
-        update_command = 'UPDATE reaction SET {} WHERE id = {};'\
-            .format(execute_str, id)
+    def merge(self, filename):
+        """
+        Merge the atomic structures, publications and reactions of another
+        db file into this one, with set-based INSERT ... SELECT statements
+        on the attached file. Rows are given new ids. Skipped are:
+        structures with a unique_id that is already present, publications
+        with the same pub_id, and reactions with the same pub_id,
+        composition, facet, reactants, products and reaction energy. An
+        interrupted merge can therefore be restarted.
+        Each file is merged in a single transaction.
 
-        cur.execute(update_command)
+        Parameters
+        ----------
+        filename: str
+            name of db file to merge into this one
 
-        delete_command = 'DELETE from reaction_system WHERE id = {}'.format(id)
-        cur.execute(delete_command)
+        Returns: dict with number of inserted rows per table
+        """
+        con = self.connection or self._connect()
+        self._initialize(con)
+        con.commit()  # can't attach database within transaction
+        cur = con.cursor()
+        cur.execute('ATTACH DATABASE ? AS src', [filename])
+
+        counts = {}
+        try:
+            cur.execute('BEGIN IMMEDIATE')
+            main_tables = get_tables(cur, 'main')
+            src_tables = get_tables(cur, 'src')
+
+            """ Atomic structures and their keys, species etc."""
+            self._create_id_map(
+                cur, 'system_ids', self.get_last_id(cur, table='systems'),
+                """SELECT s.id FROM src.systems AS s WHERE s.unique_id
+                NOT IN (SELECT unique_id FROM main.systems) ORDER BY s.id""")
+            columns = get_common_columns(cur, 'systems', exclude=['id'])
+            cur.execute(
+                """INSERT INTO main.systems (id, {0})
+                SELECT m.new_id, {1} FROM src.systems AS s
+                JOIN temp.system_ids AS m ON s.id = m.old_id
+                ORDER BY m.new_id""".format(
+                    ', '.join(columns),
+                    ', '.join('s.' + column for column in columns)))
+            counts['systems'] = cur.rowcount
+
+            for table in ['species', 'keys', 'text_key_values',
+                          'number_key_values']:
+                if table not in main_tables or table not in src_tables:
+                    continue
+                columns = get_common_columns(cur, table, exclude=['id'])
+                cur.execute(
+                    """INSERT INTO main.{0} ({1}, id)
+                    SELECT {2}, m.new_id FROM src.{0} AS t
+                    JOIN temp.system_ids AS m ON t.id = m.old_id""".format(
+                        table, ', '.join(columns),
+                        ', '.join('t.' + column for column in columns)))
+
+            """ Publications """
+            columns = get_common_columns(cur, 'publication', exclude=['id'])
+            cur.execute(
+                """INSERT OR IGNORE INTO main.publication ({0})
+                SELECT {0} FROM src.publication ORDER BY id""".format(
+                    ', '.join(columns)))
+            counts['publication'] = cur.rowcount
+            cur.execute(
+                """INSERT OR IGNORE INTO main.publication_system
+                (ase_id, pub_id)
+                SELECT ase_id, pub_id FROM src.publication_system""")
+            counts['publication_system'] = cur.rowcount
+
+            """ Reactions """
+            self._create_id_map(
+                cur, 'reaction_ids', self.get_last_id(cur),
+                """SELECT r.id FROM src.reaction AS r WHERE NOT EXISTS
+                (SELECT m.id FROM main.reaction AS m WHERE
+                m.chemical_composition IS r.chemical_composition
+                AND m.pub_id IS r.pub_id AND m.facet IS r.facet
+                AND m.reactants IS r.reactants AND m.products IS r.products
+                AND m.reaction_energy IS r.reaction_energy)
+                ORDER BY r.id""")
+            columns = get_common_columns(cur, 'reaction', exclude=['id'])
+            cur.execute(
+                """INSERT INTO main.reaction (id, {0})
+                SELECT m.new_id, {1} FROM src.reaction AS r
+                JOIN temp.reaction_ids AS m ON r.id = m.old_id
+                ORDER BY m.new_id""".format(
+                    ', '.join(columns),
+                    ', '.join('r.' + column for column in columns)))
+            counts['reaction'] = cur.rowcount
+
+            cur.execute(
+                """INSERT INTO main.reaction_system
+                (name, energy_correction, ase_id, id)
+                SELECT rs.name, rs.energy_correction, rs.ase_id, m.new_id
+                FROM src.reaction_system AS rs
+                JOIN temp.reaction_ids AS m ON rs.id = m.old_id""")
+            counts['reaction_system'] = cur.rowcount
+
+            if self.species and 'reaction_species' in src_tables:
+                cur.execute(
+                    """INSERT INTO main.reaction_species
+                    (reaction_id, species, state, prefactor, side)
+                    SELECT m.new_id, rs.species, rs.state, rs.prefactor,
+                    rs.side FROM src.reaction_species AS rs
+                    JOIN temp.reaction_ids AS m ON rs.reaction_id = m.old_id
+                    """)
+            elif self.species:
+                cur.execute(
+                    """SELECT m.new_id, r.reactants, r.products
+                    FROM src.reaction AS r
+                    JOIN temp.reaction_ids AS m ON r.id = m.old_id""")
+                species_values = []
+                for id, reactants, products in cur.fetchall():
+                    species_values += [
+                        [id] + species_row for species_row in
+                        get_species_values(json.loads(reactants),
+                                           json.loads(products))]
+                cur.executemany(
+                    'INSERT INTO reaction_species VALUES (?, ?, ?, ?, ?)',
+                    species_values)
+
+            cur.execute('DROP TABLE temp.system_ids')
+            cur.execute('DROP TABLE temp.reaction_ids')
+            con.commit()
+        except BaseException:
+            con.rollback()
+            raise
+        finally:
+            cur.execute('DETACH DATABASE src')
+            if self.connection is None:
+                con.close()
 
-        reaction_structure_values = []
-        for name, ase_id in ase_ids.items():
-            reaction_structure_values.append([name,
-                                              energy_corrections.get(name),
-                                              ase_id, id])
-            insert_statement = """INSERT OR IGNORE INTO
-            publication_system(ase_id, pub_id) VALUES (?, ?)"""
-            cur.execute(insert_statement, [ase_id, pub_id])
+        return counts
 
-        cur.executemany('INSERT INTO reaction_system VALUES (?, ?, ?, ?)',
-                        reaction_structure_values)
-
-        if self.connection is None:
-            con.commit()
-            con.close()
-        return id
+    def _create_id_map(self, cur, name, last_id, select_statement):
+        """
+        Create temporary table name with columns (new_id, old_id), where
+        old_id are the ids selected by select_statement and new_id count
+        up from last_id + 1 in the same order.
+        """
+        cur.execute('DROP TABLE IF EXISTS temp.{}'.format(name))
+        cur.execute("""CREATE TEMP TABLE {}
+        (new_id INTEGER PRIMARY KEY, old_id INTEGER)""".format(name))
+        # The next rowid is one more than the largest one
+        cur.execute('INSERT INTO temp.{} VALUES (?, NULL)'.format(name),
+                    [last_id])
+        cur.execute('INSERT INTO temp.{} (old_id) {}'.format(
+            name, select_statement))
+        cur.execute('DELETE FROM temp.{} WHERE old_id IS NULL'.format(name))
 
     def get_last_id(self, cur, table='reaction'):
         """
@@ -414,20 +978,94 @@ class CathubSQLite:
         con = self.connection or self._connect()
         self._initialize(con)
         cur = con.cursor()
-        statement = """SELECT reaction.id FROM reaction WHERE
-        reaction.chemical_composition='{}' and reaction.reactants='{}'
-        and reaction.products='{}';""".format(chemical_composition,
-                                              json.dumps(reactants),
-                                              json.dumps(products))
 
-        cur.execute(statement)
-        rows = cur.fetchall()
-        if len(rows) > 0:
-            id = rows[0][0]
+        if self.species:
+            species = sorted(get_species_values(reactants, products))
+            cur.execute("""SELECT reaction_species.reaction_id,
+            reaction_species.species, reaction_species.state,
+            reaction_species.prefactor, reaction_species.side
+            FROM reaction_species WHERE reaction_species.reaction_id IN
+            (SELECT reaction.id FROM reaction WHERE
+            reaction.chemical_composition=?)
+            ORDER BY reaction_species.reaction_id""", [chemical_composition])
+            candidates = {}
+            for row in cur.fetchall():
+                candidates.setdefault(row[0], []).append(list(row[1:]))
+            ids = [id for id in sorted(candidates)
+                   if sorted(candidates[id]) == species]
+        else:
+            cur.execute("""SELECT reaction.id, reaction.reactants,
+            reaction.products FROM reaction WHERE
+            reaction.chemical_composition=? ORDER BY reaction.id""",
+                        [chemical_composition])
+            ids = [row[0] for row in cur.fetchall()
+                   if json.loads(row[1]) == reactants
+                   and json.loads(row[2]) == products]
+
+        if self.connection is None:
+            con.close()
+
+        if len(ids) > 0:
+            id = ids[0]
         else:
             id = None
         return id
 
+    def get_species_reaction_ids(self, species, state=None, side=None,
+                                 where=None, params=[]):
+        """
+        Get the ids of reactions with a given species among the reactants
+        and/or products, using the indexed reaction_species table.
+        All reactions producing O* on Pt:
+
+            db.get_species_reaction_ids(
+                'O', state='star', side='products',
+                where='reaction.surface_composition=?', params=['Pt'])
+
+        Parameters
+        ----------
+        species: str
+            chemical formula of species without state, f.ex. 'O' or 'CO2'.
+            Use '' for the empty slab.
+        state: str
+            'star', 'gas' or None for any state
+        side: str
+            'reactants', 'products' or None for any side
+        where: str
+            Additional SQL condition on the reaction table
+        params: list
+            values for the ? placeholders in where
+
+        Returns: sorted list of ids
+        """
+        con = self.connection or self._connect()
+        self._initialize(con)
+        assert self.species, \
+            'No reaction_species table. Run "cathub db-migrate {}"'.format(
+                self.filename)
+        cur = con.cursor()
+
+        conditions = ['reaction_species.species=?']
+        arguments = [species]
+        for column, value in [('state', state), ('side', side)]:
+            if value is not None:
+                conditions.append('reaction_species.{}=?'.format(column))
+                arguments.append(value)
+        statement = """SELECT DISTINCT reaction_species.reaction_id
+        FROM reaction_species WHERE {}""".format(' AND '.join(conditions))
+        if where:
+            statement = """SELECT reaction.id FROM reaction WHERE
+            reaction.id IN ({}) AND ({})""".format(statement, where)
+            arguments += list(params)
+
+        cur.execute(statement, arguments)
+        ids = sorted(row[0] for row in cur.fetchall())
+
+        if self.connection is None:
+            con.close()
+
+        return ids
+
     def check_publication(self, pub_id):
         con = self.connection or self._connect()
         self._initialize(con)
@@ -461,31 +1099,209 @@ class CathubSQLite:
             id = None
         return id
 
+    def get_checkpoints(self, server, phase=None):
+        """
+        Blocks transferred to a postgreSQL server, recorded with
+        write_checkpoint().
+
+        Parameters
+        ----------
+        server: str
+            f.ex. 'upload@catalysishub.org/catalysishub'
+        phase: str
+            'systems', 'publication' or 'reaction'. All phases if None.
+
+        Returns: list of (phase, source_start, source_end, target_start,
+            target_end, completed) tuples
+        """
+        con = self.connection or self._connect()
+        for statement in checkpoint_commands:
+            con.execute(statement)
+        statement = """SELECT phase, source_start, source_end, target_start,
+        target_end, completed FROM transfer_checkpoint WHERE server=?"""
+        arguments = [server]
+        if phase is not None:
+            statement += ' AND phase=?'
+            arguments.append(phase)
+        rows = con.execute(statement + ' ORDER BY phase, source_start',
+                           arguments).fetchall()
+        if self.connection is None:
+            con.commit()
+            con.close()
+        return [tuple(row[:5]) + (bool(row[5]), ) for row in rows]
+
+    def write_checkpoint(self, server, phase, source_start, source_end,
+                         target_start=None, target_end=None,
+                         completed=False):
+        """
+        Record a block of source ids written to the server. A block is
+        first recorded as pending, with the ids allocated on the server,
+        and marked as completed once the server transaction is committed.
+        """
+        con = self.connection or self._connect()
+        for statement in checkpoint_commands:
+            con.execute(statement)
+        con.execute("""INSERT OR REPLACE INTO transfer_checkpoint
+        VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                    [server, phase, source_start, source_end, target_start,
+                     target_end, int(completed)])
+        if self.connection is None:
+            con.commit()
+            con.close()
+
+    def delete_checkpoints(self, server, phase=None, source_start=None):
+        """Delete recorded blocks for server"""
+        con = self.connection or self._connect()
+        for statement in checkpoint_commands:
+            con.execute(statement)
+        statement = 'DELETE FROM transfer_checkpoint WHERE server=?'
+        arguments = [server]
+        if phase is not None:
+            statement += ' AND phase=?'
+            arguments.append(phase)
+        if source_start is not None:
+            statement += ' AND source_start=?'
+            arguments.append(source_start)
+        con.execute(statement, arguments)
+        if self.connection is None:
+            con.commit()
+            con.close()
+
+    def get_fingerprints(self):
+        """
+        Folder fingerprints recorded with write_fingerprints().
+
+        Returns: dict with folder as key and (fingerprint, reaction_id)
+            as value
+        """
+        con = self.connection or self._connect()
+        for statement in fingerprint_commands:
+            con.execute(statement)
+        rows = con.execute("""SELECT folder, fingerprint, reaction_id
+        FROM folder_fingerprint""").fetchall()
+        if self.connection is None:
+            con.commit()
+            con.close()
+        return {row[0]: (row[1], row[2]) for row in rows}
+
+    def write_fingerprints(self, fingerprints):
+        """
+        Record fingerprints of folders, with the id of the reaction read
+        from the folder, if any.
+
+        Parameters
+        ----------
+        fingerprints: list of (folder, fingerprint, reaction_id) tuples
+        """
+        con = self.connection or self._connect()
+        for statement in fingerprint_commands:
+            con.execute(statement)
+        con.executemany("""INSERT OR REPLACE INTO folder_fingerprint
+        VALUES (?, ?, ?)""", fingerprints)
+        if self.connection is None:
+            con.commit()
+            con.close()
+
+    def delete_fingerprints(self, folders):
+        """Delete fingerprints of folders"""
+        con = self.connection or self._connect()
+        for statement in fingerprint_commands:
+            con.execute(statement)
+        con.executemany('DELETE FROM folder_fingerprint WHERE folder=?',
+                        [[folder] for folder in folders])
+        if self.connection is None:
+            con.commit()
+            con.close()
+
+    def delete_reactions(self, ids):
+        """
+        Delete reactions with their reaction_system and reaction_species
+        rows, and the atomic structures that are no longer part of any
+        reaction.
+
+        Parameters
+        ----------
+        ids: list of int
+            reaction ids
+
+        Returns: number of deleted reactions and atomic structures
+        """
+        if len(ids) == 0:
+            return 0, 0
+        con = self.connection or self._connect()
+        self._initialize(con)
+        cur = con.cursor()
+        n_reactions = 0
+        systems = []
+        for batch in get_batches(ids, 500):
+            params = ', '.join('?' * len(batch))
+            cur.execute('SELECT DISTINCT ase_id FROM reaction_system '
+                        'WHERE id IN ({})'.format(params), batch)
+            ase_ids = [row[0] for row in cur.fetchall()]
+            cur.execute('DELETE FROM reaction_system WHERE id IN ({})'
+                        .format(params), batch)
+            if self.species:
+                cur.execute('DELETE FROM reaction_species WHERE '
+                            'reaction_id IN ({})'.format(params), batch)
+            cur.execute('DELETE FROM reaction WHERE id IN ({})'
+                        .format(params), batch)
+            n_reactions += cur.rowcount
+
+            for ase_batch in get_batches(ase_ids, 500):
+                ase_params = ', '.join('?' * len(ase_batch))
+                cur.execute(
+                    """SELECT id, unique_id FROM systems
+                    WHERE unique_id IN ({}) AND unique_id NOT IN
+                    (SELECT ase_id FROM reaction_system)"""
+                    .format(ase_params), ase_batch)
+                systems += cur.fetchall()
+
+        for batch in get_batches(systems, 500):
+            system_ids, unique_ids = zip(*batch)
+            cur.execute('DELETE FROM publication_system WHERE ase_id IN ({})'
+                        .format(', '.join('?' * len(batch))), unique_ids)
+            SQLite3Database()._delete(cur, system_ids)
+
+        if self.connection is None:
+            con.commit()
+            con.close()
+        return n_reactions, len(systems)
+
     def print_summary(self):
         self.stdout.write('------------------------------------------------\n')
         self.stdout.write('Reaction Summary: \n')
         self.stdout.write('------------------------------------------------\n')
 
-        con = self.connection or self._connect()
-        self._initialize(con)
-        cur = con.cursor()
-        cur.execute("""
-        SELECT
-        surface_composition, facet, reactants, products, reaction_energy,
-        activation_energy, sites
-        FROM
-        reaction;""")
-        rows = cur.fetchall()
         table = []
-        for row in rows:
-            equation = get_equation(json.loads(row[2]), json.loads(row[3]))
-            table += [[row[0], row[1], equation, row[4], row[5], row[6]]]
+        for row, reaction_systems in self.iter_reactions():
+            equation = get_equation(json.loads(row[6]), json.loads(row[7]))
+            table += [[row[2], row[3], equation, row[8], row[9], row[4]]]
 
         headers = ['Surface Composition', 'Facet', 'Equation', 'Reaction Energy',
                    'Activation Energy', 'Sites']
         self.stdout.write(tabulate(table, headers) + '\n')
 
 
+class SessionSQLite3Database(SQLite3Database):
+    """ASE SQLite3Database over an open connection, which is not committed
+    or closed by ASE"""
+
+    def __init__(self, filename, connection):
+        SQLite3Database.__init__(self, filename)
+        self.connection = connection
+        self.change_count = 0
+
+    def _connect(self):
+        return self.connection
+
+    @contextmanager
+    def managed_connection(self, commit_frequency=None):
+        # newer ASE versions commit every commit_frequency writes, which
+        # would split the transaction of the session
+        self._initialize(self.connection)
+        yield self.connection
+
+
 def check_ase_ids(values, ase_ids):
     ase_values = ase_ids.values()
     assert len(set(ase_values)) == len(ase_values), 'Duplicate ASE ids!'
@@ -502,6 +1318,89 @@ def check_ase_ids(values, ase_ids):
     return
 
 
+def get_reaction_values(values):
+    """
+    Get the row for the reaction table and the rows for the reaction_system
+    table (without reaction id) from a values dict. See CathubSQLite.write()
+    """
+    ase_ids = values['ase_ids']
+    energy_corrections = values['energy_corrections']
+
+    if ase_ids is not None:
+        check_ase_ids(values, ase_ids)
+    else:
+        ase_ids = {}
+    reaction_values = (values['chemical_composition'],
+                       values['surface_composition'],
+                       values['facet'],
+                       json.dumps(values['sites']),
+                       json.dumps(values['coverages']),
+                       json.dumps(values['reactants']),
+                       json.dumps(values['products']),
+                       values['reaction_energy'],
+                       values['activation_energy'],
+                       values['dft_code'],
+                       values['dft_functional'],
+                       values['username'],
+                       values['pub_id']
+                       )
+
+    reaction_structure_values = []
+    for name, ase_id in ase_ids.items():
+        if name in energy_corrections:
+            energy_correction = energy_corrections[name]
+        else:
+            energy_correction = 0
+        reaction_structure_values.append([name, energy_correction, ase_id])
+
+    return reaction_values, reaction_structure_values
+
+
+def get_species_values(reactants, products):
+    """
+    Get the rows for the reaction_species table (without reaction id) from
+    the reactants and products dicts of a reaction. The state of the
+    species is 'star' or 'gas', f.ex. 'Ostar' gives ['O', 'star', ...]
+    and 'star' (the empty slab) gives ['', 'star', ...]
+
+    Returns: list of [species, state, prefactor, side]
+    """
+    species_values = []
+    for side, column in [('reactants', reactants), ('products', products)]:
+        for name in sorted(column or {}):
+            species_values.append([clear_state(name), get_state(name),
+                                   column[name], side])
+    return species_values
+
+
+def get_tables(cur, schema='main'):
+    """Get names of tables in (attached) database schema"""
+    cur.execute("SELECT name FROM {}.sqlite_master WHERE type='table'"
+                .format(schema))
+    return set(row[0] for row in cur.fetchall())
+
+
+def get_common_columns(cur, table, exclude=[]):
+    """Get columns of table that are in both the main and the attached src
+    database, in the order of the main database"""
+    columns = []
+    for schema in ['main', 'src']:
+        cur.execute('PRAGMA {}.table_info({})'.format(schema, table))
+        columns.append([row[1] for row in cur.fetchall()])
+    return [column for column in columns[0]
+            if column in columns[1] and column not in exclude]
+
+
+def get_batches(iterable, batch_size):
+    """Split an iterable into lists of length batch_size"""
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
 def get_key_value_list(key_list, values, table='reaction'):
     total_keys = {'reaction': ['chemical_composition', 'surface_composition',
                                'facet', 'sites', 'coverages', 'reactants',
@@ -526,23 +1425,17 @@ def get_key_value_list(key_list, values, table='reaction'):
     return key_list, value_list
 
 
-def get_value_strlist(value_list):
-    value_strlist = []
+def get_value_params(value_list):
+    """Convert values to parameters for an UPDATE statement"""
+    params = []
     for v in value_list:
-        if PY2:  # python 2
-            if isinstance(v, unicode):
-                v = v.encode('ascii', 'ignore')
         if isinstance(v, dict):
             v = json.dumps(v)
-            value_strlist.append("'{}'".format(v))
-        elif isinstance(v, str):
-            value_strlist.append("'{}'".format(v))
-        elif v is None or v == '':
-            value_strlist.append("{}".format('NULL'))
-        else:
-            value_strlist.append("{}".format(v))
+        elif v == '':
+            v = None
+        params.append(v)
 
-    return value_strlist
+    return params
 
 
 def get_equation(reactants, products):
@@ -14,6 +14,7 @@ from . import psql_server_connect
 from . import folder2db as _folder2db
 from . import db2server as _db2server
 from . import organize as _organize
+from . import export as _export
 from . import folderreader
 from . import ase_tools
 from . import tools
@@ -35,6 +36,34 @@ def show_reactions(dbfile):
     db.print_summary()
 
 
+@cli.command('db-migrate')
+@click.argument('dbfile')
+def db_migrate(dbfile):
+    """Add missing tables, indexes and structure hashes to sqlite3 (.db)
+    file"""
+    db = CathubSQLite(dbfile)
+    created = db.migrate()
+    if created:
+        print('Created: {0}'.format(', '.join(created)))
+    else:
+        print('{0} is up to date'.format(dbfile))
+
+
+@cli.command()
+@click.argument('outfile')
+@click.argument('dbfiles', nargs=-1, required=True)
+def merge(outfile, dbfiles):
+    """Merge sqlite3 (.db) files into OUTFILE. Data already in OUTFILE
+    is skipped, such that an interrupted merge can be restarted."""
+    db = CathubSQLite(outfile)
+    for dbfile in dbfiles:
+        counts = db.merge(dbfile)
+        print('Merged {0}: {1}'.format(
+            dbfile, ', '.join('{0} {1}'.format(counts[table], table)
+                              for table in ['systems', 'publication',
+                                            'reaction', 'reaction_system'])))
+
+
 @cli.command()
 @click.argument('args',  default='', type=str)
 @click.option('--dbuser', default='catvisitor', type=str)
@@ -85,8 +114,25 @@ def ase(dbuser, dbpassword, args, gui):
     help="""Bounds for accepted absolute reaction energies in eV""")
 @click.option('--goto-reaction',
               help="""name of reaction folder to skip ahead to""")
+@click.option('--jobs',
+              default=1,
+              type=int,
+              show_default=True,
+              help="""Number of processes to read structure files with""")
+@click.option('--cache/--no-cache',
+              default=False,
+              show_default=True,
+              help="""Keep structures read from files in FOLDER_NAME/.cache.db
+              and only read new or changed files""")
+@click.option('--incremental',
+              is_flag=True,
+              default=False,
+              show_default=True,
+              help="""Only read metal, facet and reaction folders that changed
+              since the last incremental run, and delete reactions of
+              removed folders""")
 def folder2db(folder_name, userhandle, debug, energy_limit, skip_folders,
-              goto_reaction):
+              goto_reaction, jobs, cache, incremental):
     """Read folder and collect data in local sqlite3 database"""
 
     folder_name = folder_name.rstrip('/')
@@ -95,7 +141,8 @@ def folder2db(folder_name, userhandle, debug, energy_limit, skip_folders,
         for sk in s.split(','):
             skip.append(sk)
     pub_id = _folder2db.main(folder_name, debug, energy_limit,
-                             skip, userhandle, goto_reaction)
+                             skip, userhandle, goto_reaction, jobs, cache,
+                             incremental)
     if pub_id:
         print('')
         print('')
@@ -112,7 +159,16 @@ def folder2db(folder_name, userhandle, debug, energy_limit, skip_folders,
               show_default=True)
 @click.option('--dbuser', default='upload', type=str)
 @click.option('--dbpassword', default='cHyuuQH0', type=str)
-def db2server(dbfile, block_size, dbuser, dbpassword):
+@click.option('--resume', is_flag=True,
+              help="Continue an interrupted transfer, skipping the blocks "
+              "recorded as completed in DBFILE")
+@click.option('--workers', default=1, type=int,
+              help="Number of connections to upload blocks in parallel",
+              show_default=True)
+@click.option('--plan', is_flag=True,
+              help="Only report the size of DBFILE, the atomic structures "
+              "already on the server and a projected transfer time")
+def db2server(dbfile, block_size, dbuser, dbpassword, resume, workers, plan):
     """Transfer data from local database to Catalysis Hub server"""
 
     _db2server.main(dbfile,
@@ -123,7 +179,32 @@ def db2server(dbfile, block_size, dbuser, dbpassword):
                     block_size=block_size,
                     start_block=0,
                     user=dbuser,
-                    password=dbpassword)
+                    password=dbpassword,
+                    resume=resume,
+                    workers=workers,
+                    plan=plan)
+
+
+@cli.command()
+@click.argument('source')
+@click.argument('filename')
+@click.option('--format', 'file_format', default='parquet',
+              type=click.Choice(_export.export_formats), show_default=True,
+              help="parquet, or arrow for the memory-mappable arrow IPC "
+              "(feather) format")
+@click.option('--batch-size', default=10000, type=int,
+              help="Number of reactions to read and write per batch",
+              show_default=True)
+@click.option('--dbuser', default='catvisitor', type=str)
+@click.option('--dbpassword', default='eFjohbnD57WLYAJX', type=str)
+def export(source, filename, file_format, batch_size, dbuser, dbpassword):
+    """Export reactions to a columnar file. SOURCE is a sqlite3 (.db) file,
+    or 'server' for the Catalysis Hub server"""
+    _export.main(source, filename,
+                 file_format=file_format,
+                 batch_size=batch_size,
+                 user=dbuser,
+                 password=dbpassword)
 
 
 reaction_columns = [
@@ -533,7 +614,8 @@ def connect(user):
     show_default=True,
     help="When set the script will cache"
     " structures between runs in a file named"
-    " <FOLDER_NAME>.cache.pckl")
+    " <FOLDER_NAME>.cache.db, and only read"
+    " new or changed files again")
 @click.option(
     '-v', '--verbose',
     is_flag=True,
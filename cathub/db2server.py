@@ -7,19 +7,27 @@ def main(dbfile, write_reaction=True, write_ase=True,
          block_size=1000, start_block=0,
          user='catroot',
          password=None,
-         userhandle=None
+         userhandle=None,
+         resume=False,
+         workers=1,
+         plan=False
          ):
 
     stdout.write('Starting db2server\n')
 
     db = CathubPostgreSQL(user=user, password=password)
     stdout.write('Established SQL Server connection.\n')
+    if plan:
+        db.plan(dbfile, block_size=block_size)
+        return
     db.transfer(dbfile, write_reaction=write_reaction,
                 write_ase=write_ase,
                 write_publication=write_publication,
                 write_reaction_system=write_reaction_system,
                 block_size=block_size,
-                start_block=start_block)
+                start_block=start_block,
+                resume=resume,
+                workers=workers)
 
 
 if __name__ == '__main__':
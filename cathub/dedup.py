@@ -0,0 +1,101 @@
+import json
+import ase.db
+
+from .ase_tools import get_chemical_formula
+
+
+class DuplicateIndex:
+    """
+    In-memory hash index of the atomic structures and reactions in a
+    CathubSQLite database file, for duplicate checks in constant time while
+    reading folders. The index is loaded once from the db file and should be
+    updated with add_atoms() and add_reaction() as new rows are written.
+
+    Atomic structures are keyed on (formula, energy) and reactions on
+    (chemical_composition, reactants, products, reaction_energy), with
+    energies rounded to a fixed number of decimals.
+
+    Parameters
+    ----------
+    decimals: int
+        number of decimals that energies are rounded to
+    """
+
+    def __init__(self, decimals=8):
+        self.decimals = decimals
+        self.atoms = {}
+        self.reactions = {}
+
+    def load(self, db):
+        """
+        Fill index with structures and reactions in db file
+
+        Parameters
+        ----------
+        db: CathubSQLite object
+        """
+        self.atoms = {}
+        self.reactions = {}
+
+        db_ase = ase.db.connect(db.filename)
+        for row in db_ase.select(include_data=False):
+            if row.get('energy') is None:
+                continue
+            key = self.get_atoms_key(row.formula, row.energy)
+            self.atoms.setdefault(key, (row.id, row.unique_id))
+
+        for row, reaction_systems in db.iter_reactions():
+            key = self.get_reaction_key(row[1], json.loads(row[6]),
+                                        json.loads(row[7]), row[8])
+            self.reactions.setdefault(key, row[0])
+
+    def get_atoms_key(self, formula, energy):
+        return (formula, round(energy, self.decimals))
+
+    def get_reaction_key(self, chemical_composition, reactants, products,
+                         reaction_energy):
+        if reaction_energy is not None:
+            reaction_energy = round(reaction_energy, self.decimals)
+        return (chemical_composition,
+                json.dumps(reactants, sort_keys=True),
+                json.dumps(products, sort_keys=True),
+                reaction_energy)
+
+    def check_atoms(self, atoms, energy=None):
+        """
+        Check if atomic structure is already in db file
+
+        Returns (id, unique_id) or (None, None)
+        """
+        if energy is None:
+            energy = atoms.get_potential_energy()
+        key = self.get_atoms_key(get_chemical_formula(atoms), energy)
+        return self.atoms.get(key, (None, None))
+
+    def add_atoms(self, atoms, id, unique_id, energy=None):
+        if energy is None:
+            energy = atoms.get_potential_energy()
+        key = self.get_atoms_key(get_chemical_formula(atoms), energy)
+        self.atoms.setdefault(key, (id, unique_id))
+
+    def check_reaction(self, values):
+        """
+        Check if reaction is already in db file
+
+        Parameters
+        ----------
+        values: dict
+            See CathubSQLite.write() method for details
+
+        Returns id or None
+        """
+        key = self.get_reaction_key(values['chemical_composition'],
+                                    values['reactants'], values['products'],
+                                    values['reaction_energy'])
+        return self.reactions.get(key)
+
+    def add_reaction(self, values, id):
+        key = self.get_reaction_key(values['chemical_composition'],
+                                    values['reactants'], values['products'],
+                                    values['reaction_energy'])
+        self.reactions.setdefault(key, id)
@@ -0,0 +1,158 @@
+import sys
+import json
+import six
+from collections import OrderedDict
+
+from .cathubsqlite import CathubSQLite, get_equation
+from .postgresql import CathubPostgreSQL, load_json
+
+export_formats = ['parquet', 'arrow']
+
+reaction_columns = ['id', 'chemical_composition', 'surface_composition',
+                    'facet', 'sites', 'coverages', 'equation',
+                    'reaction_energy', 'activation_energy', 'dft_code',
+                    'dft_functional', 'username', 'pub_id']
+
+
+def get_schema(species_names):
+    """
+    Arrow schema for the reaction table. Reactants and products are
+    flattened into one float64 column of prefactors per species,
+    f.ex. 'reactant_O2gas' and 'product_Ostar', which are null for reactions
+    without the species. Sites and coverages are stored as json text.
+    """
+    import pyarrow as pa
+
+    fields = []
+    for column in reaction_columns:
+        if column == 'id':
+            fields.append(pa.field(column, pa.int64()))
+        elif column in ['reaction_energy', 'activation_energy']:
+            fields.append(pa.field(column, pa.float64()))
+        else:
+            fields.append(pa.field(column, pa.string()))
+    for prefix, side in [('reactant_', 'reactants'), ('product_', 'products')]:
+        for name in species_names[side]:
+            fields.append(pa.field(prefix + name, pa.float64()))
+    return pa.schema(fields)
+
+
+def get_record_batch(rows, schema, species_names):
+    """Convert reaction rows of sqlite3 or postgreSQL db to arrow columns"""
+    import pyarrow as pa
+
+    columns = {column: [] for column in schema.names}
+    for row in rows:
+        # same order of species for sqlite3 and postgreSQL
+        reactants = OrderedDict(sorted((load_json(row[6]) or {}).items()))
+        products = OrderedDict(sorted((load_json(row[7]) or {}).items()))
+        values = {'id': row[0],
+                  'chemical_composition': row[1],
+                  'surface_composition': row[2],
+                  'facet': row[3],
+                  'sites': dump_json(row[4]),
+                  'coverages': dump_json(row[5]),
+                  'equation': get_equation(reactants, products),
+                  'reaction_energy': get_float(row[8]),
+                  'activation_energy': get_float(row[9]),
+                  'dft_code': row[10],
+                  'dft_functional': row[11],
+                  'username': row[12],
+                  'pub_id': row[13]}
+        for column in reaction_columns:
+            columns[column].append(values[column])
+        for prefix, side, column_values in [('reactant_', 'reactants',
+                                             reactants),
+                                            ('product_', 'products',
+                                             products)]:
+            for name in species_names[side]:
+                columns[prefix + name].append(
+                    get_float(column_values.get(name)))
+
+    arrays = [pa.array(columns[field.name], type=field.type)
+              for field in schema]
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+def get_float(value):
+    if value is None:
+        return None
+    return float(value)
+
+
+def dump_json(value):
+    """Sites and coverages are json text in sqlite3 and jsonb in postgreSQL"""
+    if value is None or isinstance(value, six.string_types):
+        return value
+    return json.dumps(value)
+
+
+def export_reactions(db, filename, file_format='parquet', batch_size=10000,
+                     stdout=sys.stdout):
+    """
+    Export the reaction table to a columnar parquet or arrow file. Reactions
+    are streamed from the database and written batch_size rows at the time.
+
+    Parameters
+    ----------
+    db: CathubSQLite or CathubPostgreSQL object
+    filename: str
+        name of output file
+    file_format: str
+        'parquet', or 'arrow' for the arrow IPC (feather) format, which can
+        be memory-mapped
+    batch_size: int
+        number of reactions per record batch (parquet row group)
+
+    Returns: number of exported reactions
+    """
+    assert file_format in export_formats, \
+        'file_format should be one of {}'.format(', '.join(export_formats))
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ImportError('Export requires pyarrow: pip install pyarrow')
+
+    species_names = db.get_species_names()
+    schema = get_schema(species_names)
+
+    if file_format == 'parquet':
+        writer = pq.ParquetWriter(filename, schema)
+
+        def write_batch(batch):
+            writer.write_table(pa.Table.from_batches([batch]))
+    else:
+        writer = pa.RecordBatchFileWriter(filename, schema)
+        write_batch = writer.write_batch
+
+    n_rows = 0
+    rows = []
+    try:
+        for row, reaction_systems in db.iter_reactions(batch_size=batch_size):
+            rows.append(row)
+            if len(rows) == batch_size:
+                write_batch(get_record_batch(rows, schema, species_names))
+                n_rows += len(rows)
+                rows = []
+                stdout.write('  Exported {} reactions\n'.format(n_rows))
+        if rows:
+            write_batch(get_record_batch(rows, schema, species_names))
+            n_rows += len(rows)
+    finally:
+        writer.close()
+
+    stdout.write('Exported {} reactions to {}\n'.format(n_rows, filename))
+    return n_rows
+
+
+def main(source, filename, file_format='parquet', batch_size=10000,
+         user='catvisitor', password=None, stdout=sys.stdout):
+    """Export reactions from a sqlite3 .db file, or from the postgreSQL
+    server if source is 'server'"""
+    if source == 'server':
+        db = CathubPostgreSQL(user=user, password=password, stdout=stdout)
+    else:
+        db = CathubSQLite(source, stdout=stdout)
+    return export_reactions(db, filename, file_format=file_format,
+                            batch_size=batch_size, stdout=stdout)
@@ -4,11 +4,14 @@ from .folderreader import FolderReader
 
 
 def main(folder_name, debug=False, energy_limit=5, skip=[], userhandle=None,
-         goto_reaction=None):
+         goto_reaction=None, jobs=1, use_cache=False, incremental=False):
     folder_name = folder_name.rstrip('/')
     FR = FolderReader(folder_name=folder_name, debug=debug,
                       energy_limit=energy_limit,
-                      userhandle=userhandle)
+                      userhandle=userhandle,
+                      jobs=jobs,
+                      use_cache=use_cache,
+                      incremental=incremental)
     FR.write(skip=skip, goto_reaction=goto_reaction)
     return FR.pub_id
 
@@ -1,13 +1,17 @@
 from .cathubsqlite import CathubSQLite
+from .dedup import DuplicateIndex
+from .parsecache import ParseCache
 from .tools import get_bases, clear_prefactor, clear_state, get_pub_id, extract_atoms
 from .ase_tools import collect_structures
 from . import ase_tools
 
 import sys
+import multiprocessing
 from datetime import date
 import numpy as np
 import os
 import copy
+import hashlib
 import json
 import yaml
 
@@ -39,16 +43,40 @@ class FolderReader:
         Update data if allready present in database file. defalt is True
     energy_limit: float
         Limit for acceptable absolute reaction energies
+    jobs: int
+        Number of processes to read structure files with before the
+        folders are processed. Default is 1, reading each folder when
+        it is processed.
+    use_cache: bool
+        Keep structures read from files in the .cache.db file of the
+        folder, and only read new or changed files. Default is False.
+    incremental: bool
+        Record fingerprints of the files in each folder in the .db file,
+        and skip metal, facet and reaction folders that are unchanged
+        since the last incremental run. Reactions of folders that were
+        removed are deleted. Default is False.
     """
 
     def __init__(self, folder_name, debug=False, strict=True, verbose=False,
                  update=True, energy_limit=5, stdin=sys.stdin,
-                 stdout=sys.stdout, userhandle=None):
+                 stdout=sys.stdout, userhandle=None, jobs=1,
+                 use_cache=False, incremental=False):
         self.debug = debug
         self.strict = strict
         self.verbose = verbose
         self.update = update
         self.energy_limit = energy_limit
+        self.jobs = jobs
+        self.use_cache = use_cache
+        self.parsed_structures = None
+        self.cache = None
+        self.incremental = incremental
+        self.fingerprints = {}
+        self.own_fingerprints = {}
+        self.stored_fingerprints = {}
+        self.new_fingerprints = {}
+        self.current_folders = {}
+        self.incomplete_folders = set()
 
         self.data_base, self.user, self.user_base \
             = get_bases(folder_name=folder_name)
@@ -68,6 +96,10 @@ class FolderReader:
         self.stdout = stdout
 
         self.cathub_db = None
+        self.db = None
+        self.db_ase = None
+        self.reaction_updates = []
+        self.duplicates = DuplicateIndex()
         self.coverages = None
         self.omit_folders = []
         self.doi = None
@@ -102,6 +134,9 @@ class FolderReader:
         self.stdout.write('---------------------- \n')
         self.stdout.write('Starting folderreader! \n')
         self.stdout.write('---------------------- \n')
+        if self.use_cache:
+            self.cache = ParseCache(self.data_base + '.cache.db',
+                                    headers=True)
         found_reaction = False
         for root, dirs, files in os.walk(self.user_base):
             for omit_folder in self.omit_folders:  # user specified omit_folder
@@ -118,7 +153,8 @@ class FolderReader:
             if level == self.XC_level:
                 self.DFT_functional = os.path.basename(root)
                 self.gas_folder = root + '/gas/'
-                self.read_gas()
+                with self.db:
+                    self.read_gas()
 
             if level == self.reference_level:
                 if 'gas' in os.path.basename(root):
@@ -130,10 +166,16 @@ class FolderReader:
                     else:
                         dirs[:] = []  # don't read any sub_dirs
                         continue
-                self.read_bulk(root)
+                if self.skip_unchanged(root, dirs, level):
+                    continue
+                with self.db:
+                    self.read_bulk(root)
 
             if level == self.slab_level:
-                self.read_slab(root)
+                if self.skip_unchanged(root, dirs, level):
+                    continue
+                with self.db:
+                    self.read_slab(root)
 
             if level == self.reaction_level:
                 if goto_reaction is not None:
@@ -142,24 +184,183 @@ class FolderReader:
                     else:
                         dirs[:] = []  # don't read any sub_dirs
                         continue
+                if self.skip_unchanged(root, dirs, level):
+                    continue
 
                 self.read_reaction(root)
 
             if level == self.final_level:
                 self.root = root
-                self.read_energies(root)
-                if self.key_value_pairs_reaction is not None:
-                    yield self.key_value_pairs_reaction
+                # structures and reaction in one transaction per folder
+                with self.db:
+                    self.read_energies(root)
+                    if self.key_value_pairs_reaction is not None:
+                        yield self.key_value_pairs_reaction
+
+        if self.cache is not None:
+            self.cache.close()
+            self.cache = None
+
+    def parse_structures(self, pub_root):
+        """Read all structure files of the publication in pub_root in a
+        pool of self.jobs processes. The structures are picked up in walk
+        order by collect_structures."""
+        filenames = []
+        for root, dirs, files in os.walk(pub_root):
+            for omit_folder in self.omit_folders:
+                if omit_folder in dirs:
+                    dirs.remove(omit_folder)
+            level = len(root.split("/")) - self.user_base_level
+            if level < self.reference_level:  # no structure files
+                continue
+            if self.is_unchanged(root, level):
+                dirs[:] = []
+                continue
+            filenames += [os.path.normpath(os.path.join(root, filename))
+                          for filename in sorted(files)
+                          if not filename.endswith('publication.txt')
+                          and not filename.endswith('traj.old')]
+
+        self.parsed_structures = {}
+        if self.cache is not None:
+            missing = []
+            for filename in filenames:
+                found, structure = self.cache.get(filename)
+                if found:
+                    self.parsed_structures[filename] = structure
+                else:
+                    missing.append(filename)
+            filenames = missing
+
+        self.stdout.write('Reading {} files with {} processes\n'
+                          .format(len(filenames), self.jobs))
+        pool = multiprocessing.Pool(self.jobs)
+        try:
+            structures = pool.map(ase_tools.read_structure_header, filenames,
+                                  chunksize=max(1, len(filenames) //
+                                                (4 * self.jobs)))
+        finally:
+            pool.close()
+            pool.join()
+        for filename, structure in zip(filenames, structures):
+            self.parsed_structures[filename] = structure
+            if self.cache is not None:
+                self.cache.put(filename, structure)
+
+    def get_folder(self, root):
+        """Folder relative to the user folder, as recorded in the db file"""
+        return os.path.relpath(root, self.user_base)
+
+    def read_fingerprints(self):
+        """Fingerprints of the names, sizes and modification times of the
+        files in each folder below the user folder, with and without the
+        files in subfolders"""
+        db_filename = os.path.basename(self.cathub_db)
+        self.fingerprints = {}
+        self.own_fingerprints = {}
+        for root, dirs, files in os.walk(self.user_base, topdown=False):
+            entries = []
+            for filename in sorted(files):
+                if filename.startswith(db_filename) or \
+                   filename.startswith('.cache.db'):
+                    continue
+                stat = os.stat(os.path.join(root, filename))
+                entries.append('{} {} {}'.format(filename, stat.st_size,
+                                                 stat.st_mtime))
+            folder = self.get_folder(root)
+            own_fingerprint = get_hash(entries)
+            self.own_fingerprints[folder] = own_fingerprint
+            self.fingerprints[folder] = get_hash(
+                [own_fingerprint] +
+                ['{} {}'.format(dirname, self.fingerprints.get(
+                    self.get_folder(os.path.join(root, dirname))))
+                 for dirname in sorted(dirs)])
+
+    def get_fingerprint(self, root, level):
+        """Fingerprint of a metal, facet or reaction folder, which includes
+        the files in the folders above it and the gas phase references"""
+        folder = self.get_folder(root)
+        fingerprints = [self.fingerprints.get(folder)]
+        parent = os.path.dirname(folder)
+        while parent:
+            fingerprints.append(self.own_fingerprints.get(parent))
+            parent = os.path.dirname(parent)
+        fingerprints.append(self.own_fingerprints.get('.'))
+        xc_folder = root.rsplit('/', level - self.XC_level)[0]
+        fingerprints.append(self.fingerprints.get(
+            self.get_folder(xc_folder + '/gas')))
+        return get_hash([str(fingerprint) for fingerprint in fingerprints])
+
+    def is_unchanged(self, root, level):
+        """Whether folder is unchanged since the last incremental run"""
+        if not self.incremental:
+            return False
+        stored = self.stored_fingerprints.get(self.get_folder(root))
+        return stored is not None and \
+            stored[0] == self.get_fingerprint(root, level)
+
+    def skip_unchanged(self, root, dirs, level):
+        """Skip folder and its subfolders if unchanged, or else record the
+        new fingerprint. Returns True if skipped."""
+        if not self.incremental:
+            return False
+        if self.is_unchanged(root, level):
+            dirs[:] = []
+            self.stdout.write('Skipping unchanged folder {}\n'.format(root))
+            return True
+        folder = self.get_folder(root)
+        self.new_fingerprints[folder] = [self.get_fingerprint(root, level),
+                                         None]
+        self.current_folders = {
+            folder_level: current_folder for folder_level, current_folder
+            in self.current_folders.items() if folder_level < level}
+        self.current_folders[level] = folder
+        return False
+
+    def write_fingerprints(self):
+        """
+        Record fingerprints of the folders read without errors, and delete
+        the reactions of folders that were removed, or that no longer give
+        the same reaction.
+        """
+        if not self.incremental:
+            return
+        new = {folder: value for folder, value in
+               self.new_fingerprints.items()
+               if folder not in self.incomplete_folders}
+        removed = [folder for folder in self.stored_fingerprints
+                   if not os.path.isdir(os.path.join(self.user_base,
+                                                     folder))]
+        old_ids = set(self.stored_fingerprints[folder][1]
+                      for folder in removed + list(new)
+                      if folder in self.stored_fingerprints)
+        old_ids -= set(id for fingerprint, id in new.values())
+        old_ids -= set(id for folder, (fingerprint, id)
+                       in self.stored_fingerprints.items()
+                       if folder not in new and folder not in removed)
+        old_ids.discard(None)
+
+        with self.db as db:
+            n_reactions, n_systems = db.delete_reactions(sorted(old_ids))
+            db.delete_fingerprints(removed)
+            db.write_fingerprints([(folder, fingerprint, id) for
+                                   folder, (fingerprint, id)
+                                   in sorted(new.items())])
+        if n_reactions:
+            self.stdout.write(
+                'Deleted {} reactions and {} atomic structures of changed '
+                'or removed folders\n'.format(n_reactions, n_systems))
+        self.new_fingerprints = {}
+        self.incomplete_folders = set()
 
     def write(self, skip=[], goto_reaction=None):
         for key_values in self.read(skip=skip, goto_reaction=goto_reaction):
-            with CathubSQLite(self.cathub_db) as db:
-                id = db.check(
-                    key_values['chemical_composition'],
-                    key_values['reaction_energy'])
+            with self.db as db:
+                id = self.duplicates.check_reaction(key_values)
                 if id is None:
                     try:
                         id = db.write(key_values)
+                        self.duplicates.add_reaction(key_values, id)
                         self.stdout.write(
                             '  Written to reaction db row id = {}\n'.format(id))
                     except BaseException as e:
@@ -167,24 +368,40 @@ class FolderReader:
                             'Writing to db: {}. {}'.format(e, self.root))
 
                 elif self.update:
-                    db.update(id, key_values)
+                    # ase_ids etc. are shared with the next reactions
+                    self.reaction_updates.append(
+                        (id, copy.deepcopy(key_values)))
                     self.stdout.write(
                         '  Updated reaction db row id = {}\n'.format(id))
                 else:
                     self.stdout.write(
                         '  Already in reaction db with row id = {}\n'.format(id))
+                if self.incremental:
+                    self.new_fingerprints[self.get_folder(self.root)][1] = id
         assert self.cathub_db is not None, \
             'Wrong folder! No reactions found in {base}'\
             .format(base=self.user_base)
+        self.write_updates()
+        self.write_fingerprints()
         self.print_warnings()
         self.get_summary()
+        self.db.close()
+        self.db_ase = None
+
+    def write_updates(self):
+        """Write pending reaction updates to db file in one transaction"""
+        if self.reaction_updates:
+            ids, values_list = zip(*self.reaction_updates)
+            with self.db as db:
+                db.update_many(list(ids), list(values_list))
+            self.reaction_updates = []
 
     def get_summary(self):
-        with CathubSQLite(self.cathub_db) as db:
+        with self.db as db:
             db.print_summary()
 
     def write_publication(self, pub_data):
-        with CathubSQLite(self.cathub_db) as db:
+        with self.db as db:
             pid = db.check_publication(self.pub_id)
             if pid is None:
                 pid = db.write_publication(pub_data)
@@ -192,6 +409,22 @@ class FolderReader:
                     'Written to publications db row id = {}\n'.format(pid))
         return pid
 
+    def write_structure(self, atoms, key_value_pairs):
+        """Write atomic structure to ASE db, or update it if already
+        present. The full Atoms object is only read from file for new
+        structures. Returns unique_id"""
+        id, ase_id = self.duplicates.check_atoms(atoms)
+        if ase_id is None:
+            id, ase_id = ase_tools.write_ase(atoms.get_atoms(), self.db_ase,
+                                             self.stdout, self.user,
+                                             return_id=True,
+                                             **key_value_pairs)
+            self.duplicates.add_atoms(atoms, id, ase_id)
+        elif self.update:
+            ase_tools.update_ase(self.db_ase, id,
+                                 self.stdout, **key_value_pairs)
+        return ase_id
+
     def read_pub(self, root):
         pub_folder = os.path.basename(root)
         publication_keys = {}
@@ -270,13 +503,30 @@ class FolderReader:
 
         self.pub_id = get_pub_id(self.title, self.authors, self.year)
         self.cathub_db = '{}{}.db'.format(self.data_base, self.pub_id)
+        if self.db is not None:
+            self.write_updates()
+            self.write_fingerprints()
+            self.db.close()
+        self.db = CathubSQLite(self.cathub_db, session=True,
+                               stdout=self.stdout)
+        with self.db as db:
+            self.duplicates.load(db)
+            self.db_ase = db.get_ase_db()
+            if self.incremental:
+                self.stored_fingerprints = db.get_fingerprints()
+        if self.incremental:
+            self.read_fingerprints()
+        if self.jobs > 1:
+            self.parse_structures(root)
         self.stdout.write(
             'Writing to .db file {}:\n \n'.format(self.cathub_db))
         pub_data.update({'pub_id': self.pub_id})
         pid = self.write_publication(pub_data)
 
     def read_gas(self):
-        gas_structures = collect_structures(self.gas_folder)
+        gas_structures = collect_structures(
+            self.gas_folder, parsed_structures=self.parsed_structures,
+            cache=self.cache, headers=True)
         self.ase_ids_gas = {}
         self.gas = {}
 
@@ -294,17 +544,7 @@ class FolderReader:
                                'state': 'gas',
                                'epot': energy}
 
-            id, ase_id = ase_tools.check_in_ase(
-                gas, self.cathub_db)
-
-            if ase_id is None:
-                ase_id = ase_tools.write_ase(gas, self.cathub_db,
-                                             self.stdout,
-                                             self.user,
-                                             **key_value_pairs)
-            elif self.update:
-                ase_tools.update_ase(self.cathub_db, id,
-                                     self.stdout, **key_value_pairs)
+            ase_id = self.write_structure(gas, key_value_pairs)
 
             self.ase_ids_gas.update({chemical_composition: ase_id})
             self.gas.update({chemical_composition: gas})
@@ -327,7 +567,9 @@ class FolderReader:
 
         self.ase_ids = {}
 
-        bulk_structures = collect_structures(root)
+        bulk_structures = collect_structures(
+            root, parsed_structures=self.parsed_structures,
+            cache=self.cache, headers=True)
         n_bulk = len(bulk_structures)
         if n_bulk == 0:
             return
@@ -344,14 +586,7 @@ class FolderReader:
                            'state': 'bulk',
                            'epot': energy}
 
-        id, ase_id = ase_tools.check_in_ase(
-            bulk, self.cathub_db)
-        if ase_id is None:
-            ase_id = ase_tools.write_ase(bulk, self.cathub_db, self.stdout,
-                                         self.user, **key_value_pairs)
-        elif self.update:
-            ase_tools.update_ase(self.cathub_db, id,
-                                 self.stdout, **key_value_pairs)
+        ase_id = self.write_structure(bulk, key_value_pairs)
 
         self.ase_ids.update({'bulk' + self.crystal: ase_id})
 
@@ -359,7 +594,9 @@ class FolderReader:
         self.facet = root.split('/')[-1].split('_')[0]
         self.ase_facet = 'x'.join(list(self.facet))
 
-        empty_structures = collect_structures(root)
+        empty_structures = collect_structures(
+            root, parsed_structures=self.parsed_structures,
+            cache=self.cache, headers=True)
         n_empty = len(empty_structures)
 
         if n_empty == 0:
@@ -385,15 +622,7 @@ class FolderReader:
 
         key_value_pairs.update({'species': ''})
 
-        id, ase_id = ase_tools.check_in_ase(
-            self.empty, self.cathub_db)
-
-        if ase_id is None:
-            ase_id = ase_tools.write_ase(self.empty, self.cathub_db, self.stdout,
-                                         self.user, **key_value_pairs)
-        elif self.update:
-            ase_tools.update_ase(self.cathub_db, id,
-                                 self.stdout, **key_value_pairs)
+        ase_id = self.write_structure(self.empty, key_value_pairs)
         self.ase_ids.update({'star': ase_id})
 
     def read_reaction(self, root):
@@ -442,7 +671,9 @@ class FolderReader:
     def read_energies(self, root):
         self.key_value_pairs_reaction = None
 
-        slab_structures = collect_structures(root)
+        slab_structures = collect_structures(
+            root, parsed_structures=self.parsed_structures,
+            cache=self.cache, headers=True)
 
         if len(slab_structures) == 0:
             self.raise_warning('No structure files in {root}: Skipping this folder'
@@ -533,7 +764,6 @@ class FolderReader:
                 continue
 
             ase_id = None
-            id, ase_id = ase_tools.check_in_ase(slab, self.cathub_db)
             key_value_pairs.update({'epot': ase_tools.get_energies([slab])})
 
             if i == ts_i:  # transition state
@@ -541,14 +771,7 @@ class FolderReader:
                 self.prefactors.update({'TS': [1]})
                 prefactor_scale.update({'TS': [1]})
                 key_value_pairs.update({'species': 'TS'})
-                if ase_id is None:
-                    ase_id = ase_tools.write_ase(slab, self.cathub_db,
-                                                 self.stdout,
-                                                 self.user,
-                                                 **key_value_pairs)
-                elif self.update:
-                    ase_tools.update_ase(self.cathub_db, id, self.stdout,
-                                         **key_value_pairs)
+                ase_id = self.write_structure(slab, key_value_pairs)
                 self.ase_ids.update({'TSstar': ase_id})
                 continue
 
@@ -557,14 +780,7 @@ class FolderReader:
                 self.prefactors.update({'TSempty': [1]})
                 prefactor_scale.update({'TSempty': [1]})
                 key_value_pairs.update({'species': ''})
-                if ase_id is None:
-                    ase_id = ase_tools.write_ase(slab, self.cathub_db,
-                                                 self.stdout,
-                                                 self.user,
-                                                 **key_value_pairs)
-                elif self.update:
-                    ase_tools.update_ase(self.cathub_db, id, self.stdout,
-                                         **key_value_pairs)
+                ase_id = self.write_structure(slab, key_value_pairs)
                 self.ase_ids.update({'TSemptystar': ase_id})
                 continue
 
@@ -642,23 +858,13 @@ class FolderReader:
                 self.structures[key][n] = slab
                 species = clear_prefactor(
                     self.reaction[key][n])
-                id, ase_id = ase_tools.check_in_ase(
-                    slab, self.cathub_db)
                 key_value_pairs.update(
                     {'species':
                      clear_state(
                          species),
                      'n': n_ads,
                      'site': str(self.sites.get(species, ''))})
-                if ase_id is None:
-                    ase_id = ase_tools.write_ase(
-                        slab, self.cathub_db, self.stdout,
-                        self.user,
-                        **key_value_pairs)
-                elif self.update:
-                    ase_tools.update_ase(
-                        self.cathub_db, id, self.stdout,
-                        **key_value_pairs)
+                ase_id = self.write_structure(slab, key_value_pairs)
                 self.ase_ids.update({species: ase_id})
 
             if n_ads > 1:
@@ -754,6 +960,7 @@ class FolderReader:
             'username': self.user}
 
     def raise_error(self, message):
+        self.incomplete_folders.update(self.current_folders.values())
         if self.debug:
             self.stdout.write('--------------------------------------\n')
             self.stdout.write('Error: ' + message + '\n')
@@ -773,3 +980,7 @@ class FolderReader:
         for warning in self.warnings:
             self.stdout.write('    ' + warning + '\n')
         self.stdout.write('-------------------------------------------\n')
+
+
+def get_hash(lines):
+    return hashlib.sha1('\n'.join(lines).encode('utf-8')).hexdigest()
@@ -1,7 +1,6 @@
 #!/usr/bin/env python
 
 # builtin imports
-import pickle
 import json
 import yaml
 from yaml import Dumper
@@ -36,6 +35,7 @@ import numpy as np
 from .ase_tools import gas_phase_references, get_chemical_formula, \
     get_reduced_chemical_formula, symbols, collect_structures
 import cathub.ase_tools
+from .parsecache import ParseCache
 
 np.set_printoptions(threshold=500, linewidth=1800, edgeitems=80)
 
@@ -505,27 +505,23 @@ def create_folders(options, structures, publication_template, root=''):
 
 
 def main(options):
-    pickle_file = options.foldername.strip().rstrip(
-        '/').strip('.').rstrip('/') + '.cache.pckl'
-
-    if Path(pickle_file).exists() \
-            and Path(pickle_file).stat().st_size \
-            and options.use_cache:
-        with open(pickle_file, 'rb') as infile:
-            structures = pickle.load(infile)
-    else:
-        structures = collect_structures(options.foldername, options.verbose,
-                                        level='**/*')
-        if options.gas_dir:
-            structures.extend(
-                collect_structures(
-                    options.gas_dir,
-                    options.verbose,
-                    level='**/*')
-            )
-        if options.use_cache:
-            with open(pickle_file, 'wb') as outfile:
-                pickle.dump(structures, outfile)
+    cache = None
+    if options.use_cache:
+        cache = ParseCache(options.foldername.strip().rstrip(
+            '/').strip('.').rstrip('/') + '.cache.db')
+
+    structures = collect_structures(options.foldername, options.verbose,
+                                    level='**/*', cache=cache)
+    if options.gas_dir:
+        structures.extend(
+            collect_structures(
+                options.gas_dir,
+                options.verbose,
+                level='**/*',
+                cache=cache)
+        )
+    if cache is not None:
+        cache.close()
 
     publication_template = cathub.ase_tools.PUBLICATION_TEMPLATE
     structures = fuzzy_match(structures, options)
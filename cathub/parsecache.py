@@ -0,0 +1,148 @@
+import os
+import pickle
+import sqlite3
+import hashlib
+
+from .ase_tools import read_structure, read_structure_header
+
+init_commands = [
+    """CREATE TABLE IF NOT EXISTS {table} (
+    filename TEXT PRIMARY KEY,
+    size INTEGER,
+    mtime REAL,
+    sha1 TEXT,
+    structure BLOB
+    );""".format(table=table)
+    for table in ['parsed_file', 'parsed_header']
+]
+
+
+class ParseCache:
+    """
+    Sidecar sqlite3 file with the atomic structures read from structure
+    files, such that unchanged files are not parsed again by later runs.
+
+    Files are keyed on their absolute path. A stored structure is used if
+    the size and modification time of the file are unchanged, or otherwise
+    if the sha1 hash of the content is unchanged, f.ex. after a checkout.
+    The hash is only computed for files that were found with the same size
+    and a new modification time, so new files are not hashed. Files that
+    are not structure files, or have no energy, are stored as None.
+
+    Parameters
+    ----------
+    filename: str
+        name of cache file
+    commit_every: int
+        number of new entries to write per transaction
+    headers: bool
+        store StructureHeader objects read with
+        ase_tools.read_structure_header instead of Atoms objects
+    """
+
+    def __init__(self, filename, commit_every=100, headers=False):
+        self.filename = filename
+        self.commit_every = commit_every
+        self.headers = headers
+        self.table = 'parsed_header' if headers else 'parsed_file'
+        self.connection = None
+        self.n_pending = 0
+        self.n_hits = 0
+        self.unconfirmed = set()
+        self.n_misses = 0
+
+    def _connect(self):
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.filename)
+            for command in init_commands:
+                self.connection.execute(command)
+        return self.connection
+
+    def __enter__(self):
+        self._connect()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.commit()
+            self.connection.close()
+            self.connection = None
+            self.n_pending = 0
+
+    def get(self, filename):
+        """
+        Look up a structure file.
+
+        Returns: (found, structure) with structure as Atoms or
+        StructureHeader object, or None
+        """
+        key = os.path.abspath(filename)
+        con = self._connect()
+        row = con.execute(
+            'SELECT size, mtime, sha1, structure FROM {} '
+            'WHERE filename=?'.format(self.table), [key]).fetchone()
+        if row is None:
+            self.n_misses += 1
+            return False, None
+        size, mtime, sha1, structure = row
+        stat = os.stat(filename)
+        if (size, mtime) != (stat.st_size, stat.st_mtime):
+            if size != stat.st_size or sha1 is None or \
+                    sha1 != get_sha1(filename):
+                if size == stat.st_size:
+                    self.unconfirmed.add(key)  # hash when stored again
+                self.n_misses += 1
+                return False, None
+            con.execute('UPDATE {} SET mtime=? WHERE filename=?'
+                        .format(self.table), [stat.st_mtime, key])
+        self.n_hits += 1
+        if structure is None:
+            return True, None
+        structure = pickle.loads(bytes(structure))
+        structure.info['filename'] = filename
+        return True, structure
+
+    def put(self, filename, structure):
+        """Store Atoms or StructureHeader object, or None, read from file"""
+        key = os.path.abspath(filename)
+        stat = os.stat(filename)
+        sha1 = None
+        if key in self.unconfirmed:
+            self.unconfirmed.remove(key)
+            sha1 = get_sha1(filename)
+        blob = None
+        if structure is not None:
+            blob = sqlite3.Binary(pickle.dumps(structure, protocol=2))
+        con = self._connect()
+        con.execute(
+            'INSERT OR REPLACE INTO {} '
+            '(filename, size, mtime, sha1, structure) VALUES (?, ?, ?, ?, ?)'
+            .format(self.table),
+            [key, stat.st_size, stat.st_mtime, sha1, blob])
+        self.n_pending += 1
+        if self.n_pending >= self.commit_every:
+            con.commit()
+            self.n_pending = 0
+
+    def read_structure(self, filename):
+        """Structure of file from the cache, or read with
+        ase_tools.read_structure (or read_structure_header) and stored"""
+        found, structure = self.get(filename)
+        if not found:
+            if self.headers:
+                structure = read_structure_header(filename)
+            else:
+                structure = read_structure(filename)
+            self.put(filename, structure)
+        return structure
+
+
+def get_sha1(filename, block_size=2**20):
+    sha1 = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
@@ -3,14 +3,25 @@ import sys
 import time
 import json
 import random
+import bisect
+import functools
+import threading
+from multiprocessing.pool import ThreadPool
+import numbers
+import six
+import numpy as np
 import psycopg2
 from psycopg2.extras import execute_values
+from psycopg2.pool import ThreadedConnectionPool
 import ase.db
+from ase.data import atomic_numbers
 from ase.db.core import now
 from ase.db.postgresql import PostgreSQLDatabase
+from ase.db.sqlite import float_if_not_none
+from ase.utils import basestring
 from past.utils import PY2
 
-from .cathubsqlite import CathubSQLite
+from .cathubsqlite import CathubSQLite, get_species_values, get_tables
 
 init_commands = [
     """CREATE TABLE publication (
@@ -61,7 +72,7 @@ init_commands = [
 
     """CREATE TABLE log (
     ase_id text PRIMARY KEY REFERENCES systems(unique_id) ON DELETE CASCADE,
-    logfile BYTEA,
+    logfile BYTEA
     )""",
 ]
 
@@ -74,6 +85,33 @@ index_statements = [
     'CREATE INDEX idxuser ON reaction (username);'
 ]
 
+species_statements = [
+    """CREATE TABLE reaction_species (
+    reaction_id integer REFERENCES reaction(id) ON DELETE CASCADE,
+    species text,
+    state text,
+    prefactor numeric,
+    side text
+    );""",
+    'CREATE INDEX idxspecies ON reaction_species (species, state, side);',
+    'CREATE INDEX idxspeciesreac ON reaction_species (reaction_id);',
+
+    # Fill from existing reactions, see cathubsqlite.get_species_values
+    """INSERT INTO reaction_species (reaction_id, species, state, prefactor,
+    side)
+    SELECT reaction.id,
+    replace(replace(replace(replace(species.key, '*', ''), '(g)', ''),
+    'star', ''), 'gas', ''),
+    CASE WHEN species.key LIKE '%*%' OR species.key LIKE '%star%' THEN 'star'
+    WHEN species.key LIKE '%gas%' THEN 'gas' ELSE 'star' END,
+    species.value::numeric, sides.side
+    FROM reaction,
+    LATERAL (VALUES ('reactants', reaction.reactants),
+    ('products', reaction.products)) AS sides (side, species),
+    LATERAL jsonb_each_text(CASE WHEN jsonb_typeof(sides.species) = 'object'
+    THEN sides.species ELSE '{}'::jsonb END) AS species;"""
+]
+
 tsvector_statements = [
     """ALTER TABLE publication ADD COLUMN pubtextsearch tsvector;""",
 
@@ -98,13 +136,17 @@ tsvector_statements = [
 
     'CREATE INDEX idxsearch ON reaction USING GIN (textsearch);'
 ]
-tsvector_update = [
+# Text search columns, updated for the rows with id in a list of new ids
+tsvector_update = {
+    'publication':
     """UPDATE publication SET pubtextsearch =
     to_tsvector('simple', coalesce(title, '') || ' ' ||
     coalesce(authors::text, '') || ' ' || coalesce(year::text, '') || ' ' ||
-    coalesce(tags::text, ''));
+    coalesce(tags::text, ''))
+    WHERE id = ANY(%s);
     """,
 
+    'reaction':
     """
     UPDATE reaction SET textsearch =
     to_tsvector('simple', coalesce(regexp_replace(
@@ -112,9 +154,10 @@ tsvector_update = [
     '([0-9])', '', 'g'), '()([A-Z])', '\1 \2','g'), '') || ' ' ||
     coalesce(facet, '') || ' ' ||
     replace(replace(coalesce(reactants::text, '') || ' ' ||
-    coalesce(products::text, ''), 'star',''), 'gas', ''));
+    coalesce(products::text, ''), 'star',''), 'gas', ''))
+    WHERE id = ANY(%s);
     """
-]
+}
 
 
 def pwgen(n):
@@ -126,15 +169,68 @@ def pwgen(n):
         ) for i in range(n)])
 
 
+# Connection pools and schemas with tables, shared between
+# CathubPostgreSQL objects
+_pools = {}
+_pools_lock = threading.Lock()
+_connection_pools = {}  # pool of each connection in use
+_initialized_schemas = set()
+
+
+def close_pools():
+    """Close all pooled connections, f.ex. at the end of a script"""
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.closeall()
+        _pools.clear()
+        _connection_pools.clear()
+
+
+def timed(method):
+    """Record the number of calls and total time of a CathubPostgreSQL
+    method in its timings dict"""
+    @functools.wraps(method)
+    def timed_method(self, *args, **kwargs):
+        t0 = time.time()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            self._record_time(method.__name__, t0)
+    return timed_method
+
+
 class CathubPostgreSQL:
     """ Class for setting up the catalysis hub reaction energy database
     on postgreSQL server.
+
+    Connections are taken from a pool shared by all objects with the same
+    server, user and schema, such that the connection is only set up
+    once. Set up a connection for several manipulations:
+
+        with CathubPostgreSQL(user='catroot') as db:
+            Do your work...
+
+    The number of calls and time spent per method is collected in
+    db.timings and written with db.print_timings().
+
+    Parameters
+    ----------
+    user: str
+    password: str
+    max_connections: int
+        maximum number of open connections in the pool, which should be
+        larger than the number of transfer workers
+    server, port, database, schema:
+        override the defaults for user, f.ex. for a local test server
     """
 
     def __init__(self, user='catroot', password=None, stdin=sys.stdin,
-                 stdout=sys.stdout):
+                 stdout=sys.stdout, max_connections=16, server=None,
+                 port=5432, database=None, schema=None):
         self.initialized = False
         self.connection = None
+        self.max_connections = max_connections
+        self.timings = {}
         self.id = None
         self.server = 'catalysishub.c8gwuc8jwb7l.us-west-2.rds.amazonaws.com'
         self.database = 'catalysishub'
@@ -149,22 +245,69 @@ class CathubPostgreSQL:
             self.password = ''
         else:
             self.schema = user
+        if server is not None:
+            self.server = server
+        if database is not None:
+            self.database = database
+        if schema is not None:
+            self.schema = schema
+        self.port = port
         self.user = user
         self.password = password
         self.stdin = stdin
         self.stdout = stdout
-        self.server_name = "postgres://{0}:{1}@{2}:5432/{3}".format(
-            self.user, self.password, self.server, self.database)
-
+        self.server_name = "postgres://{0}:{1}@{2}:{3}/{4}".format(
+            self.user, self.password, self.server, self.port, self.database)
+
+
+    def _get_pool(self):
+        key = (self.server, self.port, self.database, self.user,
+               self.password, self.schema)
+        with _pools_lock:
+            if key not in _pools:
+                _pools[key] = ThreadedConnectionPool(
+                    1, self.max_connections,
+                    host=self.server,
+                    user=self.user,
+                    password=self.password,
+                    port=self.port,
+                    database=self.database,
+                    options='-c search_path={0}'.format(self.schema))
+            return _pools[key]
 
     def _connect(self):
-        con = psycopg2.connect(host=self.server,
-                               user=self.user,
-                               password=self.password,
-                               port=5432,
-                               database=self.database)
+        """Get a connection from the pool"""
+        t0 = time.time()
+        pool = self._get_pool()
+        con = pool.getconn()
+        while con.closed:  # f.ex. after a server restart
+            pool.putconn(con, close=True)
+            con = pool.getconn()
+        with _pools_lock:
+            _connection_pools[id(con)] = pool
+        self._record_time('connect', t0)
         return con
 
+    def _close(self, con, discard=False):
+        """Return a connection to the pool. Uncommitted changes are rolled
+        back. Connections in an unknown state after errors are discarded.
+        """
+        with _pools_lock:
+            pool = _connection_pools.pop(id(con))
+        pool.putconn(con, close=discard)
+
+    def _record_time(self, name, t0):
+        calls, total = self.timings.get(name, (0, 0))
+        self.timings[name] = (calls + 1, total + time.time() - t0)
+
+    def print_timings(self):
+        """Write number of calls and average time per call of methods"""
+        self.stdout.write('{0:<24} {1:>8} {2:>12}\n'.format(
+            'Method', 'Calls', 'msec/call'))
+        for name, (calls, total) in sorted(self.timings.items()):
+            self.stdout.write('{0:<24} {1:>8} {2:>12.2f}\n'.format(
+                name, calls, 1000 * total / calls))
+
     def __enter__(self):
         assert self.connection is None
         self.connection = self._connect()
@@ -175,12 +318,16 @@ class CathubPostgreSQL:
             self.connection.commit()
         else:
             self.connection.rollback()
-        self.connection.close()
+        self._close(self.connection, discard=exc_type is not None)
         self.connection = None
 
     def _initialize(self, con):
         if self.initialized:
             return
+        key = (self.server, self.port, self.database, self.schema)
+        if key in _initialized_schemas:  # checked by another object
+            self.initialized = True
+            return self
         cur = con.cursor()
 
         self.stdout.write("_initialize start\n")
@@ -213,14 +360,26 @@ class CathubPostgreSQL:
                 self.stdout.write(statement + '\n')
                 cur.execute(statement)
             con.commit()
+
+        cur.execute("""SELECT to_regclass('reaction_species');""")
+        if cur.fetchone()[0] is None:
+            self.stdout.write("_initialize create reaction_species table\n")
+            try:
+                for statement in species_statements:
+                    cur.execute(statement)
+                con.commit()
+            except psycopg2.ProgrammingError:  # f.ex. read-only user
+                con.rollback()
+                self.stdout.write(
+                    "_initialize no privileges to create reaction_species\n")
         self.initialized = True
+        _initialized_schemas.add(key)
         return self
 
     def get_ase_db(self):
-        if not self.connection:
-            self._connect()
         return ase.db.connect(self.server_name)
 
+    @timed
     def create_user(self, user, table_privileges=['ALL PRIVILEGES'],
                     schema_privileges=['ALL PRIVILEGES'],
                     row_limit=50000):
@@ -310,13 +469,15 @@ class CathubPostgreSQL:
         set_schema = 'ALTER ROLE {user} SET search_path TO {schema};'\
                      .format(user=self.user, schema=self.schema)
         cur.execute(set_schema)
+        cur.execute('RESET search_path;')  # to value of pooled connection
 
         if self.connection is None:
             con.commit()
-            con.close()
+            self._close(con)
 
         return password
 
+    @timed
     def delete_user(self, user):
         """ Delete user and all data"""
         assert self.user == 'catroot' or self.user == 'postgres'
@@ -324,6 +485,8 @@ class CathubPostgreSQL:
         con = self.connection or self._connect()
         cur = con.cursor()
         cur.execute('DROP SCHEMA {user} CASCADE;'.format(user=user))
+        _initialized_schemas.discard((self.server, self.port, self.database,
+                                      user))
         cur.execute('REVOKE USAGE ON SCHEMA public FROM {user};'
                     .format(user=user))
         cur.execute(
@@ -336,13 +499,30 @@ class CathubPostgreSQL:
 
         if self.connection is None:
             con.commit()
-            con.close()
+            self._close(con)
 
         return self
 
+    @timed
     def release(self, pub_ids=None, userhandle=None, from_schema='upload',
                 to_schema='public'):
-        """ Transfer dataset from one schema to another"""
+        """ Transfer dataset from one schema to another
+
+        All publications are moved with one batch of set-based statements,
+        in one transaction. New reaction ids are allocated in to_schema and
+        mapped from the old ids through a temporary table.
+
+        Parameters
+        ----------
+        pub_ids: list of str
+            publications to release
+        userhandle: str
+            release all publications with reactions by this user instead
+        from_schema: str
+        to_schema: str
+
+        Returns: dict with number of rows moved per table
+        """
 
         assert pub_ids or userhandle,\
             "Specify either pub_ids or userhandle"
@@ -358,104 +538,131 @@ class CathubPostgreSQL:
             cur.execute(
                 """SELECT distinct pub_id
                 FROM {from_schema}.reaction
-                WHERE username = '{username}'"""
-                .format(from_schema=from_schema,
-                        username=userhandle))
+                WHERE username = %s""".format(from_schema=from_schema),
+                [userhandle])
 
             pub_ids = [id[0] for id in cur.fetchall()]
 
-        for pub_id in pub_ids:
-            self.stdout.write(
-                """Releasing publication {pub_id} from
-                {from_schema} to {schema} \n"""
-                .format(pub_id=pub_id, from_schema=from_schema,
-                        schema=to_schema))
+        pub_ids = list(pub_ids)
+        self.stdout.write(
+            """Releasing publications {pub_ids} from
+            {from_schema} to {schema} \n"""
+            .format(pub_ids=', '.join(pub_ids), from_schema=from_schema,
+                    schema=to_schema))
 
-            mtime = now()
-            cur.execute(
-                """UPDATE {from_schema}.systems SET
-                mtime = {mtime}
-                WHERE unique_id in
-                  (SELECT distinct ase_id
-                   FROM {from_schema}.publication_system
-                   WHERE pub_id = '{pub_id}')"""
-                .format(from_schema=from_schema,
-                        mtime=mtime, pub_id=pub_id))
-
-            columns = get_key_str('systems', start_index=1)
-            cur.execute(
-                """INSERT INTO {schema}.systems ({columns})
-                SELECT {columns}
-                FROM {from_schema}.systems
-                WHERE unique_id in
-                  (SELECT distinct ase_id
-                   FROM {from_schema}.publication_system
-                   WHERE pub_id = '{pub_id}')"""
-                .format(from_schema=from_schema,
-                        schema=to_schema,
-                        columns=columns,
-                        pub_id=pub_id))
-
-            columns = get_key_str('publication', start_index=1)  # new id
-            cur.execute(
-                """INSERT INTO {schema}.publication ({columns})
-                SELECT {columns}
-                FROM {from_schema}.publication
-                WHERE pub_id = '{pub_id}'"""
-                .format(from_schema=from_schema,
-                        schema=to_schema, columns=columns,
-                        pub_id=pub_id))
-            cur.execute(
-                """INSERT INTO {schema}.publication_system
-                SELECT *
-                FROM {from_schema}.publication_system
-                WHERE pub_id = '{pub_id}'"""
-                .format(from_schema=from_schema,
-                        schema=to_schema, columns=columns, pub_id=pub_id))
+        counts = {}
+        pub_systems = """SELECT distinct ase_id
+        FROM {from_schema}.publication_system
+        WHERE pub_id = ANY(%s)""".format(from_schema=from_schema)
 
-            columns = get_key_str('reaction', start_index=1)  # new id
+        cur.execute(
+            """UPDATE {from_schema}.systems SET mtime = %s
+            WHERE unique_id in ({pub_systems})"""
+            .format(from_schema=from_schema, pub_systems=pub_systems),
+            [now(), pub_ids])
 
-            cur.execute(
-                """INSERT INTO {schema}.reaction ({columns})
-                SELECT {columns}
-                FROM {from_schema}.reaction
-                WHERE pub_id = '{pub_id}'
-                ORDER BY {from_schema}.reaction.id
-                RETURNING id"""
-                .format(from_schema=from_schema,
-                        schema=to_schema, columns=columns, pub_id=pub_id))
+        columns = get_key_str('systems', start_index=1)
+        cur.execute(
+            """INSERT INTO {schema}.systems ({columns})
+            SELECT {columns}
+            FROM {from_schema}.systems
+            WHERE unique_id in ({pub_systems})"""
+            .format(from_schema=from_schema, schema=to_schema,
+                    columns=columns, pub_systems=pub_systems),
+            [pub_ids])
+        counts['systems'] = cur.rowcount
+
+        columns = get_key_str('publication', start_index=1)  # new id
+        cur.execute(
+            """INSERT INTO {schema}.publication ({columns})
+            SELECT {columns}
+            FROM {from_schema}.publication
+            WHERE pub_id = ANY(%s)
+            ORDER BY id"""
+            .format(from_schema=from_schema, schema=to_schema,
+                    columns=columns),
+            [pub_ids])
+        counts['publication'] = cur.rowcount
 
-            new_ids = [id[0] for id in cur.fetchall()]
+        cur.execute(
+            """INSERT INTO {schema}.publication_system
+            SELECT *
+            FROM {from_schema}.publication_system
+            WHERE pub_id = ANY(%s)"""
+            .format(from_schema=from_schema, schema=to_schema),
+            [pub_ids])
+        counts['publication_system'] = cur.rowcount
+
+        # Map old to new reaction ids
+        cur.execute(
+            """CREATE TEMP TABLE release_id_map
+            (old_id integer PRIMARY KEY, new_id integer);""")
+        # new ids are reserved from the sequence, and assigned in the order
+        # of the old ids
+        cur.execute(
+            """SELECT id FROM {from_schema}.reaction
+            WHERE pub_id = ANY(%s) ORDER BY id"""
+            .format(from_schema=from_schema), [pub_ids])
+        old_ids = [row[0] for row in cur.fetchall()]
+        cur.execute(
+            """SELECT nextval(pg_get_serial_sequence(%s, 'id'))
+            FROM generate_series(1, %s)""",
+            ['{0}.reaction'.format(to_schema), len(old_ids)])
+        new_ids = sorted(row[0] for row in cur.fetchall())
+        execute_values(cur=cur,
+                       sql='INSERT INTO release_id_map VALUES %s',
+                       argslist=list(zip(old_ids, new_ids)),
+                       page_size=1000)
+
+        columns = get_key_str('reaction', start_index=1)
+        cur.execute(
+            """INSERT INTO {schema}.reaction (id, {columns})
+            SELECT release_id_map.new_id, {columns}
+            FROM {from_schema}.reaction
+            JOIN release_id_map
+            ON release_id_map.old_id = {from_schema}.reaction.id
+            ORDER BY release_id_map.new_id"""
+            .format(from_schema=from_schema, schema=to_schema,
+                    columns=columns))
+        counts['reaction'] = cur.rowcount
 
-            cur.execute(
-                """SELECT * from {from_schema}.reaction_system
-                WHERE ase_id in
-                (SELECT distinct ase_id
-                FROM {from_schema}.publication_system
-                WHERE pub_id = '{pub_id}') ORDER BY id"""
-                .format(from_schema=from_schema,
-                        pub_id=pub_id))
-
-            reaction_system0 = cur.fetchall()
-            reaction_system_values = []
-            id0 = reaction_system0[0][3]
-            i = 0
-            for row in reaction_system0:
-                row = list(row)
-                if not id0 == row[3]:
-                    i += 1
-                    id0 = row[3]
-                row[3] = new_ids[i]
-                reaction_system_values += [tuple(row)]
-            key_str = get_key_str('reaction_system')
-            insert_command = """
-            INSERT INTO {schema}.reaction_system ({key_str})
-            VALUES %s ON CONFLICT DO NOTHING;"""\
-            .format(schema=to_schema, key_str=key_str)
+        cur.execute(
+            """INSERT INTO {schema}.reaction_system ({key_str})
+            SELECT name, energy_correction, ase_id, release_id_map.new_id
+            FROM {from_schema}.reaction_system
+            JOIN release_id_map
+            ON release_id_map.old_id = {from_schema}.reaction_system.id
+            ON CONFLICT DO NOTHING"""
+            .format(from_schema=from_schema, schema=to_schema,
+                    key_str=get_key_str('reaction_system')))
+        counts['reaction_system'] = cur.rowcount
 
-            execute_values(cur=cur, sql=insert_command,
-                           argslist=reaction_system_values, page_size=1000)
-            self.stdout.write('Transfer complete\n')
+        cur.execute(
+            """SELECT to_regclass(%s), to_regclass(%s)""",
+            ['{0}.reaction_species'.format(from_schema),
+             '{0}.reaction_species'.format(to_schema)])
+        if None not in cur.fetchone():
+            cur.execute(
+                """INSERT INTO {schema}.reaction_species ({key_str})
+                SELECT release_id_map.new_id, {columns}
+                FROM {from_schema}.reaction_species
+                JOIN release_id_map
+                ON release_id_map.old_id =
+                {from_schema}.reaction_species.reaction_id"""
+                .format(from_schema=from_schema, schema=to_schema,
+                        key_str=get_key_str('reaction_species'),
+                        columns=get_key_str('reaction_species',
+                                            start_index=1)))
+            counts['reaction_species'] = cur.rowcount
+
+        cur.execute('DROP TABLE release_id_map;')
+
+        self.stdout.write('Transfer complete\n')
+        for table in ['systems', 'publication', 'publication_system',
+                      'reaction', 'reaction_system', 'reaction_species']:
+            if table in counts:
+                self.stdout.write('  {0}: {1} rows\n'.format(
+                    table, counts[table]))
 
         #if self.user == 'catroot':
         #    if self.connection is None:
@@ -464,10 +671,11 @@ class CathubPostgreSQL:
 
         if self.connection is None:
             con.commit()
-            con.close()
+            self._close(con)
 
-        return
+        return counts
 
+    @timed
     def get_pub_id_owner(self, pub_id):
         """Check if a user owns a publication"""
         con = self.connection or self._connect()
@@ -479,66 +687,141 @@ class CathubPostgreSQL:
             .format(pub_id=pub_id))
 
         username = cur.fetchall()[0][0]
+        if self.connection is None:
+            self._close(con)
 
         return username
 
-    def delete_publication(self, pub_id, schema='upload'):
-        """ Delete dataset from upload schema"""
+    @timed
+    def delete_publication(self, pub_id, schema='upload', batch_size=1000,
+                           vacuum=False):
+        """ Delete dataset from upload schema
+
+        The ids of the atomic structures are collected in a temporary
+        table once, and reactions and structures are deleted batch_size
+        rows at the time. Each batch is committed separately, unless
+        inside a with block, such that locks are only held briefly.
+
+        Parameters
+        ----------
+        pub_id: str
+        schema: str
+        batch_size: int
+            number of reactions or atomic structures to delete per batch
+        vacuum: bool
+            run VACUUM ANALYZE on the affected tables afterwards
+
+        Returns: dict with number of deleted rows per table
+        """
         if schema == 'upload':
             user = 'upload_admin'
         elif schema == 'public':
             user = 'catroot'
 
-        if not self.user == 'catroot':
+        if self.user not in ['catroot', 'postgres']:
             assert self.user == user, \
                 "You don't have permission to perform this operation"
 
         con = self.connection or self._connect()
         cur = con.cursor()
 
+        def commit():
+            if self.connection is None:
+                con.commit()
+
         self.stdout.write('Deleting publication: {pub_id} from {schema}\n'
                           .format(pub_id=pub_id, schema=schema))
 
-        cur.execute("""SELECT to_regclass('keys');""")
-        if cur.fetchone()[0] is not None:  # remove data from old tables
-            old_tables = ['text_key_values', 'number_key_values',
-                          'species', 'keys']
-            for table in old_tables:
-                cur.execute(
-                    """DELETE FROM {schema}.{table}"""
-                    .format(schema=schema,
-                            table=table))
-
+        counts = {'reaction': 0, 'systems': 0}
+        while True:
+            cur.execute(
+                """DELETE FROM {schema}.reaction WHERE id IN
+                (SELECT id FROM {schema}.reaction WHERE pub_id = %s
+                LIMIT %s)""".format(schema=schema), [pub_id, batch_size])
+            if cur.rowcount == 0:
+                break
+            counts['reaction'] += cur.rowcount
+            commit()
+            self.stdout.write('  Deleted {0} reactions\n'
+                              .format(counts['reaction']))
+
+        cur.execute('DROP TABLE IF EXISTS delete_system_ids;')
+        cur.execute('CREATE TEMP TABLE delete_system_ids (id integer);')
         cur.execute(
-            """DELETE FROM {schema}.systems
-            WHERE unique_id in
-            (SELECT distinct ase_id
-            FROM {schema}.publication_system
-            WHERE pub_id = '{pub_id}')"""
-            .format(schema=schema,
-                    pub_id=pub_id))
+            """INSERT INTO delete_system_ids
+            SELECT systems.id FROM {schema}.systems
+            JOIN (SELECT distinct ase_id FROM {schema}.publication_system
+                  WHERE pub_id = %s) AS pub_systems
+            ON pub_systems.ase_id = systems.unique_id
+            ORDER BY systems.id""".format(schema=schema), [pub_id])
+        n_systems = cur.rowcount
+        commit()
+
+        # Tables from older ASE versions, without ON DELETE CASCADE
+        side_tables = []
+        for table in ['text_key_values', 'number_key_values', 'species',
+                      'keys']:
+            cur.execute('SELECT to_regclass(%s);',
+                        ['{0}.{1}'.format(schema, table)])
+            if cur.fetchone()[0] is not None:
+                side_tables.append(table)
+
+        last_id = 0
+        while True:
+            cur.execute("""SELECT id FROM delete_system_ids WHERE id > %s
+            ORDER BY id LIMIT %s""", [last_id, batch_size])
+            ids = [id[0] for id in cur.fetchall()]
+            if len(ids) == 0:
+                break
+            last_id = ids[-1]
+            for table in side_tables:
+                cur.execute(
+                    'DELETE FROM {schema}.{table} WHERE id = ANY(%s)'
+                    .format(schema=schema, table=table), [ids])
+            cur.execute(
+                'DELETE FROM {schema}.systems WHERE id = ANY(%s)'
+                .format(schema=schema), [ids])
+            counts['systems'] += cur.rowcount
+            commit()
+            self.stdout.write('  Deleted {0} / {1} atomic structures\n'
+                              .format(counts['systems'], n_systems))
+        cur.execute('DROP TABLE delete_system_ids;')
 
         cur.execute(
             """ DELETE FROM {schema}.publication
-            WHERE pub_id = '{pub_id}'"""
-            .format(schema=schema,
-                    pub_id=pub_id))
+            WHERE pub_id = %s""".format(schema=schema), [pub_id])
+        counts['publication'] = cur.rowcount
 
         self.stdout.write('Delete complete\n')
 
         if self.connection is None:
             con.commit()
-            con.close()
-        return
-
+            if vacuum:
+                con.autocommit = True
+                for table in ['reaction', 'reaction_system',
+                              'reaction_species', 'publication_system',
+                              'publication', 'systems'] + side_tables:
+                    cur.execute('SELECT to_regclass(%s);',
+                                ['{0}.{1}'.format(schema, table)])
+                    if cur.fetchone()[0] is not None:
+                        cur.execute('VACUUM ANALYZE {schema}.{table};'
+                                    .format(schema=schema, table=table))
+                con.autocommit = False
+            self._close(con)
+        return counts
+
+    @timed
     def status(self, table='reaction'):
         con = self.connection or self._connect()
         self._initialize(con)
         cur = con.cursor()
         cur.execute("SELECT COUNT(id) from {table};".format(table=table))
         count = cur.fetchone()
+        if self.connection is None:
+            self._close(con)
         return count[0]
 
+    @timed
     def read(self, id, table='reaction'):
         con = self.connection or self._connect()
         self._initialize(con)
@@ -551,14 +834,342 @@ class CathubPostgreSQL:
         columns = cur.fetchall()
 
         if id == 'all':
-            cur.execute('SELECT * FROM \n {table} \n'.format(table=table))
+            row = list(self._iter_rows(con, table))
         else:
             cur.execute('SELECT * FROM \n {table} \n WHERE \n {table}.id={id}'
                         .format(table=table, id=id))
-        row = cur.fetchall()
+            row = cur.fetchall()
+
+        if self.connection is None:
+            con.commit()
+            self._close(con)
 
         return columns, row
 
+    def iter_rows(self, table='reaction', batch_size=1000):
+        """
+        Iterate over all rows of a table with a named (server-side)
+        cursor, which fetches batch_size rows at the time instead of
+        the whole table.
+        """
+        con = self.connection or self._connect()
+        self._initialize(con)
+        try:
+            for row in self._iter_rows(con, table, batch_size):
+                yield row
+        finally:
+            if self.connection is None:
+                con.commit()
+                self._close(con)
+
+    def _iter_rows(self, con, table, batch_size=1000):
+        cur = con.cursor(name='cathub_{0}_{1}'.format(table, id(con)))
+        cur.itersize = batch_size
+        cur.execute('SELECT * FROM {table}'.format(table=table))
+        for row in cur:
+            yield row
+        cur.close()
+
+    def iter_reactions(self, where=None, params=[], batch_size=1000):
+        """
+        Iterate over rows of the reaction table together with their
+        reaction_system rows, ordered by reaction id. Rows are fetched
+        batch_size at the time with keyset pagination on reaction.id.
+        See CathubSQLite.iter_reactions()
+
+        Parameters
+        ----------
+        where: str
+            SQL condition on the reaction table, f.ex.
+            'reaction.surface_composition=%s'
+        params: list
+            values for the %s placeholders in where
+        batch_size: int
+            number of reactions to fetch per query
+
+        Yields: (reaction row, list of reaction_system rows)
+        """
+        con = self.connection or self._connect()
+        self._initialize(con)
+        cur = con.cursor()
+
+        condition = 'reaction.id > %s'
+        if where:
+            condition += ' AND ({})'.format(where)
+        statement = """SELECT {} FROM reaction WHERE {}
+        ORDER BY reaction.id LIMIT %s""".format(get_key_str('reaction'),
+                                                condition)
+        system_statement = """SELECT {} FROM reaction_system
+        WHERE reaction_system.id = ANY(%s)""".format(
+            get_key_str('reaction_system'))
+
+        last_id = 0
+        try:
+            while True:
+                cur.execute(statement, [last_id] + list(params) + [batch_size])
+                rows = cur.fetchall()
+                if len(rows) == 0:
+                    break
+                last_id = rows[-1][0]
+
+                reaction_systems = {}
+                cur.execute(system_statement, [[row[0] for row in rows]])
+                for system_row in cur.fetchall():
+                    reaction_systems.setdefault(system_row[3], []) \
+                        .append(system_row)
+
+                for row in rows:
+                    yield row, reaction_systems.get(row[0], [])
+        finally:
+            if self.connection is None:
+                self._close(con)
+
+    @timed
+    def get_species_names(self):
+        """
+        Get the names of all reactants and products in the reaction table
+
+        Returns: {'reactants': sorted list, 'products': sorted list}
+        """
+        con = self.connection or self._connect()
+        self._initialize(con)
+        cur = con.cursor()
+
+        names = {}
+        for side in ['reactants', 'products']:
+            cur.execute(
+                """SELECT DISTINCT jsonb_object_keys({side}) FROM reaction
+                WHERE jsonb_typeof({side}) = 'object'""".format(side=side))
+            names[side] = sorted(row[0] for row in cur.fetchall())
+
+        if self.connection is None:
+            self._close(con)
+
+        return names
+
+    @timed
+    def write_systems(self, rows):
+        """
+        Write atomic structures to the systems table and its side tables
+        with a few execute_values calls, instead of one ASE db write per
+        row.
+
+        Parameters
+        ----------
+        rows: list of AtomsRow objects
+            f.ex. from ase.db.connect('yourdbfile.db').select()
+
+        Returns: list of ids
+        """
+        con = self.connection or self._connect()
+        self._initialize(con)
+        cur = con.cursor()
+
+        ids = self._write_systems(cur, rows)
+
+        if self.connection is None:
+            con.commit()
+            self._close(con)
+
+        return ids
+
+    def _write_systems(self, cur, rows, ids=None, prefix=''):
+        """Write AtomsRow objects to the systems table and its side tables,
+        or to the tables with the names prefixed by prefix, with new ids
+        from the id sequence or with the given ids"""
+        if len(rows) == 0:
+            return []
+
+        if ids is None:
+            ids = self._get_new_ids(cur, 'systems', len(rows))
+
+        db_ase = PostgreSQLDatabase()  # for encoding of columns
+        mtime = now()
+        system_values = []
+        side_values = {'species': [], 'keys': [], 'text_key_values': [],
+                       'number_key_values': []}
+        for id, row in zip(ids, rows):
+            system_values.append(get_system_values(db_ase, id, row, mtime))
+
+            for symbol, n in row.count_atoms().items():
+                side_values['species'].append(
+                    (atomic_numbers[symbol], n, id))
+            for key, value in row.key_value_pairs.items():
+                side_values['keys'].append((key, id))
+                if isinstance(value, (numbers.Real, np.bool_)):
+                    side_values['number_key_values'].append(
+                        (key, float(value), id))
+                else:
+                    side_values['text_key_values'].append((key, value, id))
+
+        key_str = get_key_str('systems')
+        insert_command = """INSERT INTO {0}systems ({1})
+        VALUES %s;""".format(prefix, key_str)
+        execute_values(cur=cur, sql=insert_command,
+                       argslist=system_values, page_size=len(rows))
+
+        for table in ['species', 'keys', 'text_key_values',
+                      'number_key_values']:
+            cur.execute("SELECT to_regclass(%s);", [prefix + table])
+            if cur.fetchone()[0] is None:  # removed in newer ASE versions
+                continue
+            insert_command = 'INSERT INTO {0}{1} VALUES %s;'.format(prefix,
+                                                                    table)
+            execute_values(cur=cur, sql=insert_command,
+                           argslist=side_values[table], page_size=1000)
+
+        return ids
+
+    def _transfer_blocks(self, con, blocks, n_blocks, transfer_block, label,
+                         workers=1):
+        """
+        Call transfer_block(con, b0, b1) for each (block_id, b0, b1) in
+        blocks, over con, or over a pool of worker connections with
+        disjoint sets of blocks.
+
+        Returns: list of (n, stats) results of transfer_block
+        """
+        t0 = time.time()
+        results = []
+
+        def run(con, block_id, b0, b1):
+            t1 = time.time()
+            result = transfer_block(con, b0, b1)
+            if result is None:
+                self.stdout.write('  Skipping completed block {0}\n'
+                                  .format(block_id + 1))
+                return
+            results.append(result)
+            n_done = len(results)
+            dt = time.time() - t1
+            self.stdout.write(
+                '  Finnished Block {0} / {1} in {2} sec\n'
+                .format(block_id + 1, n_blocks, dt))
+            self.stdout.write(
+                '    Completed transfer of {0} {1}\n'
+                .format(result[0], label))
+            self.stdout.write('    Estimated time left: {0} sec\n'.format(
+                (time.time() - t0) / n_done * (len(blocks) - n_done)))
+
+        if workers == 1:
+            for block in blocks:
+                run(con, *block)
+            return results
+
+        def run_worker(i):
+            con_worker = self._connect()
+            try:
+                for block in blocks[i::workers]:
+                    run(con_worker, *block)
+            finally:
+                self._close(con_worker)
+
+        pool = ThreadPool(workers)
+        try:
+            pool.map(run_worker, range(workers))
+        finally:
+            pool.close()
+            pool.join()
+        return results
+
+    def _transfer_systems(self, con, db, journal, server, b0, b1, done):
+        """Write atomic structures with ids b0 to b1 of ase db, in one
+        transaction"""
+        rows = [row for row in db.select('{}<=id<={}'.format(b0, b1))
+                if not in_ranges(row.id, done)]
+        if len(rows) == 0:
+            return None
+        cur = con.cursor()
+        ids = self._write_systems(cur, rows)
+        journal.write_checkpoint(server, 'systems', b0, b1, ids[0], ids[-1])
+        con.commit()
+        journal.write_checkpoint(server, 'systems', b0, b1, ids[0], ids[-1],
+                                 completed=True)
+        return len(rows), {}
+
+    def _transfer_reactions(self, con, db, journal, server, b0, b1, done,
+                            write_reaction_system=True):
+        """Write reactions with ids b0 to b1 of CathubSQLite db, with new
+        ids, in one transaction"""
+        reactions = [
+            (values, rows) for values, rows in db.iter_reactions(
+                where='reaction.id BETWEEN ? AND ?',
+                params=[b0, b1], batch_size=b1 - b0 + 1)
+            if not in_ranges(values[0], done)]
+        if len(reactions) == 0:
+            return None
+
+        cur = con.cursor()
+        ids = self._get_new_ids(cur, 'reaction', len(reactions))
+        reaction_values, reaction_system_values, species_values = \
+            get_reaction_block_values(ids, reactions, write_reaction_system)
+
+        stats = {}
+        for table, table_values in [
+                ('reaction', reaction_values),
+                ('reaction_system', reaction_system_values),
+                ('reaction_species', species_values)]:
+            t0 = time.time()
+            self._copy_rows(cur, table, table_values)
+            stats[table] = (len(table_values), time.time() - t0)
+        cur.execute(tsvector_update['reaction'], [ids])
+        journal.write_checkpoint(server, 'reaction', b0, b1, ids[0], ids[-1])
+        con.commit()
+        journal.write_checkpoint(server, 'reaction', b0, b1, ids[0], ids[-1],
+                                 completed=True)
+        return len(reactions), stats
+
+    def get_server_key(self):
+        """Server and schema, without password, for the transfer journal"""
+        return '{0}@{1}/{2}'.format(self.schema, self.server, self.database)
+
+    def _check_checkpoints(self, cur, journal, server):
+        """
+        Settle pending blocks in the transfer journal: a block is completed
+        if the first id allocated for it exists on the server, since each
+        block is written in one transaction.
+
+        Returns: dict with merged ranges of completed source ids per phase
+        """
+        ranges = {}
+        for phase, source_start, source_end, target_start, target_end, \
+                completed in journal.get_checkpoints(server):
+            if not completed and target_start is not None:
+                table = {'systems': 'systems', 'reaction': 'reaction'}[phase]
+                cur.execute('SELECT count(*) FROM {0} WHERE id=%s'
+                            .format(table), [target_start])
+                completed = cur.fetchone()[0] > 0
+                if completed:
+                    journal.write_checkpoint(server, phase, source_start,
+                                             source_end, target_start,
+                                             target_end, completed=True)
+            if completed:
+                ranges.setdefault(phase, []).append((source_start,
+                                                     source_end))
+            else:
+                journal.delete_checkpoints(server, phase, source_start)
+        self.stdout.write('  {0} completed blocks in transfer journal\n'
+                          .format(sum(len(r) for r in ranges.values())))
+        return {phase: merge_ranges(phase_ranges)
+                for phase, phase_ranges in ranges.items()}
+
+    def _get_new_ids(self, cur, table, n):
+        """Allocate n ids from the id sequence of table"""
+        if n == 0:
+            return []
+        cur.execute("""SELECT nextval('{0}_id_seq')
+        FROM generate_series(1, %s)""".format(table), [n])
+        return [id[0] for id in cur.fetchall()]
+
+    def _copy_rows(self, cur, table, rows, target=None):
+        """Stream rows into table, or into target with the columns of
+        table, with COPY FROM STDIN"""
+        if len(rows) == 0:
+            return
+        cur.copy_expert('COPY {0} ({1}) FROM STDIN'.format(
+            target or table, get_key_str(table)), get_copy_buffer(rows))
+
+    @timed
     def write_publication(self, pub_values):
         con = self.connection or self._connect()
         self._initialize(con)
@@ -570,7 +1181,7 @@ class CathubPostgreSQL:
             .format(pub_id=pub_id))
         row = cur.fetchone()
         if row is not None:  # len(row) > 0:
-            id = row  # [0]
+            id = row[0]
         else:
             key_str = get_key_str('publication', start_index=1)
             value_str = get_value_str(pub_values, start_index=1)
@@ -583,9 +1194,10 @@ class CathubPostgreSQL:
 
         if self.connection is None:
             con.commit()
-            con.close()
+            self._close(con)
         return id, pub_id
 
+    @timed
     def write(self, values, table='reaction'):
         con = self.connection or self._connect()
         self._initialize(con)
@@ -602,9 +1214,10 @@ class CathubPostgreSQL:
 
         if self.connection is None:
             con.commit()
-            con.close()
+            self._close(con)
         return id
 
+    @timed
     def write_reaction(self, value_dict):
         con = self.connection or self._connect()
         self._initialize(con)
@@ -646,12 +1259,28 @@ class CathubPostgreSQL:
         execute_values(cur=cur, sql=insert_command,
                        argslist=reaction_system_values, page_size=1000)
 
+        self._write_species(cur, id, value_dict['reactants'],
+                            value_dict['products'])
+
         if self.connection is None:
             con.commit()
-            con.close()
+            self._close(con)
 
         return id
 
+    def _write_species(self, cur, id, reactants, products):
+        """Write reactants and products of reaction to reaction_species"""
+        species_values = [tuple([id] + species_row) for species_row in
+                          get_species_values(load_json(reactants),
+                                             load_json(products))]
+        key_str = get_key_str('reaction_species')
+        insert_command = """INSERT INTO reaction_species
+        ({0}) VALUES %s;""".format(key_str)
+
+        execute_values(cur=cur, sql=insert_command,
+                       argslist=species_values, page_size=1000)
+
+    @timed
     def update_reaction(self, id, ase_ids=None, energy_corrections={},
                         **kwargs):
         con = self.connection or self._connect()
@@ -689,11 +1318,20 @@ class CathubPostgreSQL:
             execute_values(cur=cur, sql=insert_command,
                            argslist=reaction_system_values, page_size=1000)
 
+        if 'reactants' in kwargs or 'products' in kwargs:
+            cur.execute("""SELECT reactants, products FROM reaction
+            WHERE id = %s;""", [id])
+            reactants, products = cur.fetchone()
+            cur.execute('DELETE FROM reaction_species WHERE reaction_id = %s;',
+                        [id])
+            self._write_species(cur, id, reactants, products)
+
         if self.connection is None:
             con.commit()
-            con.close()
+            self._close(con)
         return id
 
+    @timed
     def delete_reaction(self, id):
         con = self.connection or self._connect()
         self._initialize(con)
@@ -708,9 +1346,10 @@ class CathubPostgreSQL:
 
         if self.connection is None:
             con.commit()
-            con.close()
+            self._close(con)
         return id
 
+    @timed
     def update_publication(self, pub_dict):
         con = self.connection or self._connect()
         self._initialize(con)
@@ -742,10 +1381,11 @@ class CathubPostgreSQL:
 
         if self.connection is None:
             con.commit()
-            con.close()
+            self._close(con)
 
         return
 
+    @timed
     def delete(self, authorlist, year, doi=None):
         con = self.connection or self._connect()
         self._initialize(con)
@@ -760,10 +1400,11 @@ class CathubPostgreSQL:
         count = cur.fetchone()[0]
         if self.connection is None:
             con.commit()
-            con.close()
+            self._close(con)
 
         return count
 
+    @timed
     def truncate_schema(self):
         """ Will delete all data in schema. Only for test use!"""
 
@@ -776,17 +1417,24 @@ class CathubPostgreSQL:
         cur.execute('TRUNCATE systems CASCADE;')
 
         con.commit()
-        con.close()
+        if self.connection is None:
+            self._close(con)
 
         return
 
+    @timed
     def transfer(self, filename_sqlite, block_size=1000,
                  start_block=0, write_ase=True,
                  write_publication=True, write_reaction=True,
-                 write_reaction_system=True, check=False):
+                 write_reaction_system=True, check=False, resume=False,
+                 workers=1):
         """ Transfer data from local sqlite3 .db file to the
         catalysis-hub postgreSQL server
 
+        Completed blocks are recorded in the transfer_checkpoint table of
+        the .db file, such that an interrupted transfer can be continued
+        with resume=True.
+
         Parameters:
         filename_sqlite: str
             name of .db file
@@ -803,8 +1451,21 @@ class CathubPostgreSQL:
             whether or not to transfer reaction table
         write_reaction_system: bool
             whether or not to write reaction_system table
+        resume: bool
+            skip blocks completed by an earlier transfer to this server
+        workers: int (default 1)
+            Number of connections to write blocks of atomic structures and
+            reactions in parallel. Publications, their text search
+            column and the pub_id of atomic structures are written once,
+            over the main connection. The text search column of reactions
+            is updated per block, on the connection that writes the block.
+
+        Returns: dict with (number of rows written, seconds) of the
+            'systems', 'publication' and 'reaction' phases
         """
 
+        assert os.path.isfile(filename_sqlite), \
+            'No such file: {0}'.format(filename_sqlite)
         self.stdout.write('Starting transfer\n')
         con = self.connection or self._connect()
         self._initialize(con)
@@ -813,43 +1474,50 @@ class CathubPostgreSQL:
         self.stdout.write('Got a cursor\n')
         self.stdout.write('Connecting to {0}\n'.format(self.server_name))
 
+        journal = CathubSQLite(filename_sqlite)
+        server = self.get_server_key()
+        if resume:
+            self.stdout.write('Resuming transfer\n')
+            completed = self._check_checkpoints(cur, journal, server)
+        else:
+            journal.delete_checkpoints(server)
+            completed = {}
+        done_systems = completed.get('systems', ([], []))
+        done_reactions = completed.get('reaction', ([], []))
+
+        phases = {}
         nrows = 0
         if write_ase:
+            t0 = time.time()
             self.stdout.write('Transfering atomic structures\n')
             db = ase.db.connect(filename_sqlite)
-            n_structures = db.count()
+            # blocks span the ids up to the last one, since deleted rows,
+            # f.ex. from incremental folder2db runs, leave gaps
+            con_ase = db._connect()
+            n_structures = None
+            if 'systems' in get_tables(con_ase.cursor()):
+                n_structures = con_ase.execute(
+                    'SELECT max(id) FROM systems').fetchone()[0]
+            con_ase.close()
+            assert n_structures, \
+                'No atomic structures in {0}'.format(filename_sqlite)
             n_blocks = n_structures // block_size + 1
-            t_av = 0
+            blocks = []
             for block_id in range(start_block, n_blocks):
-                i = block_id - start_block
-                t1 = time.time()
-                b0 = block_id * block_size
-                b1 = (block_id + 1) * block_size + 1
-
-                if block_id + 1 == n_blocks:
-                    b1 = n_structures + 1
-
-                rows = list(db.select('{}<id<{}'.format(b0, b1)))
-
-                with ase.db.connect(self.server_name, type='postgresql') as db2:
-                    # write one row at the time until ase is updated
-                    # db2.write(rows)
-                    for row in rows:
-                        db2.write(row)
+                b0 = block_id * block_size + 1
+                b1 = min((block_id + 1) * block_size, n_structures)
+                if b0 <= b1:
+                    blocks.append((block_id, b0, b1))
 
-                nrows += len(rows)
-                t2 = time.time()
-                dt = t2 - t1
-                t_av = (t_av * i + dt) / (i + 1)
+            def transfer_block(con, b0, b1):
+                return self._transfer_systems(con, db, journal, server,
+                                              b0, b1, done_systems)
 
-                self.stdout.write(
-                    '  Finnished Block {0} / {1} in {2} sec\n'
-                    .format(block_id + 1, n_blocks, dt))
-                self.stdout.write(
-                    '    Completed transfer of {0} atomic structures\n'
-                    .format(nrows))
-                self.stdout.write('    Estimated time left: {0} sec\n'.format(
-                    t_av * (n_blocks - block_id - 1)))
+            results = self._transfer_blocks(con, blocks, n_blocks,
+                                            transfer_block,
+                                            'atomic structures', workers)
+            nrows = sum(n for n, stats in results)
+            phases['systems'] = (nrows, time.time() - t0)
 
         db = CathubSQLite(filename_sqlite)
         con_lite = db._connect()
@@ -857,12 +1525,16 @@ class CathubPostgreSQL:
 
         Npub = 0
         Npubstruc = 0
-        if write_publication:
+        if write_publication and 'publication' in completed:
+            self.stdout.write('Skipping completed publications\n')
+        elif write_publication:
+            t0 = time.time()
             self.stdout.write('Transfering publications\n')
             try:
                 npub = db.get_last_pub_id(cur_lite)
             except BaseException:
                 npub = 1
+            pids = []
             for id_lite in range(1, npub + 1):
                 Npub += 1
                 row = db.read(id=id_lite, table='publication')
@@ -870,6 +1542,8 @@ class CathubPostgreSQL:
                     continue
                 values = row[0]
                 pid, pub_id = self.write_publication(values)
+                pids.append(pid)
+            cur.execute(tsvector_update['publication'], [pids])
 
             # Publication structures connection
             cur_lite.execute("""SELECT * from publication_system;""")
@@ -898,110 +1572,57 @@ class CathubPostgreSQL:
                         .format(pub_id=pub_id))
 
             con.commit()
+            journal.write_checkpoint(server, 'publication', 0, 0,
+                                     completed=True)
+            phases['publication'] = (Npub + Npubstruc, time.time() - t0)
             self.stdout.write('  Completed transfer of publications\n')
 
         Ncat = 0
         Ncatstruc = 0
+        copy_time = {}
+        copy_count = {}
 
         if write_reaction:
+            t0 = time.time()
             self.stdout.write('Transfering reactions')
-            cur.execute('SELECT max(id) from reaction;')
-            ID = cur.fetchone()[0] or 0
+            # ids from earlier transfers may not have advanced the sequence
+            cur.execute("""SELECT setval('reaction_id_seq', max(id))
+            FROM reaction HAVING max(id) >=
+            (SELECT last_value FROM reaction_id_seq);""")
+            con.commit()
 
             n_react = db.get_last_id(cur_lite)
 
             n_blocks = int(n_react / block_size) + 1
-            t_av = 0
+            blocks = []
             for block_id in range(start_block, n_blocks):
-                reaction_values = []
-                reaction_system_values = []
-                Ncat0 = Ncat
-                Ncatstruc0 = Ncatstruc
-
-                i = block_id - start_block
-                t1 = time.time()
                 b0 = block_id * block_size + 1
-                b1 = (block_id + 1) * block_size + 1
-                if block_id + 1 == n_blocks:
-                    b1 = n_react + 1
-
-                for id_lite in range(b0, b1):
-                    row = db.read(id_lite)
-                    if len(row) == 0:
-                        continue
-                    values = row[0]
-
-                    id = None
-                    update_rs = False
-                    if id is not None:
-                        id = self.update(id, values)
-                        self.stdout.write(
-                            'Updated reaction db with row id = {}\n'
-                            .format(id))
-                        update_rs = True
-                    else:
-                        ID += 1
-                        Ncat += 1
-                        value_list = get_value_list(values)
-                        value_list[0] = ID  # set new ID
-                        reaction_values += [tuple(value_list)]
-                        if write_reaction_system:
-                            cur_lite.execute("SELECT * from reaction_system where id={};"
-                                             .format(id_lite))
-                            rows = cur_lite.fetchall()
-                            if update_rs:
-                                cur.execute("""Delete from reaction_system
-                                where id={0}""".format(id))
-                            for row in rows:
-                                Ncatstruc += 1
-                                values = list(row)
-                                if len(values) == 3:
-                                    values.insert(1, None)
-                                value_list = get_value_list(values)
-                                value_list[3] = ID
-                                reaction_system_values += [tuple(value_list)]
-
-                q = ', '.join('?' * 14)
-                q = '({})'.format(q.replace('?', '%s'))
-
-                key_str = get_key_str()
-                insert_command = """INSERT INTO reaction
-                ({0}) VALUES %s;""".format(key_str)
-
-                execute_values(cur=cur, sql=insert_command,
-                               argslist=reaction_values,
-                               template=q, page_size=block_size)
-
-                key_str = get_key_str('reaction_system')
-                insert_command = """INSERT INTO reaction_system
-                ({0}) VALUES %s ON CONFLICT DO NOTHING;""".format(key_str)
-
-                execute_values(cur=cur, sql=insert_command,
-                               argslist=reaction_system_values,
-                               page_size=1000)
-                con.commit()
-
-                t2 = time.time()
-                dt = t2 - t1
-                t_av = (t_av * i + dt) / (i + 1)
-
-                self.stdout.write(
-                    '  Finnished Block {0} / {1} in {2} sec \n'
-                    .format(block_id + 1, n_blocks, dt))
-                self.stdout.write(
-                    '    Completed transfer of {0} reactions. \n'
-                    .format(Ncat - Ncat0))
-                self.stdout.write('    Estimated time left: {0} sec \n'
-                                  .format(t_av * (n_blocks - block_id - 1)))
-
+                b1 = min((block_id + 1) * block_size, n_react)
+                if b0 <= b1:
+                    blocks.append((block_id, b0, b1))
+
+            def transfer_block(con, b0, b1):
+                return self._transfer_reactions(
+                    con, db, journal, server, b0, b1, done_reactions,
+                    write_reaction_system)
+
+            results = self._transfer_blocks(con, blocks, n_blocks,
+                                            transfer_block, 'reactions',
+                                            workers)
+            for n, stats in results:
+                Ncat += n
+                Ncatstruc += stats['reaction_system'][0]
+                for table, (count, dt) in stats.items():
+                    copy_count[table] = copy_count.get(table, 0) + count
+                    copy_time[table] = copy_time.get(table, 0) + dt
+
+            phases['reaction'] = (sum(copy_count.values()),
+                                  time.time() - t0)
             self.stdout.write('  Completed transfer of reactions\n')
 
-        for statement in tsvector_update:
-            cur.execute(statement)
-
         if self.connection is None:
             con.commit()
-            con.close()
+            self._close(con)
 
         self.stdout.write('Inserted into:\n')
         self.stdout.write('  systems: {0}\n'.format(nrows))
@@ -1010,6 +1631,159 @@ class CathubPostgreSQL:
         self.stdout.write('  reaction: {0}\n'.format(Ncat))
         self.stdout.write('  reaction_system: {0}\n'.format(Ncatstruc))
 
+        if copy_time:
+            self.stdout.write('Throughput:\n')
+        for table in ['reaction', 'reaction_system', 'reaction_species']:
+            if table not in copy_time:
+                continue
+            self.stdout.write(
+                '  {0}: {1} rows in {2:.2f} sec ({3:.0f} rows/sec)\n'.format(
+                    table, copy_count[table], copy_time[table],
+                    copy_count[table] / max(copy_time[table], 1e-6)))
+
+        return phases
+
+    @timed
+    def plan(self, filename_sqlite, block_size=1000, calibration_size=100):
+        """
+        Dry run of transfer: scan the sqlite3 .db file and report the
+        number of rows per table, the size of the atomic structures and
+        how many of them are already on the server, with a projected
+        transfer time from writing a calibration block. The calibration
+        block is written to temporary copies of the tables, which are
+        dropped afterwards, such that the tables and id sequences on the
+        server are not changed.
+
+        Parameters
+        ----------
+        filename_sqlite: str
+            name of .db file
+        block_size: int (default 1000)
+            Number of atomic structures and reactions per transfer block
+        calibration_size: int (default 100)
+            Number of atomic structures and reactions to write for the
+            calibration
+
+        Returns: dict with 'tables' (number of rows per table),
+            'systems_bytes', 'data_bytes', 'existing_systems',
+            'calibration' ((rows, seconds) for 'systems' and 'reaction')
+            and 'projected_seconds'
+        """
+        db = CathubSQLite(filename_sqlite)
+        con_lite = db._connect()
+        cur_lite = con_lite.cursor()
+        tables = {}
+        sqlite_tables = get_tables(cur_lite)
+        for table in ['systems', 'publication', 'publication_system',
+                      'reaction', 'reaction_system', 'reaction_species']:
+            if table in sqlite_tables:
+                cur_lite.execute('SELECT count(*) FROM {0}'.format(table))
+                tables[table] = cur_lite.fetchone()[0]
+
+        con = self.connection or self._connect()
+        self._initialize(con)
+        cur = con.cursor()
+
+        # one pass over the atomic structures, counting serialized bytes
+        # and checking unique ids against the server batch by batch
+        cur_lite.execute('PRAGMA table_info(systems)')
+        columns = [column[1] for column in cur_lite.fetchall()
+                   if column[2] in ['BLOB', 'TEXT']]
+        cur_lite.execute(
+            'SELECT unique_id, {0}, coalesce(length(data), 0) FROM systems'
+            .format(' + '.join('coalesce(length({0}), 0)'.format(column)
+                               for column in columns)))
+        systems_bytes = 0
+        data_bytes = 0
+        existing = set()
+        while True:
+            rows = cur_lite.fetchmany(1000)
+            if not rows:
+                break
+            systems_bytes += sum(row[1] for row in rows)
+            data_bytes += sum(row[2] for row in rows)
+            cur.execute("""SELECT unique_id FROM systems
+            WHERE unique_id = ANY(%s);""", [[row[0] for row in rows]])
+            existing.update(row[0] for row in cur.fetchall())
+
+        # calibrate on temporary copies of the tables, such that the tables
+        # and id sequences on the server are left untouched
+        cur.execute('SAVEPOINT plan_calibration;')
+        for table in ['systems', 'species', 'keys', 'text_key_values',
+                      'number_key_values', 'reaction', 'reaction_system',
+                      'reaction_species']:
+            cur.execute("SELECT to_regclass(%s);", [table])
+            if cur.fetchone()[0] is not None:
+                cur.execute("""CREATE TEMP TABLE plan_{0}
+                (LIKE {0} INCLUDING ALL);""".format(table))
+        calibration = {}
+        rows = []
+        for row in ase.db.connect(filename_sqlite).select():
+            if row.unique_id not in existing:
+                rows.append(row)
+            if len(rows) == calibration_size:
+                break
+        t0 = time.time()
+        self._write_systems(cur, rows, ids=list(range(1, len(rows) + 1)),
+                            prefix='plan_')
+        calibration['systems'] = (len(rows), time.time() - t0)
+
+        reactions = list(db.iter_reactions(
+            where='reaction.id <= ?', params=[calibration_size],
+            batch_size=calibration_size))
+        block_values = get_reaction_block_values(
+            range(1, len(reactions) + 1), reactions)
+        t0 = time.time()
+        for table, table_values in zip(
+                ['reaction', 'reaction_system', 'reaction_species'],
+                block_values):
+            self._copy_rows(cur, table, table_values,
+                            target='plan_' + table)
+        calibration['reaction'] = (len(reactions), time.time() - t0)
+        cur.execute('ROLLBACK TO SAVEPOINT plan_calibration;')
+
+        if self.connection is None:
+            con.rollback()
+            self._close(con)
+
+        n_systems = tables['systems'] - len(existing)
+        n_reactions = tables.get('reaction', 0)
+        projected = 0
+        for phase, n in [('systems', n_systems), ('reaction', n_reactions)]:
+            n_calibration, dt = calibration[phase]
+            if n_calibration > 0:
+                projected += dt / n_calibration * n
+
+        self.stdout.write('Transfer plan for {0}\n'.format(filename_sqlite))
+        self.stdout.write('Rows:\n')
+        for table, n in sorted(tables.items()):
+            self.stdout.write('  {0}: {1}\n'.format(table, n))
+        self.stdout.write(
+            'Atomic structures: {0:.1f} MB, of which {1:.1f} MB data\n'
+            .format(systems_bytes / 1e6, data_bytes / 1e6))
+        self.stdout.write(
+            'Already on {0}: {1} of {2} atomic structures\n'
+            .format(self.get_server_key(), len(existing),
+                    tables['systems']))
+        self.stdout.write('Calibration:\n')
+        for phase, label in [('systems', 'atomic structures'),
+                             ('reaction', 'reactions')]:
+            n, dt = calibration[phase]
+            self.stdout.write('  {0} {1} in {2:.2f} sec\n'.format(
+                n, label, dt))
+        n_blocks = -(-max(n_systems, n_reactions) // block_size)
+        self.stdout.write(
+            'Projected transfer time: {0:.1f} sec in {1} blocks of {2}\n'
+            .format(projected, n_blocks, block_size))
+
+        return {'tables': tables,
+                'systems_bytes': systems_bytes,
+                'data_bytes': data_bytes,
+                'existing_systems': len(existing),
+                'calibration': calibration,
+                'projected_seconds': projected}
+
+    @timed
     def check(self, pub_id, chemical_composition, reactants, products,
               sites=None, reaction_energy=None):
         con = self.connection or self._connect()
@@ -1045,8 +1819,11 @@ class CathubPostgreSQL:
             id = rows[0][0]
         else:
             id = None
+        if self.connection is None:
+            self._close(con)
         return id
 
+    @timed
     def publication_status(self):
         con = self.connection or self._connect()
         self._initialize(con)
@@ -1060,6 +1837,8 @@ class CathubPostgreSQL:
         publication -> 'doi' is null;"""
         cur.execute(select_statement)
         pubs = cur.fetchall()
+        if self.connection is None:
+            self._close(con)
 
         return pubs
 
@@ -1077,6 +1856,8 @@ def get_key_list(table='reaction', start_index=0):
                 'reaction_system': ['name', 'energy_correction',
                                     'ase_id', 'id'],
                 'publication_system': ['ase_id, pub_id'],
+                'reaction_species': ['reaction_id', 'species', 'state',
+                                     'prefactor', 'side'],
                 'systems': ['id', 'unique_id', 'ctime', 'mtime', 'username',
                             'numbers', 'positions', 'cell', 'pbc',
                             'initial_magmoms', 'initial_charges', 'masses',
@@ -1089,12 +1870,171 @@ def get_key_list(table='reaction', start_index=0):
     return key_list[table][start_index:]
 
 
+def get_system_values(db_ase, id, row, mtime):
+    """
+    Values for the columns in get_key_list('systems') from an AtomsRow
+    object, encoded as in the ASE postgresql backend.
+
+    Parameters
+    ----------
+    db_ase: ase.db.postgresql.PostgreSQLDatabase object
+    id: int
+        new id of row
+    row: AtomsRow object
+    mtime: float
+        modification time
+    """
+    blob = db_ase.blob
+    encode = db_ase.encode
+
+    constraints = row._constraints
+    if constraints:
+        if isinstance(constraints, list):
+            constraints = encode(constraints)
+    else:
+        constraints = None
+
+    if 'calculator' in row:
+        calculator = row.calculator
+        calculator_parameters = encode(row.calculator_parameters)
+    else:
+        calculator = None
+        calculator_parameters = None
+
+    data = row._data
+    if not isinstance(data, str):
+        # decoded dict, or binary blob of newer ASE versions
+        data = encode(dict(row.data))
+
+    return (id,
+            row.unique_id,
+            row.ctime,
+            mtime,
+            row.user,
+            blob(row.numbers),
+            blob(row.positions),
+            blob(row.cell),
+            int(np.dot(row.pbc, [1, 2, 4])),
+            blob(row.get('initial_magmoms')),
+            blob(row.get('initial_charges')),
+            blob(row.get('masses')),
+            blob(row.get('tags')),
+            blob(row.get('momenta')),
+            constraints,
+            calculator,
+            calculator_parameters,
+            row.get('energy'),
+            row.get('free_energy'),
+            blob(row.get('forces')),
+            blob(row.get('stress')),
+            blob(row.get('dipole')),
+            blob(row.get('magmoms')),
+            row.get('magmom'),
+            blob(row.get('charges')),
+            encode(row.key_value_pairs),
+            data,
+            len(row.numbers),
+            float_if_not_none(row.get('fmax')),
+            float_if_not_none(row.get('smax')),
+            float_if_not_none(row.get('volume')),
+            float(row.mass),
+            float(row.charge))
+
+
 def get_key_str(table='reaction', start_index=0):
     key_str = """, """.join(get_key_list(table, start_index))
 
     return key_str
 
 
+def load_json(value):
+    """Load json text from sqlite3 files. Dicts are returned as is."""
+    if value is None or isinstance(value, dict):
+        return value
+    return json.loads(value)
+
+
+def get_reaction_block_values(ids, reactions, write_reaction_system=True):
+    """
+    Rows of the reaction, reaction_system and reaction_species tables for
+    a block of reactions of CathubSQLite.iter_reactions, with new ids.
+
+    Returns: lists of reaction, reaction_system and reaction_species values
+    """
+    reaction_values = []
+    reaction_system_values = []
+    species_values = []
+    for ID, (values, rows) in zip(ids, reactions):
+        value_list = get_value_list(values)
+        value_list[0] = ID  # set new ID
+        reaction_values += [tuple(value_list)]
+        species_values += [
+            tuple([ID] + species_row) for species_row in
+            get_species_values(load_json(values[6]),
+                               load_json(values[7]))]
+        if write_reaction_system:
+            ase_ids = set()
+            for row in rows:
+                values = list(row)
+                if len(values) == 3:
+                    values.insert(1, None)
+                if values[2] in ase_ids:  # primary key (id, ase_id)
+                    continue
+                ase_ids.add(values[2])
+                value_list = get_value_list(values)
+                value_list[3] = ID
+                reaction_system_values += [tuple(value_list)]
+    return reaction_values, reaction_system_values, species_values
+
+
+def merge_ranges(ranges):
+    """
+    Merge (start, end) ranges of ids, with end included.
+
+    Returns: sorted lists of starts and ends of disjoint ranges
+    """
+    starts = []
+    ends = []
+    for start, end in sorted(ranges):
+        if starts and start <= ends[-1] + 1:
+            ends[-1] = max(ends[-1], end)
+        else:
+            starts.append(start)
+            ends.append(end)
+    return starts, ends
+
+
+def in_ranges(id, ranges):
+    """Check if id is in ranges from merge_ranges()"""
+    starts, ends = ranges
+    i = bisect.bisect_right(starts, id) - 1
+    return i >= 0 and id <= ends[i]
+
+
+def get_copy_buffer(rows):
+    """
+    Serialize rows to the text format of postgreSQL COPY: tab separated
+    columns, one row per line and \\N for NULL.
+    """
+    buffer = six.StringIO()
+    for row in rows:
+        buffer.write('\t'.join(get_copy_value(v) for v in row))
+        buffer.write('\n')
+    buffer.seek(0)
+    return buffer
+
+
+def get_copy_value(value):
+    if value is None:
+        return '\\N'
+    if isinstance(value, float):
+        value = repr(value)
+    elif not isinstance(value, six.string_types):
+        value = str(value)
+    return value.replace('\\', '\\\\').replace('\t', '\\t')\
+        .replace('\n', '\\n').replace('\r', '\\r')
+
+
 def get_value_list(values, start_index=0):
     value_list = []
     for v in values:
@@ -0,0 +1,380 @@
+import os
+import sys
+import time
+import shutil
+import sqlite3
+import tempfile
+import unittest
+import ase.db
+from ase import Atoms
+from click.testing import CliRunner
+from cathub.cathubsqlite import CathubSQLite, index_commands
+
+
+def get_reaction_values(i, pub_id='DoeFancy2017'):
+    """Synthetic reaction for adsorption of O on a Pt slab"""
+    return {'chemical_composition': 'Pt16',
+            'surface_composition': 'Pt',
+            'facet': '111',
+            'sites': {'O': 'fcc'},
+            'coverages': None,
+            'reactants': {'O2gas': 0.5, 'star': 1.0},
+            'products': {'Ostar': 1.0},
+            'reaction_energy': -1.0 + i * 1e-4,
+            'activation_energy': None,
+            'dft_code': 'Quantum ESPRESSO',
+            'dft_functional': 'BEEF-vdW',
+            'username': 'doe@stanford.edu',
+            'pub_id': pub_id,
+            'ase_ids': {'O2gas': 'gas{}'.format(i % 3),
+                        'star': 'slab{}'.format(i % 7),
+                        'Ostar': 'ads{}'.format(i)},
+            'energy_corrections': {'O2gas': 0.1}}
+
+
+def get_publication_values(pub_id):
+    return {'pub_id': pub_id,
+            'title': 'Fancy title',
+            'authors': ['Doe, John'],
+            'journal': 'JACS',
+            'volume': '1',
+            'number': '1',
+            'pages': '23-42',
+            'year': 2017,
+            'publisher': 'ACS',
+            'doi': None,
+            'tags': []}
+
+
+def dump_tables(filename):
+    db = CathubSQLite(filename)
+    con = db._connect()
+    tables = {}
+    for table in ['reaction', 'reaction_system', 'publication_system']:
+        tables[table] = sorted(con.execute(
+            'SELECT * FROM {}'.format(table)).fetchall(), key=str)
+    con.close()
+    return tables
+
+
+class CathubSQLiteTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def get_db(self, name):
+        return CathubSQLite(os.path.join(self.tempdir, name))
+
+    def test_write_many(self):
+        db1 = self.get_db('single.db')
+        with db1:
+            ids1 = [db1.write(get_reaction_values(i)) for i in range(50)]
+
+        db2 = self.get_db('many.db')
+        ids2 = db2.write_many((get_reaction_values(i) for i in range(50)),
+                              batch_size=16)
+        self.assertEqual(ids1, ids2)
+        self.assertEqual(dump_tables(db1.filename), dump_tables(db2.filename))
+
+        ids3 = db2.write_many([get_reaction_values(50)])
+        self.assertEqual(ids3, [51])
+        self.assertEqual(db2.write(get_reaction_values(51)), 52)
+
+    def test_write_many_benchmark(self):
+        n = 500
+        db1 = self.get_db('single.db')
+        t0 = time.time()
+        ids1 = [db1.write(get_reaction_values(i)) for i in range(n)]
+        rate_single = n / (time.time() - t0)
+
+        db2 = self.get_db('many.db')
+        t0 = time.time()
+        ids2 = db2.write_many(get_reaction_values(i) for i in range(n))
+        rate_many = n / (time.time() - t0)
+
+        # throughput is only reported, since timings vary between machines
+        sys.stdout.write('write: {0:.0f} rows/sec, write_many: {1:.0f} '
+                         'rows/sec\n'.format(rate_single, rate_many))
+        self.assertEqual(ids1, list(range(1, n + 1)))
+        self.assertEqual(ids2, ids1)
+        self.assertEqual(dump_tables(db1.filename), dump_tables(db2.filename))
+
+    def test_update_many(self):
+        db1 = self.get_db('single.db')
+        db2 = self.get_db('many.db')
+        for db in [db1, db2]:
+            db.write_many(get_reaction_values(i) for i in range(20))
+
+        values_list = []
+        for i in range(20):
+            values = get_reaction_values(i + 1)
+            values['facet'] = "1'1'1"  # quotes broke the old update
+            values_list.append(values)
+        with db1:
+            for i, values in enumerate(values_list):
+                db1.update(i + 1, values)
+        db2.update_many(list(range(1, 21)), values_list, batch_size=7)
+        self.assertEqual(dump_tables(db1.filename), dump_tables(db2.filename))
+
+        row = db2.read(20)[0]
+        self.assertEqual(row[3], "1'1'1")
+        self.assertEqual(row[8], -1.0 + 20 * 1e-4)
+
+    def test_update_many_benchmark(self):
+        n = 500
+        rates = []
+        dbs = []
+        for name in ['single.db', 'many.db']:
+            db = self.get_db(name)
+            db.write_many(get_reaction_values(i) for i in range(n))
+            t0 = time.time()
+            if name == 'single.db':
+                for i in range(n):
+                    db.update(i + 1, get_reaction_values(i + 1))
+            else:
+                db.update_many(list(range(1, n + 1)),
+                               [get_reaction_values(i + 1) for i in range(n)])
+            rates.append(n / (time.time() - t0))
+            dbs.append(db)
+
+        # throughput is only reported, since timings vary between machines
+        sys.stdout.write('update: {0:.0f} rows/sec, update_many: {1:.0f} '
+                         'rows/sec\n'.format(*rates))
+        for db in dbs:
+            self.assertEqual(db.read(1)[0][8], -1.0 + 1e-4)
+        self.assertEqual(dump_tables(dbs[0].filename),
+                         dump_tables(dbs[1].filename))
+
+    def test_iter_reactions(self):
+        db = self.get_db('iter.db')
+        db.write_many(get_reaction_values(i) for i in range(25))
+        reactions = list(db.iter_reactions(batch_size=4))
+        self.assertEqual([row[0] for row, systems in reactions],
+                         list(range(1, 26)))
+        for row, systems in reactions:
+            self.assertEqual(len(systems), 3)
+            self.assertTrue(all(system[3] == row[0] for system in systems))
+
+        reactions = list(db.iter_reactions(
+            where='reaction.reaction_energy < ?', params=[-0.999],
+            batch_size=3))
+        self.assertEqual([row[0] for row, systems in reactions],
+                         list(range(1, 11)))
+
+        reactions = list(db.iter_reactions(
+            where='reaction.id IN (2, 24)', batch_size=2))
+        self.assertEqual([[system[3] for system in systems]
+                          for row, systems in reactions], [[2] * 3, [24] * 3])
+
+    def assert_uses_index(self, con, statement, arguments, index):
+        plan = con.execute('EXPLAIN QUERY PLAN ' + statement,
+                           arguments).fetchall()
+        details = ' '.join(row[-1] for row in plan)
+        self.assertIn('USING INDEX {}'.format(index), details)
+
+    def test_indexes(self):
+        db = self.get_db('indexes.db')
+        db.write_many(get_reaction_values(i) for i in range(20))
+        con = db._connect()
+        self.assert_uses_index(
+            con, """SELECT reaction.id FROM reaction WHERE
+            reaction.chemical_composition=? and reaction.reaction_energy=?""",
+            ['Pt16', -1.0], 'idx')
+        self.assert_uses_index(
+            con, 'SELECT * from reaction_system where id=?', [3],
+            'idxreacsys')
+        self.assert_uses_index(
+            con, 'SELECT * from publication_system where ase_id=?', ['ads3'],
+            'idxpubsys')
+        con.close()
+
+    def test_migrate(self):
+        from cathub.cli import db_migrate
+        db = self.get_db('old.db')
+        db.write(get_reaction_values(0))
+        con = db._connect()
+        for index_command in index_commands:
+            name = index_command.split()[5]
+            con.execute('DROP INDEX {}'.format(name))
+        con.commit()
+        con.close()
+
+        runner = CliRunner()
+        result = runner.invoke(db_migrate, [db.filename])
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn('idxreacsys', result.output)
+        self.assertEqual(db.migrate(), [])
+
+    def test_species(self):
+        db = self.get_db('species.db')
+        db.write_many(get_reaction_values(i) for i in range(3))
+        values = get_reaction_values(3)
+        values.update({'chemical_composition': 'Cu16',
+                       'reactants': {'star': 1.0, 'COgas': 1.0},
+                       'products': {'COstar': 1.0},
+                       'ase_ids': {'COgas': 'gas3', 'star': 'slab3',
+                                   'COstar': 'ads3'}})
+        id = db.write(values)
+
+        self.assertEqual(db.get_species_reaction_ids('O', state='star',
+                                                     side='products'),
+                         [1, 2, 3])
+        self.assertEqual(db.get_species_reaction_ids(
+            '', side='reactants', where='reaction.chemical_composition=?',
+            params=['Cu16']), [id])
+        self.assertEqual(db.get_species_reaction_ids('O', side='reactants'),
+                         [])
+
+        # Key order of reactants and products doesn't matter
+        reactants = {'COgas': 1, 'star': 1}
+        self.assertEqual(db.check_reaction_on_surface(
+            'Cu16', reactants, {'COstar': 1}), id)
+        self.assertIsNone(db.check_reaction_on_surface(
+            'Cu16', reactants, {'COstar': 2}))
+
+        values['products'] = {'Ostar': 1.0, 'Cstar': 1.0}
+        values['ase_ids'] = {'COgas': 'gas3', 'star': 'slab3',
+                             'Ostar': 'ads3', 'Cstar': 'ads4'}
+        db.update(id, values)
+        self.assertEqual(db.get_species_reaction_ids('CO', state='star'), [])
+        self.assertEqual(db.get_species_reaction_ids('C'), [id])
+
+        con = db._connect()
+        con.execute('DROP TABLE reaction_species')
+        con.commit()
+        con.close()
+
+        db = CathubSQLite(db.filename)
+        self.assertEqual(db.check_reaction_on_surface(
+            'Cu16', reactants, {'Cstar': 1, 'Ostar': 1}), id)
+        self.assertIn('reaction_species', db.migrate())
+        self.assertEqual(db.get_species_reaction_ids('O', state='star',
+                                                     side='products'),
+                         [1, 2, 3, 4])
+
+    def test_merge(self):
+        from cathub.cli import merge
+        db1 = self.get_db('DoeFancy2017.db')
+        db1.write_many(get_reaction_values(i) for i in range(10))
+        db1.write_publication(get_publication_values('DoeFancy2017'))
+        ase_db = ase.db.connect(db1.filename)
+        for i in range(3):
+            ase_db.write(Atoms('H', [[0, 0, i]]), name='H{}'.format(i))
+        db2 = self.get_db('DoeFancier2018.db')
+        shutil.copy(db1.filename, db2.filename)
+        db2.write_many(get_reaction_values(i, pub_id='DoeFancier2018')
+                       for i in range(5))
+        db2.write_publication(get_publication_values('DoeFancier2018'))
+        ase.db.connect(db2.filename).write(Atoms('O'), name='O')
+
+        out = self.get_db('out.db')
+        counts = out.merge(db2.filename)
+        self.assertEqual(counts['reaction'], 15)
+        self.assertEqual(counts['systems'], 4)
+        result = CliRunner().invoke(merge, [out.filename, db1.filename,
+                                            db2.filename])
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn('0 systems, 0 publication, 0 reaction', result.output)
+
+        tables = dump_tables(out.filename)
+        self.assertEqual(len(tables['reaction']), 15)
+        self.assertEqual(len(tables['reaction_system']), 45)
+        self.assertEqual(out.get_species_reaction_ids('O', state='star'),
+                         list(range(1, 16)))
+        ase_db = ase.db.connect(out.filename)
+        self.assertEqual(ase_db.count(), 4)
+        self.assertEqual(ase_db.get(name='O').formula, 'O')
+        self.assertEqual(ase_db.count('H'), 3)
+
+        # New reactions are appended
+        db1.write(get_reaction_values(10))
+        self.assertEqual(out.merge(db1.filename)['reaction'], 1)
+        self.assertEqual(out.read(16)[0][8], -1.0 + 10 * 1e-4)
+
+    def test_session(self):
+        db = CathubSQLite(os.path.join(self.tempdir, 'session.db'),
+                          session=True, synchronous='OFF')
+        with db:
+            con = db.connection
+            db.write(get_reaction_values(0))
+            with db:
+                db.write(get_reaction_values(1))
+        self.assertIs(db.connection, con)
+        self.assertEqual(
+            con.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+        self.assertEqual(con.execute('PRAGMA synchronous').fetchone()[0], 0)
+        self.assertEqual(len(dump_tables(db.filename)['reaction']), 2)
+        db.close()
+        self.assertIsNone(db.connection)
+        con = sqlite3.connect(db.filename)
+        self.assertEqual(
+            con.execute('PRAGMA journal_mode').fetchone()[0], 'delete')
+        con.close()
+        self.assertFalse(os.path.exists(db.filename + '-wal'))
+
+        db2 = CathubSQLite(db.filename, session=True)
+        with db2:
+            db2.write(get_reaction_values(2))
+        self.assertTrue(db2.initialized)
+        db2.close()
+
+        os.remove(db.filename)  # a new file should be initialized again
+        db3 = CathubSQLite(db.filename, session=True)
+        with db3:
+            self.assertEqual(db3.write(get_reaction_values(3)), 1)
+        db3.close()
+
+    def test_session_ase_db(self):
+        db = CathubSQLite(os.path.join(self.tempdir, 'session_ase.db'),
+                          session=True)
+        with db:
+            db_ase = db.get_ase_db()
+            id = db_ase.write(Atoms('H'), name='H')
+            db_ase.update(id, state='gas')  # uncommitted row
+            self.assertEqual(db_ase.get(id).state, 'gas')
+            db.write(get_reaction_values(0))
+        self.assertIs(db_ase.connection, db.connection)
+        self.assertEqual(ase.db.connect(db.filename).count(), 1)
+
+        try:
+            with db:
+                db_ase.write(Atoms('O'))
+                with db_ase.managed_connection(commit_frequency=1):
+                    pass  # no commit within the session
+                raise RuntimeError
+        except RuntimeError:
+            pass
+        db.close()
+        self.assertEqual(ase.db.connect(db.filename).count(), 1)
+
+    def test_checkpoints(self):
+        from cathub.postgresql import merge_ranges, in_ranges
+        db = self.get_db('journal.db')
+        db.write(get_reaction_values(0))
+        server = 'upload@localhost/catalysishub'
+        db.write_checkpoint(server, 'reaction', 1, 10, 101, 110,
+                            completed=True)
+        db.write_checkpoint(server, 'reaction', 11, 20, 111, 120)
+        db.write_checkpoint('other', 'reaction', 1, 10, completed=True)
+        self.assertEqual(db.get_checkpoints(server),
+                         [('reaction', 1, 10, 101, 110, True),
+                          ('reaction', 11, 20, 111, 120, False)])
+        db.write_checkpoint(server, 'reaction', 11, 20, 111, 120,
+                            completed=True)
+        db.delete_checkpoints(server, 'reaction', 1)
+        self.assertEqual(db.get_checkpoints(server, 'reaction'),
+                         [('reaction', 11, 20, 111, 120, True)])
+        db.delete_checkpoints(server)
+        self.assertEqual(db.get_checkpoints(server), [])
+        self.assertEqual(len(db.get_checkpoints('other')), 1)
+
+        ranges = merge_ranges([(21, 30), (1, 10), (11, 15), (40, 41)])
+        self.assertEqual(ranges, ([1, 21, 40], [15, 30, 41]))
+        self.assertEqual([id for id in range(45) if in_ranges(id, ranges)],
+                         list(range(1, 16)) + list(range(21, 31)) + [40, 41])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+import os
+import io
+import shutil
+import tempfile
+import unittest
+from click.testing import CliRunner
+from cathub.cathubsqlite import CathubSQLite
+from cathub.export import export_reactions
+from test_cathubsqlite import get_reaction_values
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+
+@unittest.skipIf(pa is None, 'pyarrow is not installed')
+class ExportTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.db = CathubSQLite(os.path.join(self.tempdir, 'export.db'))
+        values = get_reaction_values(0)
+        values.update({'reactants': {'COgas': 1.0, 'star': 1.0},
+                       'products': {'COstar': 1.0},
+                       'ase_ids': {'COgas': 'gas0', 'star': 'slab0',
+                                   'COstar': 'ads0'}})
+        self.db.write(values)
+        self.db.write_many(get_reaction_values(i) for i in range(1, 25))
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def check_table(self, table):
+        self.assertEqual(table.num_rows, 25)
+        self.assertEqual(table.column('id').to_pylist(), list(range(1, 26)))
+        self.assertEqual(table.schema.field('reaction_energy').type,
+                         pa.float64())
+        for name in ['reactant_COgas', 'reactant_O2gas', 'reactant_star',
+                     'product_COstar', 'product_Ostar']:
+            self.assertEqual(table.schema.field(name).type, pa.float64())
+
+        self.assertEqual(table.column('reactant_O2gas').to_pylist()[:2],
+                         [None, 0.5])
+        self.assertEqual(table.column('product_COstar').to_pylist()[:2],
+                         [1.0, None])
+        self.assertEqual(table.column('equation').to_pylist()[1],
+                         '0.5O2(g) + * -> O*')
+        self.assertAlmostEqual(table.column('reaction_energy')[24].as_py(),
+                               -1.0 + 24 * 1e-4)
+
+    def test_parquet(self):
+        filename = os.path.join(self.tempdir, 'reactions.parquet')
+        n = export_reactions(self.db, filename, batch_size=10,
+                             stdout=io.StringIO())
+        self.assertEqual(n, 25)
+        self.assertEqual(pq.ParquetFile(filename).num_row_groups, 3)
+        self.check_table(pq.read_table(filename))
+
+    def test_arrow(self):
+        from cathub.cli import export
+        filename = os.path.join(self.tempdir, 'reactions.arrow')
+        result = CliRunner().invoke(export, [self.db.filename, filename,
+                                             '--format', 'arrow',
+                                             '--batch-size', '7'])
+        self.assertEqual(result.exit_code, 0)
+        with pa.memory_map(filename) as source:
+            self.check_table(pa.ipc.open_file(source).read_all())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,223 @@
+import os
+import io
+import glob
+import shutil
+import sqlite3
+import tempfile
+import unittest
+import ase.db
+import ase.io
+from ase import Atoms
+from ase.calculators.singlepoint import SinglePointCalculator
+from cathub.folderreader import FolderReader
+from cathub.ase_tools import write_ase, check_in_ase, \
+    read_structure_header
+from cathub.cathubsqlite import CathubSQLite
+from cathub.dedup import DuplicateIndex
+from cathub.parsecache import ParseCache
+
+path = os.path.abspath(os.path.join(os.path.dirname(__file__)))
+
+
+def count_rows(filename):
+    con = sqlite3.connect(filename)
+    counts = {}
+    for table in ['systems', 'reaction', 'reaction_system',
+                  'publication_system']:
+        counts[table] = con.execute(
+            'SELECT COUNT(*) FROM {}'.format(table)).fetchone()[0]
+    con.close()
+    return counts
+
+
+class FolderReaderTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.folder = os.path.join(self.tempdir, 'aayush')
+        shutil.copytree(os.path.join(path, 'aayush'), self.folder)
+        for filename in glob.glob(self.folder + '/*.db') + \
+                glob.glob(self.folder + '/.cache.db'):
+            os.remove(filename)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def read_folder(self, **kwargs):
+        FR = FolderReader(self.folder, stdout=io.StringIO(),
+                          userhandle='tester', **kwargs)
+        FR.write()
+        return FR
+
+    def test_no_duplicates(self):
+        FR = self.read_folder()
+        counts = count_rows(FR.cathub_db)
+        self.assertEqual(counts['reaction'], 40)
+
+        index = DuplicateIndex()
+        index.load(CathubSQLite(FR.cathub_db))
+        self.assertEqual(len(index.atoms), counts['systems'])
+        self.assertEqual(len(index.reactions), counts['reaction'])
+
+        FR = self.read_folder()
+        self.assertEqual(count_rows(FR.cathub_db), counts)
+        self.assertIn('Updated reaction db row id = 40',
+                      FR.stdout.getvalue())
+
+    def test_jobs(self):
+        FR = self.read_folder()
+        counts = count_rows(FR.cathub_db)
+        reactions = [values for values, rows in
+                     CathubSQLite(FR.cathub_db).iter_reactions()]
+        os.remove(FR.cathub_db)
+
+        FR = self.read_folder(jobs=2)
+        self.assertEqual(FR.parsed_structures, {})  # all picked up
+        self.assertEqual(count_rows(FR.cathub_db), counts)
+        self.assertEqual([values for values, rows in
+                          CathubSQLite(FR.cathub_db).iter_reactions()],
+                         reactions)
+
+    def test_jobs_publications(self):
+        pub_folder = os.path.join(self.folder, 'montoya_the_2016')
+        shutil.copytree(os.path.join(self.folder, 'montoya_the_2015'),
+                        pub_folder)
+        with open(os.path.join(pub_folder, 'publication.txt')) as f:
+            publication = f.read()
+        with open(os.path.join(pub_folder, 'publication.txt'), 'w') as f:
+            f.write(publication.replace('"2015"', '"2016"'))
+
+        FR = self.read_folder(jobs=2)
+        output = FR.stdout.getvalue()
+        # each publication reads its own files once
+        self.assertEqual(output.count('Reading 45 files with 2 processes'),
+                         2)
+        self.assertEqual(FR.parsed_structures, {})
+
+    def test_parse_cache(self):
+        FR = self.read_folder(use_cache=True)
+        counts = count_rows(FR.cathub_db)
+        cache = ParseCache(os.path.join(self.folder, '.cache.db'),
+                           headers=True)
+        filenames = [row[0] for row in cache._connect().execute(
+            'SELECT filename FROM parsed_header WHERE structure IS NOT NULL')]
+        self.assertEqual(len(filenames), 45)
+        self.assertEqual(cache._connect().execute(
+            'SELECT COUNT(*) FROM parsed_header WHERE sha1 IS NOT NULL')
+            .fetchone()[0], 0)  # not hashed on a cold run
+
+        filename = filenames[0]
+        os.utime(filename, (0, 0))
+        self.assertEqual(cache.get(filename), (False, None))  # no hash
+        cache.read_structure(filename)
+        os.utime(filename, (1, 1))  # same content
+        found, atoms = cache.get(filename)
+        self.assertTrue(found)
+        self.assertEqual(atoms.info['filename'], filename)
+        self.assertEqual(cache.get(filename)[1].get_potential_energy(),
+                         atoms.get_potential_energy())
+        with open(filename, 'a') as f:
+            f.write('\n')
+        self.assertEqual(cache.get(filename), (False, None))
+        cache.close()
+
+        os.remove(FR.cathub_db)
+        FR = self.read_folder(jobs=2, use_cache=True)
+        self.assertEqual(count_rows(FR.cathub_db), counts)
+        self.assertIn('Reading 1 files with 2 processes',
+                      FR.stdout.getvalue())
+
+    def test_incremental(self):
+        FR = self.read_folder(incremental=True)
+        counts = count_rows(FR.cathub_db)
+        fingerprints = CathubSQLite(FR.cathub_db).get_fingerprints()
+        self.assertEqual(len(fingerprints), 44)  # metals, facets, reactions
+
+        FR = self.read_folder(incremental=True)
+        self.assertEqual(count_rows(FR.cathub_db), counts)
+        self.assertEqual(FR.stdout.getvalue().count(
+            'Skipping unchanged folder'), 2)  # both metals
+        self.assertNotIn('reaction db row id', FR.stdout.getvalue())
+
+        facet = glob.glob(self.folder + '/*/*/*/Pt_fcc/111')[0]
+        reactions = sorted(glob.glob(facet + '/*/'))
+        filename = glob.glob(reactions[0] + '/*')[0]
+        os.utime(filename, (0, 0))
+        shutil.rmtree(reactions[1])
+        FR = self.read_folder(incremental=True)
+        output = FR.stdout.getvalue()
+        # other metal and other reactions on the facet
+        self.assertEqual(output.count('Skipping unchanged folder'),
+                         1 + len(reactions) - 2)
+        self.assertEqual(output.count('Updated reaction db row id'), 1)
+        self.assertIn('Deleted 1 reactions', output)
+        self.assertEqual(count_rows(FR.cathub_db)['reaction'], 39)
+        self.assertEqual(len(CathubSQLite(FR.cathub_db).get_fingerprints()),
+                         43)
+
+    def test_read_structure_header(self):
+        filenames = glob.glob(self.folder + '/*/*/*/*/*/*/*.traj')
+        filenames.append(os.path.join(path, 'unorganized', 'ads.traj'))
+        self.assertGreater(len(filenames), 10)
+        for filename in filenames:
+            header = read_structure_header(filename)
+            atoms = ase.io.read(filename)
+            self.assertIsNone(header._atoms)  # not read with ase.io.read
+            self.assertEqual(header.info['filename'], filename)
+            self.assertEqual(list(header.get_atomic_numbers()),
+                             list(atoms.get_atomic_numbers()))
+            self.assertEqual(header.get_chemical_formula(mode='metal'),
+                             atoms.get_chemical_formula(mode='metal'))
+            self.assertTrue((header.cell == atoms.cell).all())
+            self.assertEqual(header.get_potential_energy(),
+                             atoms.get_potential_energy())
+            self.assertTrue((header.get_atoms().positions ==
+                             atoms.positions).all())
+        self.assertIsNone(read_structure_header(
+            os.path.join(path, 'unorganized', 'OUTCAR')))
+
+    def test_write_ase(self):
+        filename = os.path.join(self.tempdir, 'structures.db')
+        CathubSQLite(filename).migrate()  # index on structure_hash
+        stdout = io.StringIO()
+
+        def get_atoms(z=1.0, energy=-10.0):
+            atoms = Atoms('CO', positions=[[0, 0, 0], [0, 0, z]],
+                          cell=[5, 5, 5], pbc=True)
+            atoms.set_calculator(SinglePointCalculator(atoms, energy=energy))
+            return atoms
+
+        id, unique_id = write_ase(get_atoms(), filename, stdout,
+                                  return_id=True, name='CO')
+        self.assertEqual(ase.db.connect(filename).get(id).unique_id,
+                         unique_id)
+        self.assertEqual(write_ase(get_atoms(1.0 + 1e-6), filename, stdout),
+                         unique_id)
+        self.assertEqual(check_in_ase(get_atoms(), filename),
+                         (id, unique_id))
+        self.assertEqual(check_in_ase(get_atoms(energy=-9.0), filename),
+                         (None, None))
+        self.assertNotEqual(write_ase(get_atoms(1.1), filename, stdout),
+                            unique_id)
+        self.assertEqual(ase.db.connect(filename).count(), 2)
+
+    def test_migrate_structure_hash(self):
+        filename = os.path.join(self.tempdir, 'old.db')
+        stdout = io.StringIO()
+        atoms = Atoms('CO', positions=[[0, 0, 0], [0, 0, 1.1]],
+                      cell=[5, 5, 5], pbc=True)
+        atoms.set_calculator(SinglePointCalculator(atoms, energy=-10.0))
+        id = ase.db.connect(filename).write(atoms)  # written without hash
+        ase.db.connect(filename).write(Atoms('H'))  # no energy
+        self.assertEqual(check_in_ase(atoms, filename), (None, None))
+
+        db = CathubSQLite(filename)
+        self.assertIn('structure_hash', db.migrate())
+        unique_id = ase.db.connect(filename).get(id).unique_id
+        self.assertEqual(check_in_ase(atoms, filename), (id, unique_id))
+        self.assertEqual(write_ase(atoms, filename, stdout), unique_id)
+        self.assertEqual(ase.db.connect(filename).count(), 2)
+        self.assertNotIn('structure_hash', db.migrate())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,339 @@
+"""Upload benchmarks against a throwaway local postgreSQL server.
+
+The server is set up with initdb and pg_ctl in a temporary directory, so
+the postgreSQL binaries must be on PATH, or in the PG_BIN directory.
+When run as root, the server is run as the CATHUB_BENCHMARK_PG_USER user
+(nobody by default), since postgreSQL refuses to run as root. The number
+of reactions in the synthetic publication is set with
+CATHUB_BENCHMARK_SIZE, and rows/sec per phase are written as json to
+CATHUB_BENCHMARK_OUTPUT if set:
+
+    CATHUB_BENCHMARK_SIZE=10000 python -m pytest -s test_upload_benchmark.py
+"""
+import os
+import io
+import sys
+import json
+import time
+import socket
+import shutil
+import tempfile
+import subprocess
+import unittest
+
+import ase.build
+import ase.db
+from ase import Atoms
+from ase.db.core import now
+from ase.db.row import AtomsRow
+from ase.calculators.singlepoint import SinglePointCalculator
+
+from cathub.cathubsqlite import CathubSQLite
+from cathub.postgresql import CathubPostgreSQL, close_pools
+from cathub.ase_tools import write_ase
+
+import psycopg2
+
+
+def find_pg_bin(name):
+    directories = os.environ.get('PATH', '').split(os.pathsep)
+    if os.environ.get('PG_BIN'):
+        directories.insert(0, os.environ['PG_BIN'])
+    for directory in directories:
+        filename = os.path.join(directory, name)
+        if os.path.isfile(filename) and os.access(filename, os.X_OK):
+            return filename
+    return None
+
+
+def get_free_port():
+    sock = socket.socket()
+    sock.bind(('localhost', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def get_set_user(user):
+    """preexec_fn for subprocess, which runs the command as user"""
+    import pwd
+    entry = pwd.getpwnam(user)
+
+    def set_user():
+        os.setgid(entry.pw_gid)
+        os.setuid(entry.pw_uid)
+    return set_user, entry.pw_uid, entry.pw_gid
+
+
+class LocalPostgreSQL:
+    """Throwaway postgreSQL server with trust authentication for the
+    postgres user, set up in a temporary directory"""
+
+    def __init__(self, database='catalysishub_benchmark'):
+        self.database = database
+        self.directory = None
+        self.port = None
+        self.preexec_fn = None
+        self.devnull = open(os.devnull, 'w')
+
+    def initdb(self):
+        self.directory = tempfile.mkdtemp()
+        if hasattr(os, 'geteuid') and os.geteuid() == 0:
+            self.preexec_fn, uid, gid = get_set_user(
+                os.environ.get('CATHUB_BENCHMARK_PG_USER', 'nobody'))
+            os.chown(self.directory, uid, gid)
+        subprocess.check_call(
+            [find_pg_bin('initdb'), '-D',
+             os.path.join(self.directory, 'data'), '-U', 'postgres',
+             '-A', 'trust'], stdout=self.devnull, stderr=self.devnull,
+            preexec_fn=self.preexec_fn)
+
+    def start(self):
+        self.port = get_free_port()
+        subprocess.check_call(
+            [find_pg_bin('pg_ctl'), '-D',
+             os.path.join(self.directory, 'data'), '-w',
+             '-l', os.path.join(self.directory, 'server.log'),
+             '-o', '-p {0} -k {1} -c listen_addresses=localhost'
+             .format(self.port, self.directory), 'start'],
+            stdout=self.devnull, preexec_fn=self.preexec_fn)
+        con = psycopg2.connect(host='localhost', port=self.port,
+                               user='postgres', database='postgres')
+        con.autocommit = True
+        con.cursor().execute('CREATE DATABASE {0};'.format(self.database))
+        con.close()
+
+    def stop(self):
+        close_pools()
+        if self.port is not None:
+            subprocess.call(
+                [find_pg_bin('pg_ctl'), '-D',
+                 os.path.join(self.directory, 'data'), '-m', 'fast', '-w',
+                 'stop'], stdout=self.devnull, preexec_fn=self.preexec_fn)
+        self.devnull.close()
+        if self.directory is not None:
+            shutil.rmtree(self.directory)
+
+    def get_db(self, schema='public'):
+        return CathubPostgreSQL(user='postgres', server='localhost',
+                                port=self.port, database=self.database,
+                                schema=schema, stdout=io.StringIO())
+
+
+def make_publication(filename, pub_id, n_reactions):
+    """
+    Synthetic publication with n_reactions of H adsorption on Pt(111),
+    with one adsorbate structure per reaction and a shared slab and gas
+    phase reference.
+    """
+    stdout = io.StringIO()
+    slab = ase.build.fcc111('Pt', [2, 2, 4], vacuum=10)
+    slab.set_calculator(SinglePointCalculator(atoms=slab, energy=500))
+    gas = Atoms('H2', [[0, 0, 0], [0, 0, 0.74]], cell=[15, 15, 15])
+    gas.set_calculator(SinglePointCalculator(atoms=gas, energy=-6.8))
+    slab_id = write_ase(slab, filename, stdout=stdout)
+    gas_id = write_ase(gas, filename, stdout=stdout)
+
+    db_ase = ase.db.connect(filename)
+    ads_ids = []
+    with db_ase:
+        for i in range(n_reactions):
+            ads = slab.copy()
+            ase.build.add_adsorbate(ads, 'H', 1.0 + i * 1e-4, 'fcc')
+            ads.set_calculator(SinglePointCalculator(atoms=ads,
+                                                     energy=496.9 - i * 1e-4))
+            row = AtomsRow(ads)
+            row.ctime = now()
+            row.user = 'doe'
+            db_ase.write(row)
+            ads_ids.append(row.unique_id)
+
+    db = CathubSQLite(filename)
+    db.write_publication({'pub_id': pub_id,
+                          'title': 'Synthetic benchmark publication',
+                          'authors': ['Doe, John'],
+                          'journal': 'JACS',
+                          'volume': '1',
+                          'number': '1',
+                          'pages': '23-42',
+                          'year': 2017,
+                          'publisher': 'ACS',
+                          'doi': None,
+                          'tags': []})
+    db.write_many(
+        {'chemical_composition': 'Pt16',
+         'surface_composition': 'Pt',
+         'facet': '111',
+         'sites': {'H': 'fcc'},
+         'coverages': None,
+         'reactants': {'H2gas': 0.5, 'star': 1.0},
+         'products': {'Hstar': 1.0},
+         'reaction_energy': -0.5 - i * 1e-4,
+         'activation_energy': None,
+         'dft_code': 'Quantum ESPRESSO',
+         'dft_functional': 'BEEF-vdW',
+         'username': 'doe@stanford.edu',
+         'pub_id': pub_id,
+         'ase_ids': {'H2gas': gas_id, 'star': slab_id,
+                     'Hstar': ads_ids[i]},
+         'energy_corrections': {}}
+        for i in range(n_reactions))
+
+
+def count_rows(db, schema):
+    con = db._connect()
+    cur = con.cursor()
+    n = 0
+    for table in ['systems', 'publication', 'publication_system',
+                  'reaction', 'reaction_system']:
+        cur.execute('SELECT count(*) FROM {0}.{1}'.format(schema, table))
+        n += cur.fetchone()[0]
+    db._close(con)
+    return n
+
+
+@unittest.skipIf(find_pg_bin('initdb') is None or
+                 find_pg_bin('pg_ctl') is None,
+                 'postgreSQL binaries not found')
+class UploadBenchmarkTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.n_reactions = int(os.environ.get('CATHUB_BENCHMARK_SIZE', 200))
+        cls.server = LocalPostgreSQL()
+        try:
+            cls.server.initdb()
+        except (subprocess.CalledProcessError, OSError, KeyError) as e:
+            cls.server.stop()
+            raise unittest.SkipTest('initdb failed: {0}'.format(e))
+        cls.tempdir = tempfile.mkdtemp()
+        try:
+            cls.server.start()
+            cls.pub_id = 'DoeBenchmark2017'
+            cls.filename = os.path.join(cls.tempdir, cls.pub_id + '.db')
+            make_publication(cls.filename, cls.pub_id, cls.n_reactions)
+        except Exception:
+            cls.tearDownClass()
+            raise
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+        shutil.rmtree(cls.tempdir)
+
+    def test_upload_benchmark(self):
+        n = self.n_reactions
+        results = {}
+
+        admin = self.server.get_db()
+        con = admin._connect()
+        con.cursor().execute('CREATE SCHEMA upload;')
+        con.commit()
+        admin._close(con)
+
+        upload = self.server.get_db(schema='upload')
+        plan = upload.plan(self.filename, block_size=100)
+        self.assertEqual(plan['tables']['reaction'], n)
+        self.assertEqual(plan['existing_systems'], 0)
+        self.assertEqual(upload.status('systems'), 0)
+        results['plan'] = (plan['tables']['systems'],
+                           plan['projected_seconds'])
+
+        phases = upload.transfer(self.filename, block_size=100)
+        for phase, (rows, dt) in phases.items():
+            results['transfer_' + phase] = (rows, dt)
+        self.assertEqual(upload.status('reaction'), n)
+        self.assertEqual(upload.status('systems'), n + 2)
+        con = upload._connect()
+        cur = con.cursor()
+        cur.execute('SELECT min(id), max(id) FROM upload.systems')
+        self.assertEqual(cur.fetchone(), (1, n + 2))  # no ids used by plan
+        upload._close(con)
+
+        public = self.server.get_db()
+        public.status()  # create tables
+        t0 = time.time()
+        counts = public.release([self.pub_id], from_schema='upload',
+                                to_schema='public')
+        results['release'] = (sum(counts.values()), time.time() - t0)
+        self.assertEqual(counts['reaction'], n)
+        self.assertEqual(counts['reaction_system'], 3 * n)
+        self.assertEqual(public.status('reaction'), n)
+        energies = {}
+        for schema in ['upload', 'public']:
+            con = public._connect()
+            cur = con.cursor()
+            cur.execute('SELECT id, reaction_energy FROM {0}.reaction '
+                        'ORDER BY id'.format(schema))
+            energies[schema] = cur.fetchall()
+            public._close(con)
+        ids = [id for id, energy in energies['public']]
+        self.assertEqual(ids, list(range(ids[0], ids[0] + n)))
+        self.assertEqual([energy for id, energy in energies['public']],
+                         [energy for id, energy in energies['upload']])
+
+        n_rows = count_rows(upload, 'upload')
+        t0 = time.time()
+        upload.delete_publication(self.pub_id, schema='upload')
+        results['delete_publication'] = (n_rows - count_rows(upload,
+                                                             'upload'),
+                                         time.time() - t0)
+        self.assertEqual(count_rows(upload, 'upload'), 0)
+
+        sys.stdout.write('\n{0:<24} {1:>8} {2:>10} {3:>10}\n'.format(
+            'Phase', 'Rows', 'Seconds', 'Rows/sec'))
+        output = {}
+        for phase, (rows, dt) in sorted(results.items()):
+            output[phase] = {'rows': rows, 'seconds': dt,
+                             'rows_per_sec': rows / max(dt, 1e-6)}
+            sys.stdout.write('{0:<24} {1:>8} {2:>10.3f} {3:>10.0f}\n'.format(
+                phase, rows, dt, output[phase]['rows_per_sec']))
+        if os.environ.get('CATHUB_BENCHMARK_OUTPUT'):
+            with open(os.environ['CATHUB_BENCHMARK_OUTPUT'], 'w') as f:
+                json.dump({'n_reactions': n, 'phases': output}, f,
+                          indent=2)
+
+    def test_transfer_missing_source(self):
+        db = self.server.get_db()
+        filename = os.path.join(self.tempdir, 'missing.db')
+        with self.assertRaises(AssertionError):
+            db.transfer(filename)
+        self.assertFalse(os.path.exists(filename))
+
+        filename = os.path.join(self.tempdir, 'empty.db')
+        CathubSQLite(filename).migrate()  # no atomic structures
+        with self.assertRaises(AssertionError) as context:
+            db.transfer(filename)
+        self.assertIn('No atomic structures', str(context.exception))
+
+    def test_transfer_after_delete(self):
+        filename = os.path.join(self.tempdir, 'deleted.db')
+        shutil.copy(self.filename, filename)
+        db = CathubSQLite(filename)
+        self.assertEqual(db.delete_reactions([1]), (1, 1))  # gap in ids
+        n_systems = ase.db.connect(filename).count()
+
+        admin = self.server.get_db()
+        con = admin._connect()
+        con.cursor().execute('CREATE SCHEMA deleted;')
+        con.commit()
+        admin._close(con)
+
+        deleted = self.server.get_db(schema='deleted')
+        deleted.transfer(filename, block_size=50)
+        self.assertEqual(deleted.status('systems'), n_systems)
+        self.assertEqual(deleted.status('reaction'), self.n_reactions - 1)
+
+        reactions = list(deleted.iter_reactions(batch_size=50))
+        self.assertEqual(len(reactions), self.n_reactions - 1)
+        self.assertTrue(all(len(systems) == 3
+                            for row, systems in reactions))
+        ids = [reactions[0][0][0], reactions[-1][0][0]]
+        reactions = list(deleted.iter_reactions(
+            where='reaction.id = ANY(%s)', params=[ids], batch_size=1))
+        self.assertEqual([[system[3] for system in systems]
+                          for row, systems in reactions],
+                         [[ids[0]] * 3, [ids[1]] * 3])
+
+
+if __name__ == '__main__':
+    unittest.main()